@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Loopback benchmark for the Lab3 file sharing protocol.
+#
+# A file sharing Server is started on 127.0.0.1 (either on a thread in
+# this process or as a separate "main.py -r server" subprocess) and N
+# headless Clients are driven against it from threads. The workload
+# matrix covers file size, client concurrency and GET/PUT mix, plus a
+# small-file batch workload. Results are written as JSON and can be
+# compared against a previously saved baseline, e.g.
+#
+#   python benchmark.py -o baseline.json
+#   python benchmark.py -b baseline.json
+#
+# A PUT has no reply in this protocol, so each PUT is followed by an
+# RLIST round trip and its latency includes that round trip.
+#
+# The range workload has every client issue GETRANGE requests for
+# different regions of the largest benchmark file.
+#
+########################################################################
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from main import Server, Client
+
+########################################################################
+
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+DEFAULT_SIZES = "1K,64K,1M"
+DEFAULT_CLIENTS = "1,4"
+DEFAULT_GET_RATIOS = "1.0,0.5"
+
+BATCH_FILE_SIZE = 1024
+RANGE_SIZE = 64 * 1024
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+def parse_size(text):
+    # "64K" -> 65536, "4G" -> 4294967296, "100" -> 100
+    text = text.strip().upper()
+    if text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+def format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return str(size)
+
+def write_file(path, size):
+    # Files are transferred as raw bytes; ASCII keeps them readable.
+    chunk = (b"0123456789abcdef" * (WRITE_CHUNK_SIZE // 16))
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(chunk[:min(remaining, WRITE_CHUNK_SIZE)])
+            remaining -= WRITE_CHUNK_SIZE
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((Server.HOSTNAME, 0))
+        return s.getsockname()[1]
+
+########################################################################
+# Server launchers
+########################################################################
+
+class InProcessServer:
+
+    def __init__(self, dir_name, mmap_get):
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            self.server = Server(port=0, dir_name=dir_name, discovery=False, serve=False,
+                                 mmap_get=mmap_get)
+        self.port = self.server.port
+        self.thread = threading.Thread(target=self.server.process_connections_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stats(self):
+        return {"cache": self.server.file_cache.stats(),
+                "mmap": self.server.map_pool.stats()}
+
+    def stop(self):
+        self.server.shutdown()
+
+class SubprocessServer:
+
+    STARTUP_TIMEOUT = 10
+
+    def __init__(self, dir_name, mmap_get):
+        self.port = free_port()
+        main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        command = [sys.executable, main_path, "-r", "server", "-p", str(self.port),
+                   "-d", dir_name, "--no-discovery"]
+        if mmap_get:
+            command.append("--mmap-get")
+        self.process = subprocess.Popen(
+            command,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.wait_until_listening()
+
+    def wait_until_listening(self):
+        deadline = time.monotonic() + SubprocessServer.STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection((Server.HOSTNAME, self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError("Benchmark server did not start listening.")
+
+    def stats(self):
+        # Not visible from outside the server process.
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+########################################################################
+# Benchmark runner
+########################################################################
+
+class Benchmark:
+
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = tempfile.mkdtemp(prefix="lab3_bench_")
+        self.server_dir = os.path.join(self.work_dir, "server_dir")
+        os.mkdir(self.server_dir)
+        self.server_stats = None
+
+    def run(self):
+        launcher = SubprocessServer if self.args.subprocess else InProcessServer
+        server = launcher(self.server_dir, self.args.mmap_get)
+        results = []
+        try:
+            sizes = [parse_size(s) for s in self.args.sizes.split(",")]
+            clients = [int(c) for c in self.args.clients.split(",")]
+            get_ratios = [float(r) for r in self.args.get_ratios.split(",")]
+
+            for size in sizes:
+                write_file(os.path.join(self.server_dir, f"bench_{size}.txt"), size)
+                for n_clients in clients:
+                    for get_ratio in get_ratios:
+                        results.append(self.run_transfer(server.port, size, n_clients, get_ratio))
+
+            if self.args.batch > 0:
+                for n_clients in clients:
+                    results.append(self.run_batch(server.port, n_clients))
+
+            if self.args.ranges > 0:
+                for n_clients in clients:
+                    results.append(self.run_ranges(server.port, max(sizes), n_clients))
+            self.server_stats = server.stats()
+        finally:
+            server.stop()
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        return results
+
+    def make_client(self, port, index):
+        client_dir = os.path.join(self.work_dir, f"client_{index}")
+        os.makedirs(client_dir, exist_ok=True)
+        client = Client(dir_name=client_dir, interactive=False)
+        client.connect_to_server(Server.HOSTNAME, port)
+        return client
+
+    def run_clients(self, port, n_clients, worker):
+        # Start every client connection first so that the timed
+        # section only covers the transfers.
+        clients = [self.make_client(port, i) for i in range(n_clients)]
+        latencies = [[] for _ in range(n_clients)]
+        threads = [threading.Thread(target=worker, args=(i, clients[i], latencies[i]))
+                   for i in range(n_clients)]
+
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        for client in clients:
+            client.close_connection()
+        return elapsed, [l for client_latencies in latencies for l in client_latencies]
+
+    def run_transfer(self, port, size, n_clients, get_ratio):
+        ops = self.args.ops
+        # Deterministic GET/PUT interleaving for the requested ratio.
+        plan = [int((i + 1) * get_ratio) > int(i * get_ratio) for i in range(ops)]
+
+        def worker(index, client, latencies):
+            put_name = f"put_{index}_{size}.txt"
+            write_file(os.path.join(client.dir_name, put_name), size)
+            for is_get in plan:
+                start = time.perf_counter()
+                if is_get:
+                    client.get_file(f"bench_{size}.txt", f"got_{size}.txt")
+                else:
+                    client.put_file(put_name)
+                    client.get_remote_list()
+                latencies.append(time.perf_counter() - start)
+
+        elapsed, latencies = self.run_clients(port, n_clients, worker)
+        name = f"transfer size={format_size(size)} clients={n_clients} get={get_ratio}"
+        return self.make_result(name, elapsed, latencies, size * ops * n_clients,
+                                size=size, clients=n_clients, get_ratio=get_ratio)
+
+    def run_batch(self, port, n_clients):
+        batch = self.args.batch
+
+        def worker(index, client, latencies):
+            names = [f"batch_{index}_{i}.txt" for i in range(batch)]
+            for name in names:
+                write_file(os.path.join(client.dir_name, name), BATCH_FILE_SIZE)
+            for name in names:
+                start = time.perf_counter()
+                client.put_file(name)
+                latencies.append(time.perf_counter() - start)
+            # One round trip to make sure every PUT has landed.
+            client.get_remote_list()
+            for name in names:
+                start = time.perf_counter()
+                client.get_file(name)
+                latencies.append(time.perf_counter() - start)
+
+        elapsed, latencies = self.run_clients(port, n_clients, worker)
+        name = f"batch files={batch} clients={n_clients}"
+        return self.make_result(name, elapsed, latencies, 2 * batch * BATCH_FILE_SIZE * n_clients,
+                                size=BATCH_FILE_SIZE, clients=n_clients, batch=batch)
+
+    def run_ranges(self, port, size, n_clients):
+        ranges = self.args.ranges
+        range_size = self.args.range_size
+        n_slots = max(1, size // range_size)
+
+        def worker(index, client, latencies):
+            for i in range(ranges):
+                # Spread clients over different regions of the file.
+                offset = ((index * ranges + i) * 7919 % n_slots) * range_size
+                start = time.perf_counter()
+                client.get_file_range(f"bench_{size}.txt", offset, range_size, "range.bin")
+                latencies.append(time.perf_counter() - start)
+
+        elapsed, latencies = self.run_clients(port, n_clients, worker)
+        name = f"range size={format_size(size)} clients={n_clients}"
+        return self.make_result(name, elapsed, latencies,
+                                min(size, range_size) * ranges * n_clients,
+                                size=size, clients=n_clients, ranges=ranges, range_size=range_size)
+
+    def make_result(self, name, elapsed, latencies, total_bytes, **params):
+        result = {"name": name}
+        result.update(params)
+        result.update({
+            "ops": len(latencies),
+            "seconds": elapsed,
+            "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+            "mb_per_sec": total_bytes / SIZE_UNITS["M"] / elapsed if elapsed else 0.0,
+            "latency_p50_ms": percentile(latencies, 50) * 1000,
+            "latency_p95_ms": percentile(latencies, 95) * 1000,
+            "latency_max_ms": max(latencies, default=0.0) * 1000,
+        })
+        return result
+
+########################################################################
+# Baseline comparison
+########################################################################
+
+def compare_to_baseline(results, baseline, tolerance):
+    # Returns the names of results whose throughput fell more than
+    # tolerance (a fraction) below the baseline.
+    baseline_by_name = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    print("-" * 72)
+    print(f"{'workload':<48}{'ops/s':>10}{'change':>10}")
+    for result in results:
+        base = baseline_by_name.get(result["name"])
+        if base is None or base["ops_per_sec"] == 0:
+            print(f"{result['name']:<48}{result['ops_per_sec']:>10.1f}{'new':>10}")
+            continue
+        change = result["ops_per_sec"] / base["ops_per_sec"] - 1
+        flag = ""
+        if change < -tolerance:
+            regressions.append(result["name"])
+            flag = " REGRESSION"
+        print(f"{result['name']:<48}{result['ops_per_sec']:>10.1f}{change:>+10.1%}{flag}")
+    return regressions
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Lab3 loopback file transfer benchmark")
+
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated file sizes, e.g. 1K,1M,4G')
+    parser.add_argument('--clients', default=DEFAULT_CLIENTS,
+                        help='comma separated client concurrency levels')
+    parser.add_argument('--get-ratios', default=DEFAULT_GET_RATIOS,
+                        help='comma separated fraction of operations that are GETs')
+    parser.add_argument('--ops', default=10, type=int,
+                        help='operations per client per transfer workload')
+    parser.add_argument('--batch', default=100, type=int,
+                        help='small files per client in the batch workload (0 disables)')
+    parser.add_argument('--ranges', default=50, type=int,
+                        help='GETRANGE requests per client in the range workload (0 disables)')
+    parser.add_argument('--range-size', default=RANGE_SIZE, type=parse_size,
+                        help='bytes asked for by each GETRANGE (default: 64K)')
+    parser.add_argument('--mmap-get', action='store_true',
+                        help='start the server with mmap serving of large GETs')
+    parser.add_argument('--subprocess', action='store_true',
+                        help='run the server as a subprocess instead of a thread')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to this file')
+    parser.add_argument('-b', '--baseline',
+                        help='compare against a previously saved JSON result file')
+    parser.add_argument('--tolerance', default=0.10, type=float,
+                        help='allowed fractional throughput drop against the baseline')
+
+    args = parser.parse_args()
+
+    # Clients and server print on every operation; keep that off the
+    # benchmark report.
+    benchmark = Benchmark(args)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        results = benchmark.run()
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "server": "subprocess" if args.subprocess else "thread",
+            "server_stats": benchmark.server_stats,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+########################################################################
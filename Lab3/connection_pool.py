@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Client side pool of TCP connections to Lab3 file sharing servers.
+#
+# Connections are keyed by (ip, port). A connection is checked out for
+# the duration of one request/response exchange and handed back
+# afterwards, so later commands to the same server reuse it. An idle
+# connection the server has closed in the meantime is dropped when it
+# would have been handed out, rather than failing the caller. Failed
+# connects are retried with exponential backoff, and a server that
+# keeps failing is skipped by pick() until its backoff has expired.
+# Only network errors count as failures; a connection left half used
+# by any other exception is closed without blaming the server.
+# pick() spreads requests over the healthy servers, preferring the one
+# with the fewest requests in flight.
+#
+########################################################################
+
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+########################################################################
+
+class ServerHealth:
+
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0.0
+        self.in_flight = 0 # requests running through connection()
+        self.picked = 0
+
+class ConnectionPool:
+
+    MAX_IDLE_PER_SERVER = 4
+    CONNECT_TIMEOUT = 5
+    CONNECT_ATTEMPTS = 3
+    BACKOFF_INITIAL = 0.1
+    BACKOFF_MAX = 5.0
+
+    def __init__(self, connect_attempts=CONNECT_ATTEMPTS):
+        self.connect_attempts = connect_attempts
+        self.idle = {} # address -> [socket, ...]
+        self.health = {} # address -> ServerHealth
+        self.lock = threading.Lock()
+
+    def get_health(self, address):
+        # Caller must hold self.lock.
+        health = self.health.get(address)
+        if health is None:
+            health = self.health[address] = ServerHealth()
+        return health
+
+    def backoff(self, failures):
+        return min(ConnectionPool.BACKOFF_MAX, ConnectionPool.BACKOFF_INITIAL * 2 ** (failures - 1))
+
+    def acquire(self, address):
+        # Returns a connected socket, reusing an idle one if possible.
+        # Raises OSError if every connection attempt fails.
+        while True:
+            with self.lock:
+                idle = self.idle.get(address)
+                if not idle:
+                    break
+                sock = idle.pop()
+            if self.alive(sock):
+                return sock
+            sock.close()
+        return self.connect(address)
+
+    def alive(self, sock):
+        # An idle connection is only usable if the server has neither
+        # closed it nor sent anything unasked. Peek without blocking.
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            # Nothing to read: still open.
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.setblocking(True)
+        # End of file, or data nobody asked for.
+        return False
+
+    def connect(self, address):
+        for attempt in range(self.connect_attempts):
+            try:
+                sock = socket.create_connection(address, timeout=ConnectionPool.CONNECT_TIMEOUT)
+                sock.settimeout(None)
+                # A PUT has no reply, so the next request would otherwise
+                # wait (Nagle) for the server's delayed ACK of the PUT.
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with self.lock:
+                    health = self.get_health(address)
+                    health.failures = 0
+                    health.retry_at = 0.0
+                return sock
+            except OSError:
+                failures = self.mark_failed(address)
+                if attempt == self.connect_attempts - 1:
+                    raise
+                time.sleep(self.backoff(failures))
+
+    def release(self, address, sock, ok=True):
+        # Hand a connection back. Connections that saw an error are
+        # closed rather than reused.
+        with self.lock:
+            idle = self.idle.setdefault(address, [])
+            if ok and sock.fileno() != -1 and len(idle) < ConnectionPool.MAX_IDLE_PER_SERVER:
+                idle.append(sock)
+                return
+        if not ok:
+            self.mark_failed(address)
+        sock.close()
+
+    def mark_failed(self, address):
+        with self.lock:
+            health = self.get_health(address)
+            health.failures += 1
+            health.retry_at = time.monotonic() + self.backoff(health.failures)
+            return health.failures
+
+    @contextmanager
+    def connection(self, address):
+        # Check out a connection for one request/response exchange.
+        with self.lock:
+            self.get_health(address).in_flight += 1
+        try:
+            sock = self.acquire(address)
+            try:
+                yield sock
+            except (OSError, ConnectionError):
+                self.release(address, sock, ok=False)
+                raise
+            except BaseException:
+                # Not the server's doing, but the exchange may be half
+                # done, so the connection can't be reused.
+                sock.close()
+                raise
+            self.release(address, sock)
+        finally:
+            with self.lock:
+                self.health[address].in_flight -= 1
+
+    def pick(self, addresses):
+        # Choose the server to send the next request to, or None if
+        # every candidate is backing off.
+        now = time.monotonic()
+        with self.lock:
+            candidates = [a for a in addresses if self.get_health(a).retry_at <= now]
+            if not candidates:
+                return None
+            address = min(candidates, key=lambda a: (self.health[a].in_flight,
+                                                     self.health[a].failures,
+                                                     self.health[a].picked))
+            self.health[address].picked += 1
+            return address
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for socks in idle.values():
+            for sock in socks:
+                sock.close()
+
+########################################################################
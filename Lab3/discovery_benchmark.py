@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# SCAN flood benchmark for the Lab3 service announcement server.
+#
+# A discovery Server is started on a thread and flooded with synthetic
+# SCAN datagrams over loopback. Each flooding socket is bound to its
+# own 127.0.0.x source address, so that the high rate responder's per
+# source rate limit applies to each of them separately. The report
+# (JSON) gives the packets sent, the server's served/dropped counters
+# and the replies that made it back, for the plain and/or high rate
+# responder, e.g.
+#
+#   python discovery_benchmark.py --mode both --seconds 3
+#
+########################################################################
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+from service_announcement import Server
+
+########################################################################
+
+FIRST_PORT = 30100
+SETTLE_TIME = 0.5
+
+def flood(port, sources, seconds):
+    socks = []
+    for i in range(sources):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((f"127.0.0.{2 + i % 250}", 0))
+        sock.setblocking(False)
+        socks.append(sock)
+
+    sent = 0
+    replies = 0
+    target = ("127.0.0.1", port)
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for sock in socks:
+            try:
+                sock.sendto(Server.SCAN_CMD_ENCODED, target)
+                sent += 1
+            except BlockingIOError:
+                pass
+        for sock in socks:
+            replies += drain(sock)
+
+    # Collect the replies to the last packets.
+    time.sleep(SETTLE_TIME)
+    for sock in socks:
+        replies += drain(sock)
+        sock.close()
+    return sent, replies
+
+def drain(sock):
+    count = 0
+    while True:
+        try:
+            sock.recvfrom(Server.RECV_SIZE)
+            count += 1
+        except (BlockingIOError, ConnectionRefusedError):
+            return count
+
+def run_mode(high_rate, port, sources, seconds):
+    server_ready = threading.Event()
+    servers = []
+
+    def serve():
+        server = Server(port=port, high_rate=high_rate, serve=False)
+        servers.append(server)
+        server_ready.set()
+        if high_rate:
+            server.receive_forever_high_rate()
+        else:
+            server.receive_forever()
+
+    # The plain responder can't be stopped, so it runs as a daemon.
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    server_ready.wait()
+
+    start = time.perf_counter()
+    sent, replies = flood(port, sources, seconds)
+    elapsed = time.perf_counter() - start
+
+    server = servers[0]
+    stats = server.stats()
+    server.shutdown()
+    return {
+        "mode": "high_rate" if high_rate else "plain",
+        "sources": sources,
+        "seconds": elapsed,
+        "sent": sent,
+        "sent_per_sec": sent / elapsed,
+        "replies_received": replies,
+        "server": stats,
+        "handled_per_sec": sum(stats.values()) / elapsed,
+    }
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Lab3 discovery responder flood benchmark")
+
+    parser.add_argument('--mode', choices=('plain', 'high-rate', 'both'), default='both')
+    parser.add_argument('--sources', default=8, type=int,
+                        help='number of flooding source addresses')
+    parser.add_argument('--seconds', default=3.0, type=float,
+                        help='flood duration per mode')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to this file')
+
+    args = parser.parse_args()
+
+    modes = {"plain": [False], "high-rate": [True], "both": [False, True]}[args.mode]
+    results = []
+    for i, high_rate in enumerate(modes):
+        # The plain responder prints every packet.
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            results.append(run_mode(high_rate, FIRST_PORT + i, args.sources, args.seconds))
+
+    report = json.dumps({"results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+########################################################################
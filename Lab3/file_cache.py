@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# In-memory LRU cache of encoded GET responses for the Lab3 server.
+#
+# Entries are keyed by file path and hold the complete response packet
+# (8 byte file size field + file bytes) so a hit can be handed straight
+# to sendall. An entry is only valid while the file's mtime and size
+# match the values recorded when it was cached. The cache is bounded by
+# a total byte budget and files larger than MAX_ENTRY_BYTES are never
+# cached.
+#
+########################################################################
+
+import os
+import threading
+from collections import OrderedDict
+
+########################################################################
+
+class FileCache:
+
+    MAX_BYTES = 64 * 1024 * 1024
+    MAX_ENTRY_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, max_bytes=MAX_BYTES, max_entry_bytes=MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.entries = OrderedDict() # path -> (mtime_ns, size, pkt)
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    def lookup(self, path):
+        # Returns (pkt, stat). pkt is None on a miss, in which case the
+        # caller builds the packet and passes the same stat to store().
+        # Raises FileNotFoundError if the file does not exist.
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                mtime_ns, size, pkt = entry
+                if mtime_ns == st.st_mtime_ns and size == st.st_size:
+                    self.entries.move_to_end(path)
+                    self.hits += 1
+                    return pkt, st
+                # Stale: the file changed on disk since it was cached.
+                self.remove(path)
+            if st.st_size > self.max_entry_bytes:
+                self.bypasses += 1
+            else:
+                self.misses += 1
+        return None, st
+
+    def store(self, path, st, pkt):
+        if len(pkt) > self.max_entry_bytes:
+            return
+        with self.lock:
+            self.remove(path)
+            self.entries[path] = (st.st_mtime_ns, st.st_size, pkt)
+            self.current_bytes += len(pkt)
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self.remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, path):
+        with self.lock:
+            self.remove(path)
+
+    def remove(self, path):
+        # Caller must hold self.lock.
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.current_bytes -= len(entry[2])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+            }
+
+########################################################################
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Per-file reader/writer locking for the Lab3 server.
+#
+# Each file name in the shared directory gets its own ReadWriteLock,
+# created on first use and dropped again once nobody holds or waits on
+# it. Any number of GETs may read a file at once, a PUT to the same
+# name waits for them and excludes new readers, and operations on
+# different names never wait on each other.
+#
+########################################################################
+
+import threading
+from contextlib import contextmanager
+
+########################################################################
+
+class ReadWriteLock:
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.cond:
+            # Writers take priority so a steady stream of GETs cannot
+            # starve an upload.
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+class FileLockTable:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {} # name -> [ReadWriteLock, users]
+
+    def checkout(self, name):
+        with self.lock:
+            entry = self.locks.get(name)
+            if entry is None:
+                entry = self.locks[name] = [ReadWriteLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def checkin(self, name):
+        with self.lock:
+            entry = self.locks[name]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[name]
+
+    @contextmanager
+    def read(self, name):
+        rw_lock = self.checkout(name)
+        rw_lock.acquire_read()
+        try:
+            yield
+        finally:
+            rw_lock.release_read()
+            self.checkin(name)
+
+    @contextmanager
+    def write(self, name):
+        rw_lock = self.checkout(name)
+        rw_lock.acquire_write()
+        try:
+            yield
+        finally:
+            rw_lock.release_write()
+            self.checkin(name)
+
+########################################################################
@@ -23,9 +23,18 @@ import argparse
 import threading
 import os
 import json
+import tempfile
+import time
+import sys
+import contextlib
+import collections
 
 from service_announcement import Server as DiscoveryServer
 from service_discovery_cycles import Client as DiscoveryClient
+from file_cache import FileCache
+from file_locks import FileLockTable
+from mmap_pool import MapPool
+from connection_pool import ConnectionPool
 
 ########################################################################
 
@@ -35,6 +44,12 @@ CMD_FIELD_LEN = 1 # 1 byte commands sent from the client.
 FILE_SIZE_FIELD_LEN  = 8 # 8 byte file size field.
 FILE_NAME_FIELD_LEN = 127
 PACKET_SIZE_FIELD_LEN = 8
+RANGE_OFFSET_FIELD_LEN = 8
+RANGE_LENGTH_FIELD_LEN = 8
+
+# Files are sent and stored as raw bytes, this many at a time, so
+# neither end holds a whole file in memory.
+FILE_CHUNK_SIZE = 64 * 1024
 
 # Packet format when a GET command is sent from a client, asking for a
 # file download:
@@ -50,13 +65,74 @@ PACKET_SIZE_FIELD_LEN = 8
 # | 8 byte file size | ... file ... |
 # -----------------------------------
 
+# A GETRANGE command asks for length bytes starting at offset. The
+# response has the same layout as a GET response, where the size field
+# is the number of bytes actually returned (the range is clipped to the
+# end of the file). Like GETs, ranges are served as raw file bytes.
+
+# --------------------------------------------------------------------
+# | 1 byte GETRANGE | 8 byte offset | 8 byte length | ... file name ... |
+# --------------------------------------------------------------------
+
+# GETANY is client side only: it sends a GET to whichever discovered
+# server holding the file is least busy.
+
 # Define a dictionary of commands. The actual command field value must
 # be a 1-byte integer. For now, we only define the "GET" command,
 # which tells the server to send a file.
 
-CMD = { "PUT": 1, "GET": 2, "SCAN": 3, "CONNECT": 4, "LLIST": 5, "RLIST": 6, "BYE": 7 }
+CMD = { "PUT": 1, "GET": 2, "SCAN": 3, "CONNECT": 4, "LLIST": 5, "RLIST": 6, "BYE": 7, "GETRANGE": 8,
+        "GETANY": 9 }
 
 MSG_ENCODING = "utf-8"
+
+def make_size_field(file_size):
+    return file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+
+def make_file_pkt(file_bytes):
+    # Prepend the file size field to the file contents.
+    return make_size_field(len(file_bytes)) + file_bytes
+
+def recv_exact(sock, length):
+    # Receive exactly length bytes, or None if the peer closed early.
+    buf = bytearray()
+    while len(buf) < length:
+        recvd = sock.recv(min(length - len(buf), FILE_CHUNK_SIZE))
+        if len(recvd) == 0:
+            return None
+        buf += recvd
+    return bytes(buf)
+
+def recv_to_file(sock, f, length):
+    # Receive exactly length bytes into the binary file f, a chunk at a
+    # time. False if the peer closed early.
+    buf = bytearray(min(length, FILE_CHUNK_SIZE))
+    view = memoryview(buf)
+    remaining = length
+    while remaining > 0:
+        recvd = sock.recv_into(view, min(remaining, len(buf)))
+        if recvd == 0:
+            return False
+        f.write(view[:recvd])
+        remaining -= recvd
+    return True
+
+def send_with_file(sock, header, f, size):
+    # Send header then the first size bytes of the binary file f. A
+    # file of up to FILE_CHUNK_SIZE goes out in the same write as the
+    # header: sent on its own it would sit behind the header (Nagle)
+    # until the peer's delayed ACK, about 40 ms. Larger files go
+    # straight from the file to the socket.
+    if size <= FILE_CHUNK_SIZE:
+        sock.sendall(header + f.read(size))
+        return
+    sock.sendall(header)
+    sock.sendfile(f, 0, size)
+
+def send_file(sock, f):
+    # Send the binary file f as a GET response.
+    file_size = os.fstat(f.fileno()).st_size
+    send_with_file(sock, make_size_field(file_size), f, file_size)
     
 ########################################################################
 # SERVER
@@ -73,49 +149,116 @@ class Server:
     FILE_NOT_FOUND_MSG = "Error: Requested file is not available!"
     DIR_NAME = "server_dir"
 
-    def __init__(self):
-        # Start discovery server thread
-        self.discovery_server = None
-        self.discovery_thread = threading.Thread(target=self.create_discovery_server)
-        self.discovery_thread.start()
+    # Uploads are staged under this prefix and renamed into place.
+    TEMP_FILE_PREFIX = ".put_"
+
+    # Advertised to discovery clients along with the current number
+    # of connected clients, so they can pick the least loaded server.
+    CAPACITY = 32
+
+    def __init__(self, hostname=HOSTNAME, port=PORT, dir_name=DIR_NAME,
+                 discovery=True, serve=True, cache_bytes=FileCache.MAX_BYTES,
+                 mmap_get=False, discovery_high_rate=False):
+        self.hostname = hostname
+        self.port = port
+        self.dir_name = dir_name
+        self.running = True
+
+        # Encoded GET responses of recently requested files.
+        self.file_cache = FileCache(max_bytes=cache_bytes)
+
+        # Reader/writer lock per file name in the shared directory.
+        self.file_locks = FileLockTable()
+
+        # Shared read-only mappings used by GETRANGE and, when mmap_get
+        # is set, by GETs of files too large for the cache.
+        self.map_pool = MapPool()
+        self.mmap_get = mmap_get
+
+        self.active_connections = 0
+        self.active_connections_lock = threading.Lock()
 
-        
         self.create_listen_socket()
 
+        # Start discovery server thread once the service port is known.
+        self.discovery_server = None
+        self.discovery_high_rate = discovery_high_rate
+        if discovery:
+            self.discovery_thread = threading.Thread(target=self.create_discovery_server)
+            self.discovery_thread.daemon = True
+            self.discovery_thread.start()
+
         print("-" * 72)
         print("Files available in shared directory:\n")
 
-        for item in os.listdir(Server.DIR_NAME):
+        for item in os.listdir(self.dir_name):
             print(item)
-        self.process_connections_forever()
-        
+
+        # When embedded (e.g. by the benchmark harness) the caller runs
+        # process_connections_forever itself, usually on a thread.
+        if serve:
+            self.process_connections_forever()
+
 
     def create_discovery_server(self):
-        self.discovery_server = DiscoveryServer()
+        self.discovery_server = DiscoveryServer(service_port=self.port, capacity=Server.CAPACITY,
+                                                load=lambda: self.active_connections,
+                                                high_rate=self.discovery_high_rate)
 
     def create_listen_socket(self):
         try:
             # Create the TCP server listen socket in the usual way.
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.bind((Server.HOSTNAME, Server.PORT))
+            self.socket.bind((self.hostname, self.port))
             self.socket.listen(Server.BACKLOG)
-            print("Listening on for file sharing connections on port {} ...".format(Server.PORT))
+            # Port 0 asks the OS for a free port; record the real one.
+            self.port = self.socket.getsockname()[1]
+            print("Listening on for file sharing connections on port {} ...".format(self.port))
         except Exception as msg:
             print(msg)
             exit()
 
     def process_connections_forever(self):
         try:
-            while True:
-                threading.Thread(target=self.connection_handler(self.socket.accept())).start()
+            while self.running:
+                client = self.socket.accept()
+                handler = threading.Thread(target=self.connection_handler, args=(client, ))
+                handler.daemon = True
+                handler.start()
         except KeyboardInterrupt:
             print()
+        except OSError:
+            # The listen socket was closed by shutdown().
+            if self.running:
+                raise
         finally:
             self.socket.close()
 
+    def shutdown(self):
+        self.running = False
+        self.map_pool.close()
+        try:
+            # Wakes up a thread blocked in accept().
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
     def connection_handler(self, client):
+        with self.active_connections_lock:
+            self.active_connections += 1
+        try:
+            self.serve_connection(client)
+        finally:
+            with self.active_connections_lock:
+                self.active_connections -= 1
+
+    def serve_connection(self, client):
         connection, address = client
+        # Replies are small writes right after reading a request; don't
+        # let Nagle hold them for the client's delayed ACK.
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         print("-" * 72)
         print(f"Connection received from {address[0]} on port {address[1]}.")
 
@@ -136,8 +279,15 @@ class Server:
                 print("Received rlist command.")
                 pkt = self.handle_list_cmd()
             elif cmd == CMD["PUT"]:
-                recv_bytes = connection.recv(Server.RECV_SIZE)
-                pkt = self.handle_put_cmd(recv_bytes, connection)
+                pkt = self.handle_put_cmd(connection)
+            elif cmd == CMD["GETRANGE"]:
+                pkt = self.handle_get_range_cmd(connection)
+            else:
+                pkt = None
+
+            # A handler closes the connection when it gives up on it.
+            if connection.fileno() == -1:
+                return
 
             try:
                 # Send the packet to the connected client.
@@ -153,57 +303,140 @@ class Server:
                 return
     
     def handle_get_cmd(self, filename, conn):
+        path = f"{self.dir_name}/{filename}"
+
+        # Large files are sent straight from a shared mapping rather
+        # than read into memory for every request.
+        if self.mmap_get:
+            try:
+                if os.stat(path).st_size > self.file_cache.max_entry_bytes:
+                    return self.send_mapped(conn, path)
+            except FileNotFoundError:
+                pass
+
         # Open the requested file and get set to send it to the
-        # client.
+        # client, unless an up to date response is already cached.
+        with self.file_locks.read(filename):
+            try:
+                pkt, st = self.file_cache.lookup(path)
+                if pkt is not None:
+                    return pkt
+                file = open(path, 'rb')
+            except FileNotFoundError:
+                print(Server.FILE_NOT_FOUND_MSG)
+                conn.close()                   
+                return
+
+            # Files small enough to cache are sent (and cached) as one
+            # packet with the header field.
+            if st.st_size <= self.file_cache.max_entry_bytes:
+                with file:
+                    pkt = make_file_pkt(file.read())
+                self.file_cache.store(path, st, pkt)
+                return pkt
+
+        # Larger ones are streamed from the file. PUTs replace the file
+        # by rename, so the open file stays complete without the lock.
+        with file:
+            try:
+                send_file(conn, file)
+            except socket.error:
+                print("Closing client connection ...")
+                conn.close()
+
+    def handle_get_range_cmd(self, conn):
+        header = recv_exact(conn, RANGE_OFFSET_FIELD_LEN + RANGE_LENGTH_FIELD_LEN)
+        if header is None:
+            conn.close()
+            return
+        offset = int.from_bytes(header[:RANGE_OFFSET_FIELD_LEN], byteorder='big')
+        length = int.from_bytes(header[RANGE_OFFSET_FIELD_LEN:], byteorder='big')
+        filename = conn.recv(Server.RECV_SIZE).decode(MSG_ENCODING)
+
+        return self.send_mapped(conn, f"{self.dir_name}/{filename}", offset, length)
+
+    def send_mapped(self, conn, path, offset=0, length=None):
+        # Send a GET style response straight out of the shared mapping.
+        # No file lock is needed: PUTs replace the file by rename, so a
+        # mapping always refers to a complete file.
         try:
-            file = open(f"{Server.DIR_NAME}/{filename}", 'r').read()
+            with self.map_pool.view(path, offset, length) as (mv, file_size):
+                # One write for the size field and a small range, as in
+                # send_with_file.
+                if len(mv) <= FILE_CHUNK_SIZE:
+                    conn.sendall(make_size_field(len(mv)) + mv)
+                else:
+                    conn.sendall(make_size_field(len(mv)))
+                    conn.sendall(mv)
         except FileNotFoundError:
             print(Server.FILE_NOT_FOUND_MSG)
-            conn.close()                   
+            conn.close()
+        except socket.error:
+            print("Closing client connection ...")
+            conn.close()
+
+    def handle_put_cmd(self, conn):
+        # Read exactly the PUT header so that a command pipelined
+        # behind this upload is not swallowed into the file contents.
+        header = recv_exact(conn, FILE_NAME_FIELD_LEN + FILE_SIZE_FIELD_LEN)
+        if header is None:
+            print("Error while receiving file, closing connection.")
+            conn.close()
             return
 
-        # Encode the file contents into bytes, record its size and
-        # generate the file size field used for transmission.
-        file_bytes = file.encode(MSG_ENCODING)
-        file_size_bytes = len(file_bytes)
-        file_size_field = file_size_bytes.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
-
-        # Create the packet to be sent with the header field.
-        pkt = file_size_field + file_bytes
-        
-        return pkt
-
-    def handle_put_cmd(self, filebytes, conn):
         # Extract information about file
-        filename = filebytes[:FILE_NAME_FIELD_LEN].decode(MSG_ENCODING).rstrip()
-        file_size = int.from_bytes(filebytes[FILE_NAME_FIELD_LEN:(FILE_NAME_FIELD_LEN + FILE_SIZE_FIELD_LEN)], byteorder="big")
-        file_contents = bytearray(filebytes[(FILE_NAME_FIELD_LEN + FILE_SIZE_FIELD_LEN):])
-        
-        while(len(file_contents) < file_size):
-            # Recv until entire file is uploaded
-            recvd = conn.recv(Server.RECV_SIZE)
-            file_contents += recvd
-
-            if (len(recvd) == 0):
-                print("Error while receiving file, closing connection.")
-                conn.close()
-                return
-                
-
-        # Write the file 
+        filename = header[:FILE_NAME_FIELD_LEN].decode(MSG_ENCODING).rstrip()
+        file_size = int.from_bytes(header[FILE_NAME_FIELD_LEN:], byteorder="big")
+
+        # Recv until entire file is uploaded, straight into a temporary
+        # file that is then renamed over the target, so a GET never sees
+        # a half-written file. The upload cannot be skipped, so if it
+        # can't be stored the connection is closed.
+        path = f"{self.dir_name}/{filename}"
         try:
-            with open(f"{Server.DIR_NAME}/{filename}", "w") as f:
-                f.write(file_contents.decode(MSG_ENCODING))
-            print(f"Received file: {filename}")
-        except Exception as e:
+            fd, temp_path = tempfile.mkstemp(prefix=Server.TEMP_FILE_PREFIX, dir=self.dir_name)
+            try:
+                with open(fd, "wb") as f:
+                    received = recv_to_file(conn, f, file_size)
+                if not received:
+                    print("Error while receiving file, closing connection.")
+                    os.unlink(temp_path)
+                    conn.close()
+                    return
+                # mkstemp creates owner-only files; match open().
+                os.chmod(temp_path, 0o644)
+                with self.file_locks.write(filename):
+                    os.replace(temp_path, path)
+                    print(f"Received file: {filename}")
+
+                    # Refresh the cached GET response with the uploaded
+                    # contents.
+                    self.map_pool.invalidate(path)
+                    self.file_cache.invalidate(path)
+                    if file_size <= self.file_cache.max_entry_bytes:
+                        try:
+                            with open(path, "rb") as f:
+                                self.file_cache.store(path, os.fstat(f.fileno()), make_file_pkt(f.read()))
+                        except OSError:
+                            self.file_cache.invalidate(path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+                raise
+        except OSError as e:
             print(f"Error writing file {filename}: {e}")
+            self.file_cache.invalidate(path)
+            conn.close()
 
     def handle_list_cmd(self):
         # Read contents of shared directory and build a list of the contents
-        dir_contents = os.listdir(Server.DIR_NAME)
+        dir_contents = os.listdir(self.dir_name)
         pkt_string = ""
         print(dir_contents)
         for item in dir_contents:
+            # Skip uploads that are still being staged.
+            if item.startswith(Server.TEMP_FILE_PREFIX):
+                continue
             pkt_string += f"{item}\n"
 
         pkt_bytes = pkt_string.encode(MSG_ENCODING)
@@ -219,103 +452,211 @@ class Server:
 
 class Client:
 
-    RECV_SIZE = 10
-
     # Define the local file name where the downloaded file will be
     # saved.
     DIR_NAME = "client_dir"
 
     FILE_NOT_FOUND_MSG = "Error: Requested file is not available!"
 
-    def __init__(self):
-        self.get_socket()
+    # Commands that talk to the connected server.
+    SERVER_CMDS = (CMD["PUT"], CMD["GET"], CMD["GETRANGE"], CMD["RLIST"])
+
+    # How long a server's RLIST is trusted when choosing GETANY servers.
+    RLIST_TTL = 10
+    TEMP_FILE_PREFIX = ".get_"
+
+    def __init__(self, dir_name=DIR_NAME, interactive=True):
+        self.dir_name = dir_name
+
+        # Connections are kept in a pool keyed by (ip, port); self.socket
+        # is the one checked out for the current server.
+        self.pool = ConnectionPool()
+        self.socket = None
+        self.server_address = None
+        self.remote_lists = {} # address -> (time fetched, set of names)
+
         self.discovery_client = DiscoveryClient()
-        self.run()
+        if interactive:
+            self.run()
 
-    def run(self):
-        while True:
-            cmd, args = self.get_input()
-            if cmd == CMD["PUT"]:
-                if len(args) >= 2:
-                    self.put_file(args[0], args[1])
-                elif len(args) == 1:
-                    self.put_file(args[0])
-            elif cmd == CMD["GET"]:
-                if len(args) >= 2:
-                    self.get_file(args[0], args[1])
-                elif len(args) == 1:
-                    self.put_file(args[0])
-            elif cmd == CMD["SCAN"]:
-                self.discovery_client.scan_for_service()
-            elif cmd == CMD["CONNECT"]:
-                if len(args) < 2:
-                    self.connect_to_server()
-                else:
-                    self.connect_to_server(args[0], args[1])
-            elif cmd == CMD["LLIST"]:
-                if len(args) < 1:
-                    self.get_local_list()
-                else:
-                    self.get_local_list(args[0])
-            elif cmd == CMD["RLIST"]:
-                self.get_remote_list()
-            elif cmd == CMD["BYE"]:
-                self.close_connection()
+    def run(self, commands=None):
+        # Commands come from the prompt unless an iterable of command
+        # lines is given, which lets scripts drive the client headless.
+        if commands is None:
+            while True:
+                cmd, args = self.get_input()
+                self.execute_command(cmd, args)
+                if cmd == CMD["BYE"]:
+                    return
+
+        for line in commands:
+            parsed = self.parse_command(line)
+            if parsed is None:
+                print(f"Invalid command: {line.strip()}")
+                continue
+            self.execute_command(*parsed)
+            if parsed[0] == CMD["BYE"]:
                 return
+
+    def execute_command(self, cmd, args):
+        # Returns the command's result; None or False if it failed.
+        if cmd in Client.SERVER_CMDS and not self.ensure_connected():
+            return None
+
+        if cmd == CMD["PUT"]:
+            if len(args) >= 1:
+                return self.put_file(*args[:2])
+        elif cmd == CMD["GET"]:
+            if len(args) >= 1:
+                return self.get_file(*args[:2])
+        elif cmd == CMD["GETRANGE"]:
+            if len(args) >= 3:
+                return self.get_file_range(args[0], int(args[1]), int(args[2]), *args[3:4])
+            print("Usage: getrange <remote file> <offset> <length> [local file]")
+        elif cmd == CMD["GETANY"]:
+            if len(args) >= 1:
+                return self.get_file_any(*args[:2])
+            print("Usage: getany <remote file> [local file]")
+        elif cmd == CMD["SCAN"]:
+            if len(args) >= 1 and args[0] == "live":
+                # Answer from the background scan's table, which only
+                # has to be waited for the first time.
+                self.discovery_client.start_background_scan()
+                self.discovery_client.wait_for_background_scan()
+                for service in self.discovery_client.get_services():
+                    print(service)
+            else:
+                self.discovery_client.scan_for_service()
+            return True
+        elif cmd == CMD["CONNECT"]:
+            if len(args) < 2:
+                # Pick the least loaded discovered server, falling back
+                # to the default address if none advertises its port.
+                service = self.discovery_client.best_service()
+                if service is not None:
+                    return self.connect_to_server(service.address[0], service.port)
+                return self.connect_to_server()
+            return self.connect_to_server(args[0], int(args[1]))
+        elif cmd == CMD["LLIST"]:
+            self.get_local_list(*args[:1])
+            return True
+        elif cmd == CMD["RLIST"]:
+            return self.get_remote_list()
+        elif cmd == CMD["BYE"]:
+            self.close_connection()
+            return True
+        return None
     
     def get_local_list(self, dir=None):
         if dir == None:
-            dir = Client.DIR_NAME
+            dir = self.dir_name
         contents = os.listdir(dir)
         for entry in contents:
+            # Skip downloads still in progress.
+            if entry.startswith(Client.TEMP_FILE_PREFIX):
+                continue
             print(f"{entry}")
 
+    def parse_command(self, user_input):
+        # Map a command line to (cmd byte, args), or None if invalid.
+        args = user_input.split()
+        if len(args) == 0:
+            return None
+        user_input = args[0]
+        args = args[1:]
+
+        if user_input == "quit":
+            return CMD["BYE"], args
+        user_input = user_input.upper()
+        for cmd_string, cmd_byte in CMD.items():
+            if user_input == cmd_string:
+                return cmd_byte, args
+        return None
+
     def get_input(self):
         # Get user input and act
         while True:
-            user_input = input("Enter a command: ")
-            args = user_input.split(" ")
-            if len(args) > 1:
-                user_input = args[0]
-                args = args[1:]
-            else:
-                args = []
-
-            if user_input == "quit":
-                return CMD["BYE"], args
-            user_input = user_input.upper()
-            for cmd_string, cmd_byte in CMD.items():
-                if user_input == cmd_string:
-                    return cmd_byte, args
+            parsed = self.parse_command(input("Enter a command: "))
+            if parsed is not None:
+                return parsed
             
             print("Invalid command, please try again.")
 
-    def get_socket(self):
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        except Exception as msg:
-            print(msg)
-            exit()
-
     def connect_to_server(self, ip=Server.HOSTNAME, port=Server.PORT):
+        address = (ip, int(port))
+        self.release_connection()
         try:
-            self.socket.connect((ip, port))
-            print(f"Connected to server at {ip}:{port}")
-        except Exception as msg:
+            # Reuses an idle pooled connection, otherwise connects with
+            # backoff between attempts.
+            self.socket = self.pool.acquire(address)
+        except OSError as msg:
             print(msg)
-            exit()
+            return False
+        self.server_address = address
+        print(f"Connected to server at {ip}:{port}")
+        return True
+
+    def ensure_connected(self):
+        # Reconnect to the current server if its connection was closed.
+        if self.socket is not None and self.socket.fileno() != -1:
+            return True
+        if self.server_address is None:
+            print("Not connected to a server.")
+            return False
+        return self.connect_to_server(*self.server_address)
+
+    def release_connection(self):
+        if self.socket is not None:
+            self.pool.release(self.server_address, self.socket, ok=self.socket.fileno() != -1)
+            self.socket = None
 
     def socket_recv_size(self, length):
-        bytes = self.socket.recv(length)
-        if len(bytes) < length:
+        # Returns None, with the socket closed, if the server hung up.
+        bytes = recv_exact(self.socket, length)
+        if bytes is None:
             self.socket.close()
-            exit()
         return(bytes)
             
     def get_file(self, remote_filename, local_filename=None):
 
         if local_filename == None:
             local_filename = remote_filename
+        # Open the local file first: failing to, after the request was
+        # sent, would leave the reply unread and the connection unusable.
+        try:
+            f, temp_path = self.open_download()
+        except OSError as msg:
+            print(msg)
+            return
+        with f:
+            file_size = self.receive_file(remote_filename, local_filename, f)
+        if not self.finish_download(temp_path, local_filename, file_size is not None):
+            return
+        return file_size
+
+    def open_download(self):
+        # A temporary file in our directory to download into, so that a
+        # failed download leaves any existing copy alone. Returns the
+        # binary file and its path.
+        fd, temp_path = tempfile.mkstemp(prefix=Client.TEMP_FILE_PREFIX, dir=self.dir_name)
+        return open(fd, 'wb'), temp_path
+
+    def finish_download(self, temp_path, local_filename, ok):
+        # Put a completed download in place, or throw a failed one away.
+        # Returns whether local_filename now holds the download.
+        try:
+            if not ok:
+                os.unlink(temp_path)
+                return False
+            # mkstemp creates owner-only files; match open().
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, f"{self.dir_name}/{local_filename}")
+            return True
+        except OSError as msg:
+            print(msg)
+            return False
+
+    def receive_file(self, remote_filename, local_filename, f):
         # Create the packet GET field.
         get_field = CMD["GET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
 
@@ -330,27 +671,22 @@ class Client:
 
         # Read the file size field.
         file_size_bytes = self.socket_recv_size(FILE_SIZE_FIELD_LEN)
-        if len(file_size_bytes) == 0:
-            self.socket.close()
+        if file_size_bytes is None:
             return
 
         # Make sure that you interpret it in host byte order.
         file_size = int.from_bytes(file_size_bytes, byteorder='big')
 
-        # Receive the file itself.
-        recvd_bytes_total = bytearray()
+        # Receive the file itself, straight into the local file.
         try:
-            # Keep doing recv until the entire file is downloaded. 
-            while len(recvd_bytes_total) < file_size:
-                recvd_bytes_total += self.socket.recv(Client.RECV_SIZE)
+            if not recv_to_file(self.socket, f, file_size):
+                print("Connection closed by server during download.")
+                self.socket.close()
+                return
 
-            # Create a file using the received filename and store the
-            # data.
             print("Received {} bytes. Creating file: {}" \
-                  .format(len(recvd_bytes_total), local_filename))
-
-            with open(f"{Client.DIR_NAME}/{local_filename}", 'w') as f:
-                f.write(recvd_bytes_total.decode(MSG_ENCODING))
+                  .format(file_size, local_filename))
+            return file_size
         except KeyboardInterrupt:
             print()
             exit(1)
@@ -359,26 +695,128 @@ class Client:
         except socket.error:
             self.socket.close()
     
+    def get_file_range(self, remote_filename, offset, length, local_filename=None):
+        if local_filename == None:
+            local_filename = remote_filename
+
+        # Create the packet: command, offset, length, then file name.
+        pkt = CMD["GETRANGE"].to_bytes(CMD_FIELD_LEN, byteorder='big') \
+            + offset.to_bytes(RANGE_OFFSET_FIELD_LEN, byteorder='big') \
+            + length.to_bytes(RANGE_LENGTH_FIELD_LEN, byteorder='big') \
+            + remote_filename.encode(MSG_ENCODING)
+        self.socket.sendall(pkt)
+
+        range_size_bytes = self.socket_recv_size(FILE_SIZE_FIELD_LEN)
+        if range_size_bytes is None:
+            return
+        range_size = int.from_bytes(range_size_bytes, byteorder='big')
+        recvd_bytes = recv_exact(self.socket, range_size)
+        if recvd_bytes is None:
+            self.socket.close()
+            return
+
+        # A range may split a multi-byte character, so store raw bytes.
+        print("Received {} bytes. Creating file: {}".format(len(recvd_bytes), local_filename))
+        with open(f"{self.dir_name}/{local_filename}", 'wb') as f:
+            f.write(recvd_bytes)
+        return recvd_bytes
+
+    def get_file_any(self, remote_filename, local_filename=None):
+        # GET a file from the least busy server that has it, among the
+        # discovered servers and the one we are connected to. Servers
+        # that fail are skipped and the next one is tried.
+        if local_filename == None:
+            local_filename = remote_filename
+
+        servers = {(s.address[0], s.port) for s in self.discovery_client.get_services()
+                   if s.port is not None}
+        if self.server_address is not None:
+            servers.add(self.server_address)
+        holders = [a for a in servers if remote_filename in self.get_remote_names(a)]
+
+        tried = set()
+        while True:
+            address = self.pool.pick([a for a in holders if a not in tried])
+            if address is None:
+                print(Client.FILE_NOT_FOUND_MSG)
+                return None
+            tried.add(address)
+            # Opened outside the pooled connection, so that a local
+            # error is not taken for a server failure.
+            try:
+                f, temp_path = self.open_download()
+            except OSError as msg:
+                print(msg)
+                return None
+            file_size = None
+            try:
+                with f, self.pool.connection(address) as sock:
+                    file_size = self.request_file(sock, remote_filename, f)
+            except (OSError, ConnectionError) as msg:
+                print(f"GET from {address[0]}:{address[1]} failed: {msg}")
+                continue
+            finally:
+                stored = self.finish_download(temp_path, local_filename, file_size is not None)
+            if not stored:
+                return None
+
+            print("Received {} bytes from {}:{}. Creating file: {}"
+                  .format(file_size, address[0], address[1], local_filename))
+            return file_size
+
+    def get_remote_names(self, address):
+        # RLIST of a server, cached for RLIST_TTL seconds.
+        cached = self.remote_lists.get(address)
+        if cached is not None and time.monotonic() - cached[0] < Client.RLIST_TTL:
+            return cached[1]
+        try:
+            with self.pool.connection(address) as sock:
+                names = set(self.request_remote_list(sock).split("\n"))
+        except (OSError, ConnectionError):
+            return set()
+        self.remote_lists[address] = (time.monotonic(), names)
+        return names
+
+    def request_file(self, sock, remote_filename, f):
+        # GET over a pooled connection into the binary file f; returns
+        # the file size. Raises ConnectionError if the server hangs up
+        # (which it does for a missing file).
+        sock.sendall(CMD["GET"].to_bytes(CMD_FIELD_LEN, byteorder='big') + remote_filename.encode(MSG_ENCODING))
+        file_size_bytes = recv_exact(sock, FILE_SIZE_FIELD_LEN)
+        if file_size_bytes is None:
+            raise ConnectionError("connection closed by server")
+        file_size = int.from_bytes(file_size_bytes, byteorder='big')
+        if not recv_to_file(sock, f, file_size):
+            raise ConnectionError("connection closed by server")
+        return file_size
+
+    def request_remote_list(self, sock):
+        sock.sendall(CMD["RLIST"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+        list_size_bytes = recv_exact(sock, PACKET_SIZE_FIELD_LEN)
+        if list_size_bytes is None:
+            raise ConnectionError("connection closed by server")
+        list_bytes = recv_exact(sock, int.from_bytes(list_size_bytes, byteorder='big'))
+        if list_bytes is None:
+            raise ConnectionError("connection closed by server")
+        return list_bytes.decode(MSG_ENCODING)
+
     def put_file(self, local_filename, remote_filename=None):
         # Adapted from server get method
         if remote_filename == None:
             remote_filename = local_filename
         try:
-            with open(f"{Client.DIR_NAME}/{local_filename}", "r") as f:
+            with open(f"{self.dir_name}/{local_filename}", "rb") as f:
 
-                # Encode the file contents into bytes, record its size and
-                # generate the file size field used for transmission.
-                file_bytes = f.read().encode(MSG_ENCODING)
-                file_size_bytes = len(file_bytes)
-                file_size_field = file_size_bytes.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+                # Record the file size and generate the file size field
+                # used for transmission.
+                file_size = os.fstat(f.fileno()).st_size
+                file_size_field = make_size_field(file_size)
 
                 filename_field = remote_filename.ljust(FILE_NAME_FIELD_LEN).encode(MSG_ENCODING)
-                # Create the packet to be sent with the header field.
-                pkt = CMD["PUT"].to_bytes(CMD_FIELD_LEN, byteorder='big') + filename_field + file_size_field + file_bytes
-                
-                self.socket.sendall(pkt)
+                header = CMD["PUT"].to_bytes(CMD_FIELD_LEN, byteorder='big') + filename_field + file_size_field
+                send_with_file(self.socket, header, f, file_size)
 
-                return None
+                return True
             
         except FileNotFoundError:
             print(Client.FILE_NOT_FOUND_MSG)            
@@ -391,22 +829,123 @@ class Client:
         pkt = CMD["RLIST"].to_bytes(CMD_FIELD_LEN, byteorder='big')
         self.socket.sendall(pkt)
         list_size_bytes = self.socket_recv_size(PACKET_SIZE_FIELD_LEN)
-        list_size = int.from_bytes(list_size_bytes, byteorder='big')
-        if len(list_size_bytes) == 0:
-            self.socket.close()
+        if list_size_bytes is None:
             return
+        list_size = int.from_bytes(list_size_bytes, byteorder='big')
 
-        recvd_bytes = bytearray()
-        while(len(recvd_bytes) < list_size):
-            recvd_bytes += self.socket.recv(Client.RECV_SIZE)
+        recvd_bytes = self.socket_recv_size(list_size)
+        if recvd_bytes is None:
+            return
 
         recvdstring = recvd_bytes.decode(MSG_ENCODING)
         print(recvdstring)
+        return recvdstring
     
     def close_connection(self):
-        self.socket.close()
+        self.release_connection()
+        self.pool.close_all()
         print("Closed connection.")
             
+########################################################################
+# BATCH MODE
+#
+# Runs a script of client command lines (one per line, '#' starts a
+# comment) without prompting. Leading CONNECT lines set up every
+# worker; the remaining commands are shared out over `concurrency`
+# clients, each with its own connection. Every command is reported
+# with its time, and the exit status is non-zero if any command failed.
+########################################################################
+
+class BatchRunner:
+
+    def __init__(self, lines, concurrency=1, dir_name=Client.DIR_NAME, connect=None, report=None):
+        self.concurrency = max(1, concurrency)
+        self.dir_name = dir_name
+        self.report = report if report is not None else sys.stdout
+        self.report_lock = threading.Lock()
+
+        self.setup = []
+        if connect is not None:
+            self.setup.append(f"connect {connect[0]} {connect[1]}")
+        self.commands = []
+        for line in lines:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            if not self.commands and line.split()[0].upper() == "CONNECT":
+                self.setup.append(line)
+            else:
+                self.commands.append(line)
+
+        self.timings = []
+        self.failures = 0
+
+    def run(self):
+        queue = collections.deque(self.commands)
+        start = time.perf_counter()
+        workers = [threading.Thread(target=self.worker, args=(queue, )) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        self.print_summary(elapsed)
+        return 1 if self.failures else 0
+
+    def worker(self, queue):
+        client = Client(dir_name=self.dir_name, interactive=False)
+        try:
+            for line in self.setup:
+                if not self.run_line(client, line):
+                    # Without its connection this worker can't do
+                    # anything useful; leave the commands to the other
+                    # workers.
+                    return
+            while True:
+                try:
+                    line = queue.popleft()
+                except IndexError:
+                    break
+                parsed = client.parse_command(line)
+                # With several workers, BYE would only end one of them.
+                if parsed is not None and parsed[0] == CMD["BYE"] and self.concurrency > 1:
+                    continue
+                self.run_line(client, line)
+                if parsed is not None and parsed[0] == CMD["BYE"]:
+                    # BYE has closed the connection itself.
+                    client = None
+                    return
+        finally:
+            if client is not None:
+                client.close_connection()
+
+    def run_line(self, client, line):
+        start = time.perf_counter()
+        parsed = client.parse_command(line)
+        try:
+            result = client.execute_command(*parsed) if parsed is not None else None
+        except Exception as msg:
+            print(msg)
+            result = None
+        elapsed = time.perf_counter() - start
+
+        ok = result is not None and result is not False
+        with self.report_lock:
+            self.timings.append(elapsed)
+            if not ok:
+                self.failures += 1
+            print(f"{'OK' if ok else 'FAIL':<4} {elapsed * 1000:10.2f} ms  {line}", file=self.report)
+        return ok
+
+    def print_summary(self, elapsed):
+        timings = sorted(self.timings)
+        def pct(p):
+            return timings[min(len(timings) - 1, int(p / 100 * len(timings)))] * 1000 if timings else 0.0
+        print("-" * 72, file=self.report)
+        print(f"{len(timings)} commands, {self.failures} failed, {elapsed:.3f} s total, "
+              f"p50 {pct(50):.2f} ms, p95 {pct(95):.2f} ms, max {pct(100):.2f} ms", file=self.report)
+
 ########################################################################
 
 if __name__ == '__main__':
@@ -418,8 +957,63 @@ if __name__ == '__main__':
                         help='server or client role',
                         required=True, type=str)
 
+    parser.add_argument('-p', '--port',
+                        help='server file sharing port',
+                        default=Server.PORT, type=int)
+
+    parser.add_argument('-d', '--dir',
+                        help='shared (server) or local (client) directory',
+                        type=str)
+
+    parser.add_argument('--no-discovery',
+                        help='do not start the service discovery server',
+                        action='store_true')
+
+    parser.add_argument('--mmap-get',
+                        help='serve GETs of large files from shared mmaps',
+                        action='store_true')
+
+    parser.add_argument('--high-rate-discovery',
+                        help='use the batched, rate limited discovery responder',
+                        action='store_true')
+
+    parser.add_argument('-b', '--batch',
+                        help="client: run commands from this script ('-' for stdin) instead of prompting",
+                        type=str)
+
+    parser.add_argument('-c', '--concurrency',
+                        help='client batch mode: number of parallel connections',
+                        default=1, type=int)
+
+    parser.add_argument('--connect',
+                        help='client batch mode: server to connect to first, as ip:port',
+                        type=str)
+
+    parser.add_argument('-q', '--quiet',
+                        help='client batch mode: only print the per command report',
+                        action='store_true')
+
     args = parser.parse_args()
-    roles[args.role]()
+    if args.role == 'client' and args.batch:
+        connect = None
+        if args.connect:
+            ip, port = args.connect.rsplit(":", 1)
+            connect = (ip, int(port))
+        report = sys.stdout
+        with (contextlib.nullcontext(sys.stdin) if args.batch == '-' else open(args.batch)) as lines:
+            runner = BatchRunner(lines, args.concurrency, args.dir or Client.DIR_NAME, connect, report)
+            if args.quiet:
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    status = runner.run()
+            else:
+                status = runner.run()
+        sys.exit(status)
+    elif args.role == 'server':
+        Server(port=args.port, dir_name=args.dir or Server.DIR_NAME,
+               discovery=not args.no_discovery, mmap_get=args.mmap_get,
+               discovery_high_rate=args.high_rate_discovery)
+    else:
+        Client(dir_name=args.dir or Client.DIR_NAME)
 
 ########################################################################
 
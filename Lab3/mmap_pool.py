@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Shared pool of read-only file mappings for the Lab3 server.
+#
+# A file is mapped once and the mapping is shared by every connection
+# reading it; requests are served by slicing a memoryview of the map,
+# so no per-request copy of the file is made. The pool holds at most
+# MAX_MAPS mappings and closes mappings that nobody is using once they
+# have been idle for IDLE_TIMEOUT seconds, or sooner (least recently
+# used first) when the pool is full. A mapping whose file has changed
+# on disk (new inode, size or mtime) is replaced on the next request.
+#
+# Mappings are kept in least recently used order, so eviction only
+# looks at the head of the pool. Besides on every request, it runs
+# every SWEEP_INTERVAL seconds on a thread of its own, so mappings (and
+# their file descriptors) are released when requests stop.
+#
+########################################################################
+
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+########################################################################
+
+class MappedFile:
+
+    def __init__(self, path, st):
+        self.path = path
+        self.key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.stale = False
+        # Zero length files cannot be mapped.
+        self.map = None
+        if self.size > 0:
+            with open(path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+class MapPool:
+
+    MAX_MAPS = 32
+    IDLE_TIMEOUT = 60
+    SWEEP_INTERVAL = 10
+
+    def __init__(self, max_maps=MAX_MAPS, idle_timeout=IDLE_TIMEOUT, sweep_interval=SWEEP_INTERVAL):
+        self.max_maps = max_maps
+        self.idle_timeout = idle_timeout
+        self.maps = OrderedDict() # path -> MappedFile, least recently used first
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.maps_opened = 0
+        self.maps_closed = 0
+
+        # A sweep_interval of 0 leaves eviction to acquire().
+        self.stop_sweeping = threading.Event()
+        if sweep_interval:
+            sweeper = threading.Thread(target=self.sweep_forever, args=(sweep_interval, ))
+            sweeper.daemon = True
+            sweeper.start()
+
+    @contextmanager
+    def view(self, path, offset=0, length=None):
+        # Yields (memoryview, file size) for the requested byte range,
+        # clamped to the end of the file. Raises FileNotFoundError if
+        # the file does not exist.
+        mapped = self.acquire(path)
+        views = []
+        try:
+            start = min(offset, mapped.size)
+            end = mapped.size if length is None else min(start + length, mapped.size)
+            if mapped.map is None:
+                views.append(memoryview(b""))
+            else:
+                views.append(memoryview(mapped.map))
+                views.append(views[0][start:end])
+            yield views[-1], mapped.size
+        finally:
+            # Views must be released before the map can be closed.
+            for mv in reversed(views):
+                mv.release()
+            self.release(mapped)
+
+    def acquire(self, path):
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            mapped = self.maps.get(path)
+            if mapped is not None and mapped.key != key:
+                self.discard(path, mapped)
+                mapped = None
+            if mapped is None:
+                mapped = MappedFile(path, st)
+                self.maps[path] = mapped
+                self.maps_opened += 1
+            else:
+                self.hits += 1
+            self.maps.move_to_end(path)
+            mapped.users += 1
+            mapped.last_used = time.monotonic()
+            self.evict_idle()
+            return mapped
+
+    def release(self, mapped):
+        with self.lock:
+            mapped.users -= 1
+            mapped.last_used = time.monotonic()
+            if mapped.stale:
+                if mapped.users == 0:
+                    mapped.close()
+                    self.maps_closed += 1
+            else:
+                self.maps.move_to_end(mapped.path)
+
+    def discard(self, path, mapped):
+        # Caller must hold self.lock. A mapping still in use is closed
+        # by the last release().
+        del self.maps[path]
+        mapped.stale = True
+        if mapped.users == 0:
+            mapped.close()
+            self.maps_closed += 1
+
+    def evict_idle(self):
+        # Caller must hold self.lock. Walks from the least recently used
+        # end and stops at the first unused mapping that is to be kept;
+        # only mappings in use are passed over.
+        now = time.monotonic()
+        over = len(self.maps) - self.max_maps
+        evict = []
+        for path, mapped in self.maps.items():
+            if mapped.users:
+                continue
+            if over > 0:
+                over -= 1
+            elif now - mapped.last_used <= self.idle_timeout:
+                break
+            evict.append((path, mapped))
+        for path, mapped in evict:
+            self.discard(path, mapped)
+
+    def sweep_forever(self, interval):
+        while not self.stop_sweeping.wait(interval):
+            with self.lock:
+                self.evict_idle()
+
+    def close(self):
+        # Stop the sweeper and close every mapping; those in use are
+        # closed by their last release().
+        self.stop_sweeping.set()
+        with self.lock:
+            for path, mapped in list(self.maps.items()):
+                self.discard(path, mapped)
+
+    def invalidate(self, path):
+        with self.lock:
+            mapped = self.maps.get(path)
+            if mapped is not None:
+                self.discard(path, mapped)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "maps": len(self.maps),
+                "hits": self.hits,
+                "opened": self.maps_opened,
+                "closed": self.maps_closed,
+            }
+
+########################################################################
@@ -7,12 +7,29 @@ import argparse
 import sys
 import time
 import datetime
+import json
+import selectors
 
 ########################################################################
 # Service Discovery Server
 #
 # The server listens on a UDP socket. When a service discovery packet
 # arrives, it returns a response with the name of the service.
+#
+# When the server knows which TCP port its service is on, the response
+# is a JSON object describing the service instead:
+#
+#   {"name": ..., "version": PROTOCOL_VERSION, "port": <TCP port>,
+#    "capacity": <max clients>, "load": <current clients>}
+#
+# Clients that only expect a name can still print it as is.
+#
+# The high rate responder (high_rate=True) is meant for broadcast
+# storms from many scanning clients: it drains the socket in batches
+# without blocking, matches the raw bytes against SCAN_CMD_ENCODED
+# instead of decoding and printing every packet, answers each source
+# IP at most RATE_LIMIT times per second (with bursts of RATE_BURST)
+# and prints served/dropped counters every STATS_INTERVAL seconds.
 # 
 ########################################################################
 
@@ -33,9 +50,52 @@ class Server:
     RECV_SIZE = 1024
     BACKLOG = 10
 
-    def __init__(self):
+    PROTOCOL_VERSION = 1
+
+    # High rate responder settings.
+    BATCH_SIZE = 256
+    SELECT_TIMEOUT = 0.5
+    RATE_LIMIT = 10 # replies per second per source IP
+    RATE_BURST = 20
+    RATE_TABLE_MAX = 10000
+    ANNOUNCEMENT_REFRESH = 1.0
+    STATS_INTERVAL = 10
+
+    def __init__(self, service_port=None, capacity=None, load=None,
+                 port=SERVICE_SCAN_PORT, high_rate=False, serve=True):
+        # load is a callable returning the current number of clients,
+        # since it changes between scans.
+        self.service_port = service_port
+        self.capacity = capacity
+        self.load = load
+        self.port = port
+        self.running = True
+
+        # Responder counters.
+        self.served = 0
+        self.dropped = 0
+        self.ignored = 0
+
+        # Source IP -> [tokens, time of last refill].
+        self.rate_table = {}
+
         self.create_socket()
-        self.receive_forever()
+        if serve:
+            if high_rate:
+                self.receive_forever_high_rate()
+            else:
+                self.receive_forever()
+
+    def get_announcement(self):
+        if self.service_port is None:
+            return Server.MSG_ENCODED
+        return json.dumps({
+            "name": Server.MSG,
+            "version": Server.PROTOCOL_VERSION,
+            "port": self.service_port,
+            "capacity": self.capacity,
+            "load": self.load() if self.load is not None else None,
+        }).encode(Server.MSG_ENCODING)
 
     def create_socket(self):
         try:
@@ -46,13 +106,13 @@ class Server:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
             # Bind socket to socket address, i.e., IP address and port.
-            self.socket.bind( (Server.ALL_IF_ADDRESS, Server.SERVICE_SCAN_PORT) )
+            self.socket.bind( (Server.ALL_IF_ADDRESS, self.port) )
         except Exception as msg:
             print(msg)
             sys.exit(1)
 
     def receive_forever(self):
-        print(Server.MSG, "listening for service discovery messages on the SDP port {} ...".format(Server.SERVICE_SCAN_PORT))
+        print(Server.MSG, "listening for service discovery messages on the SDP port {} ...".format(self.port))
         while True:
             try:
                 recvd_bytes, address = self.socket.recvfrom(Server.RECV_SIZE)
@@ -67,17 +127,109 @@ class Server:
                 if Server.SCAN_CMD in recvd_str:
                     # Send the service advertisement message back to
                     # the client.
-                    self.socket.sendto(Server.MSG_ENCODED, address)
+                    self.socket.sendto(self.get_announcement(), address)
+                    self.served += 1
             except KeyboardInterrupt:
                 print()
                 sys.exit(1)
 
+    def receive_forever_high_rate(self):
+        print(Server.MSG, "listening (high rate) for service discovery messages on the SDP port {} ...".format(self.port))
+        self.socket.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+
+        announcement = self.get_announcement()
+        announcement_time = time.monotonic()
+        stats_time = announcement_time
+        try:
+            while self.running:
+                if not selector.select(Server.SELECT_TIMEOUT):
+                    continue
+                now = time.monotonic()
+
+                # The announcement carries the current load, so rebuild
+                # it now and then rather than for every reply.
+                if now - announcement_time > Server.ANNOUNCEMENT_REFRESH:
+                    announcement = self.get_announcement()
+                    announcement_time = now
+
+                self.drain_batch(announcement, now)
+
+                if now - stats_time > Server.STATS_INTERVAL:
+                    print(f"Discovery: served {self.served}, dropped {self.dropped}, ignored {self.ignored}")
+                    stats_time = now
+        except KeyboardInterrupt:
+            print()
+            sys.exit(1)
+        finally:
+            selector.close()
+            self.socket.close()
+
+    def drain_batch(self, announcement, now):
+        # Handle up to BATCH_SIZE queued datagrams without blocking.
+        for _ in range(Server.BATCH_SIZE):
+            try:
+                recvd_bytes, address = self.socket.recvfrom(Server.RECV_SIZE)
+            except BlockingIOError:
+                return
+            except OSError:
+                # e.g. ICMP port unreachable from an earlier reply.
+                continue
+
+            if Server.SCAN_CMD_ENCODED not in recvd_bytes:
+                self.ignored += 1
+            elif not self.allow_reply(address[0], now):
+                self.dropped += 1
+            else:
+                try:
+                    self.socket.sendto(announcement, address)
+                    self.served += 1
+                except BlockingIOError:
+                    self.dropped += 1
+
+    def allow_reply(self, ip, now):
+        # Token bucket per source IP.
+        bucket = self.rate_table.get(ip)
+        if bucket is None:
+            if len(self.rate_table) >= Server.RATE_TABLE_MAX:
+                self.prune_rate_table(now)
+            bucket = self.rate_table[ip] = [Server.RATE_BURST, now]
+        else:
+            bucket[0] = min(Server.RATE_BURST, bucket[0] + (now - bucket[1]) * Server.RATE_LIMIT)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def prune_rate_table(self, now):
+        # Forget sources whose buckets would have refilled completely.
+        refill_time = Server.RATE_BURST / Server.RATE_LIMIT
+        for ip in [ip for ip, b in self.rate_table.items() if now - b[1] > refill_time]:
+            del self.rate_table[ip]
+        if len(self.rate_table) >= Server.RATE_TABLE_MAX:
+            self.rate_table.clear()
+
+    def stats(self):
+        return {"served": self.served, "dropped": self.dropped, "ignored": self.ignored}
+
+    def shutdown(self):
+        self.running = False
+
 ########################################################################
 # Process command line arguments if run directly.
 ########################################################################
 
 if __name__ == '__main__':
-    Server()
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--high-rate',
+                        help='batched, rate limited responder without per packet output',
+                        action='store_true')
+
+    args = parser.parse_args()
+    Server(high_rate=args.high_rate)
 
 ########################################################################
 
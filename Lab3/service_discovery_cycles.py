@@ -7,6 +7,8 @@ import argparse
 import sys
 import time
 import datetime
+import threading
+import json
 
 ########################################################################
 # Service Discovery
@@ -16,9 +18,60 @@ import datetime
 # to receive responses until a socket timeout occurs, indicating that
 # no more responses are available. This scan process is repeated a
 # fixed number of times. The discovered services are then output.
+#
+# In adaptive mode (the default) a cycle waits up to SCAN_TIMEOUT for
+# the first response but only QUIET_TIMEOUT after each later one, and
+# no further cycles are sent once a cycle turns up nothing new. That
+# includes a first cycle that gets no response at all, so a scan with
+# no servers about takes SCAN_TIMEOUT rather than every cycle's. A
+# background scan can also keep a live table of services up to date
+# so that it can be queried without waiting for a scan.
+#
+# Responses are cached per server address for CACHE_TTL seconds.
+# Servers that announce JSON metadata (see service_announcement.py)
+# report their TCP port and load, which best_service uses to choose a
+# server without broadcasting again while the cache is fresh.
 # 
 ########################################################################
 
+########################################################################
+# Discovered service
+########################################################################
+
+class ServiceInfo:
+
+    def __init__(self, msg, address, last_seen):
+        self.address = address
+        self.last_seen = last_seen
+        self.name = msg
+        self.version = None
+        self.port = None
+        self.capacity = None
+        self.load = None
+
+        # Older servers answer with just the service name.
+        try:
+            meta = json.loads(msg)
+        except ValueError:
+            return
+        if isinstance(meta, dict):
+            self.name = meta.get("name", msg)
+            self.version = meta.get("version")
+            self.port = meta.get("port")
+            self.capacity = meta.get("capacity")
+            self.load = meta.get("load")
+
+    def load_fraction(self):
+        if not self.capacity or self.load is None:
+            return 0.0
+        return self.load / self.capacity
+
+    def __str__(self):
+        if self.port is None:
+            return f"{self.name} found at IP address/port {self.address}"
+        return (f"{self.name} found at IP address/port {self.address}, "
+                f"file sharing port {self.port}, load {self.load}/{self.capacity}")
+
 ########################################################################
 # Service Discovery Client
 ########################################################################
@@ -35,71 +88,164 @@ class Client:
 
     SCAN_CYCLES = 3
     SCAN_TIMEOUT = 5
+    QUIET_TIMEOUT = 0.25
+    BACKGROUND_SCAN_INTERVAL = 10
+    CACHE_TTL = 30
 
     SCAN_CMD = "SCAN"
     SCAN_CMD_ENCODED = SCAN_CMD.encode(MSG_ENCODING)
 
-    def __init__(self):
-        self.get_socket()
+    def __init__(self, scan_cycles=SCAN_CYCLES, scan_timeout=SCAN_TIMEOUT,
+                 quiet_timeout=QUIET_TIMEOUT, adaptive=True,
+                 address_port=ADDRESS_PORT, cache_ttl=CACHE_TTL):
+        self.cache_ttl = cache_ttl
+        self.scan_cycles = scan_cycles
+        self.scan_timeout = scan_timeout
+        self.quiet_timeout = quiet_timeout
+        self.adaptive = adaptive
+        self.address_port = address_port
+
+        # Cached services, kept up to date by scans: address -> ServiceInfo.
+        self.services = {}
+        self.services_lock = threading.Lock()
+        self.background_thread = None
+        self.background_stop = threading.Event()
+        # Set once the background scan has finished its first round.
+        self.background_scanned = threading.Event()
+
+        self.socket = self.get_socket()
 
     def get_socket(self):
         try:
             # Service discovery done using UDP packets.
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
             # Arrange to send a broadcast service discovery packet.
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
             # Set the socket for a socket.timeout if a scanning recv
             # fails.
-            self.socket.settimeout(Client.SCAN_TIMEOUT)
+            sock.settimeout(self.scan_timeout)
+            return sock
         except Exception as msg:
             print(msg)
             sys.exit(1)
 
-    def scan_for_service(self):
-        # Collect our scan results in a list.
-        scan_results = []
+    def scan_for_service(self, verbose=True):
+        scan_results = self.scan(self.socket, verbose)
+        self.update_services(scan_results)
+
+        # Output all of our scan results, if any.
+        if verbose:
+            if scan_results:
+                for msg, address in scan_results:
+                    print(ServiceInfo(msg, address, None))
+            else:
+                print("No services found.")
+        return scan_results
+
+    def scan(self, sock, verbose=False):
+        # Collect our scan results keyed by responder; a list lookup
+        # per response is quadratic in the number of responders. The
+        # latest reply wins since announcements carry the current load.
+        scan_results = {}
 
-        # Repeat the scan procedure a preset number of times.
-        for i in range(Client.SCAN_CYCLES):
+        # Repeat the scan procedure up to a preset number of times.
+        for i in range(self.scan_cycles):
+            found_before = len(scan_results)
 
             # Send a service discovery broadcast.
-            print("Sending broadcast scan {}".format(i))            
-            self.socket.sendto(Client.SCAN_CMD_ENCODED, Client.ADDRESS_PORT)
-        
+            if verbose:
+                print("Sending broadcast scan {}".format(i))            
+            sock.sendto(Client.SCAN_CMD_ENCODED, self.address_port)
+
+            timeout = self.scan_timeout
             while True:
                 # Listen for service responses. So long as we keep
                 # receiving responses, keep going. Timeout if none are
                 # received and terminate the listening for this scan
                 # cycle.
                 try:
-                    recvd_bytes, address = self.socket.recvfrom(Client.RECV_SIZE)
-                    recvd_msg = recvd_bytes.decode(Client.MSG_ENCODING)
-
-                    # Record only unique services that are found.
-                    if (recvd_msg, address) not in scan_results:
-                        scan_results.append((recvd_msg, address))
-                        continue
+                    sock.settimeout(timeout)
+                    recvd_bytes, address = sock.recvfrom(Client.RECV_SIZE)
+                    scan_results[address] = recvd_bytes.decode(Client.MSG_ENCODING)
+                    # Once servers have started answering, a short
+                    # quiet period means they are all done.
+                    if self.adaptive:
+                        timeout = self.quiet_timeout
                 # If we timeout listening for a new response, we are
                 # finished.
                 except socket.timeout:
                     break
 
-        # Output all of our scan results, if any.
-        if scan_results:
-            for result in scan_results:
-                print(f"{result[0]} found at IP address/port {result[1]}")
-        else:
-            print("No services found.")
+            # Another broadcast is only worthwhile while it keeps
+            # turning up new services.
+            if self.adaptive and len(scan_results) == found_before:
+                break
+
+        return sorted((msg, address) for address, msg in scan_results.items())
+
+    def update_services(self, scan_results):
+        now = time.monotonic()
+        with self.services_lock:
+            for msg, address in scan_results:
+                self.services[address] = ServiceInfo(msg, address, now)
+
+    def get_services(self):
+        # Unexpired cached services; never waits on a scan.
+        now = time.monotonic()
+        with self.services_lock:
+            for address in [a for a, s in self.services.items()
+                            if now - s.last_seen > self.cache_ttl]:
+                del self.services[address]
+            return sorted(self.services.values(), key=lambda s: s.address)
+
+    def best_service(self):
+        # Least loaded service advertising a file sharing port. Only
+        # scans when the cache holds no such service.
+        candidates = [s for s in self.get_services() if s.port is not None]
+        if not candidates:
+            self.scan_for_service(verbose=False)
+            candidates = [s for s in self.get_services() if s.port is not None]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda s: s.load_fraction())
+
+    def start_background_scan(self, interval=BACKGROUND_SCAN_INTERVAL):
+        if self.background_thread is not None and self.background_thread.is_alive():
+            return
+        self.background_stop.clear()
+        self.background_scanned.clear()
+        self.background_thread = threading.Thread(target=self.background_scan, args=(interval, ))
+        self.background_thread.daemon = True
+        self.background_thread.start()
+
+    def stop_background_scan(self):
+        self.background_stop.set()
+
+    def wait_for_background_scan(self, timeout=BACKGROUND_SCAN_INTERVAL):
+        # Wait until the background scan's first round is in the table;
+        # returns at once after that. False if it timed out.
+        return self.background_scanned.wait(timeout)
+
+    def background_scan(self, interval):
+        # Use a separate socket so foreground scans don't steal replies.
+        sock = self.get_socket()
+        try:
+            while not self.background_stop.is_set():
+                self.update_services(self.scan(sock))
+                self.background_scanned.set()
+                self.background_stop.wait(interval)
+        finally:
+            sock.close()
                 
 ########################################################################
 # Fire up a client if run directly.
 ########################################################################
 
 if __name__ == '__main__':
-    Client()
+    Client().scan_for_service()
 
 ########################################################################
 
@@ -0,0 +1,76 @@
+########################################################################
+#
+# Multicast group allocator for CRDS rooms.
+#
+# The pool is a block of multicast addresses (239.1.0.0/16 by default).
+# Address i of the block is room id i. Ids are handed out in order
+# through next_room_id; deleted rooms push their id on a free list,
+# which is used first. A bytearray records which ids are in use, so an
+# id marked used some other way (a room recovered from the journal) is
+# skipped when it turns up. Allocating and freeing are O(1), amortised
+# over those skips.
+#
+# Not thread safe; the server calls it under its allocation lock.
+#
+########################################################################
+
+import ipaddress
+
+class AddressPool:
+
+    NETWORK = "239.1.0.0/16"
+
+    def __init__(self, network=NETWORK):
+        self.network = ipaddress.IPv4Network(network)
+        if not self.network.is_multicast:
+            raise ValueError(f"{network} is not a multicast network")
+        self.base = int(self.network.network_address)
+        self.size = self.network.num_addresses
+        self.in_use = bytearray(self.size)
+        self.free_ids = []
+        self.next_room_id = 0
+        self.allocated = 0
+
+    def room_id(self, ip):
+        # The id of ip, or None if ip is not in the pool.
+        try:
+            room_id = int(ipaddress.IPv4Address(ip)) - self.base
+        except ValueError:
+            return None
+        return room_id if 0 <= room_id < self.size else None
+
+    def allocate(self):
+        # Returns a free address, or None if the pool is exhausted.
+        while self.free_ids:
+            room_id = self.free_ids.pop()
+            if not self.in_use[room_id]:
+                return self.take(room_id)
+        while self.next_room_id < self.size:
+            room_id = self.next_room_id
+            self.next_room_id += 1
+            if not self.in_use[room_id]:
+                return self.take(room_id)
+        return None
+
+    def take(self, room_id):
+        self.in_use[room_id] = 1
+        self.allocated += 1
+        return str(ipaddress.IPv4Address(self.base + room_id))
+
+    def reserve(self, ip):
+        # Mark ip used without allocating it. False if it already was.
+        room_id = self.room_id(ip)
+        if room_id is None or self.in_use[room_id]:
+            return False
+        self.take(room_id)
+        return True
+
+    def free(self, ip):
+        room_id = self.room_id(ip)
+        if room_id is None or not self.in_use[room_id]:
+            return
+        self.in_use[room_id] = 0
+        self.allocated -= 1
+        self.free_ids.append(room_id)
+
+########################################################################
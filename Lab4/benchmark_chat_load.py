@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Multicast chat load generator and latency benchmark.
+#
+# --senders sender processes each send --rate messages per second of
+# --payload bytes to one chat room on loopback multicast for --seconds,
+# with ChatSender, as the client does. --receivers receiver processes
+# are in the room through ChatRooms, so their messages go through the
+# client's receive loop and formatting (to /dev/null). Each message's
+# latency is its arrival time less the send timestamp in its header.
+#
+# The JSON report gives, per receiver and over all receivers, the
+# end-to-end latency percentiles in microseconds, the loss rate, and
+# the receiver's process CPU time per message.
+#
+#   python benchmark_chat_load.py --senders 4 --receivers 4 --rate 2000
+#
+########################################################################
+
+import argparse
+import array
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+from main import Client, RX_IFACE_ADDRESS
+import chat_protocol
+from chat_protocol import ChatSender
+from chat_receiver import ChatReceiver
+from chat_rooms import ChatRoom, ChatRooms
+
+########################################################################
+
+GROUP = "239.1.255.4"
+PORT = 41004
+TICK = 0.001
+SETTLE = 0.3
+PERCENTILES = (50, 90, 99, 99.9)
+
+class LatencyReceiver(ChatReceiver):
+
+    # A room's ChatReceiver that also records each message's latency.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = array.array("q")
+
+    def handle(self, data, lines):
+        now = time.time_ns() // 1000
+        try:
+            name, seq, timestamp, msg = chat_protocol.parse(data)
+        except ValueError:
+            timestamp = None
+        if timestamp is not None:
+            self.latencies.append(now - timestamp)
+        super().handle(data, lines)
+
+class LatencyRooms(ChatRooms):
+
+    def make_room(self, name, group, port, sock):
+        return ChatRoom(name, group, port, None,
+                        LatencyReceiver(sock, self.username, name, out=self.out, output_lock=self.output_lock))
+
+def sender(index, args, start, results):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, Client.TTL)
+    chat_sender = ChatSender(f"sender{index}")
+    msg = b"x" * args.payload
+    address = (args.group, args.port)
+    total = int(args.rate * args.seconds)
+    sent = 0
+    start.wait()
+    begin = time.perf_counter()
+    while sent < total:
+        # Send whatever is due so far, then wait for the next tick.
+        due = min(int((time.perf_counter() - begin) * args.rate), total)
+        while sent < due:
+            chat_sender.send(sock, msg, address)
+            sent += 1
+        time.sleep(TICK)
+    sock.close()
+    results.put(("sender", index, sent))
+
+def receiver(index, args, ready, stop, results):
+    out = open(os.devnull, "w")
+    rooms = LatencyRooms(f"receiver{index}", RX_IFACE_ADDRESS, Client.TTL, out=out)
+    room = rooms.join("load", args.group, args.port)
+    ready.release()
+    cpu = time.process_time()
+    stop.wait()
+    cpu = time.process_time() - cpu
+    rooms.close()
+    out.close()
+    receiver = room.receiver
+    results.put(("receiver", index, {
+        "received": receiver.received,
+        "lost": receiver.lost,
+        "out_of_order": receiver.out_of_order,
+        "cpu_seconds": cpu,
+        "latencies": receiver.latencies.tobytes(),
+    }))
+
+def percentiles(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    summary = {f"p{p:g}": latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+               for p in PERCENTILES}
+    summary["max"] = latencies[-1]
+    summary["mean"] = sum(latencies) / len(latencies)
+    return summary
+
+def run(args):
+    ready = multiprocessing.Semaphore(0)
+    start = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    receivers = [multiprocessing.Process(target=receiver, args=(i, args, ready, stop, results))
+                 for i in range(args.receivers)]
+    senders = [multiprocessing.Process(target=sender, args=(i, args, start, results))
+               for i in range(args.senders)]
+    for process in receivers + senders:
+        process.start()
+    for _ in receivers:
+        ready.acquire()
+    start.set()
+    for process in senders:
+        process.join()
+    time.sleep(SETTLE)
+    stop.set()
+
+    sent = 0
+    received = {}
+    for _ in range(len(senders) + len(receivers)):
+        role, index, result = results.get()
+        if role == "sender":
+            sent += result
+        else:
+            received[index] = result
+    for process in receivers:
+        process.join()
+
+    report = []
+    all_latencies = array.array("q")
+    for index in sorted(received):
+        result = received[index]
+        latencies = array.array("q")
+        latencies.frombytes(result["latencies"])
+        all_latencies.extend(latencies)
+        report.append({
+            "receiver": index,
+            "received": result["received"],
+            "loss_rate": 1 - result["received"] / sent if sent else None,
+            "seq_lost": result["lost"],
+            "out_of_order": result["out_of_order"],
+            "cpu_seconds": result["cpu_seconds"],
+            "cpu_us_per_message": result["cpu_seconds"] / result["received"] * 1e6 if result["received"] else None,
+            "latency_us": percentiles(latencies),
+        })
+    return {
+        "senders": args.senders,
+        "receivers": args.receivers,
+        "rate_per_sender": args.rate,
+        "seconds": args.seconds,
+        "payload": args.payload,
+        "sent": sent,
+        "loss_rate": 1 - sum(r["received"] for r in report) / (sent * len(report)) if sent and report else None,
+        "latency_us": percentiles(all_latencies),
+        "per_receiver": report,
+    }
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Multicast chat load generator and latency benchmark")
+    parser.add_argument('--senders', default=4, type=int)
+    parser.add_argument('--receivers', default=4, type=int)
+    parser.add_argument('--rate', default=1000, type=int, help='messages per second per sender')
+    parser.add_argument('--seconds', default=5.0, type=float)
+    parser.add_argument('--payload', default=64, type=int, help='message text bytes')
+    parser.add_argument('--group', default=GROUP)
+    parser.add_argument('--port', default=PORT, type=int)
+    args = parser.parse_args()
+    print(json.dumps(run(args), indent=2))
+
+########################################################################
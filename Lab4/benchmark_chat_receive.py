@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Chat receive loop under a multicast flood.
+#
+# A sender process floods a chat room at --rate messages per second for
+# --seconds while a receiver thread in this process reads the room,
+# once with the original blocking loop (recvfrom, decode and print with
+# the lock taken per message) and once with ChatReceiver, each fed the
+# datagram format its client sends (the padded name field, or the
+# chat_protocol header). Output goes to /dev/null. The JSON report
+# gives, for each loop, the datagram size, how many messages arrived
+# (and for ChatReceiver, how many its sequence numbers say were lost),
+# the receiver thread's CPU time per message, and how long the loop
+# took to stop once told to (the blocking loop only notices its flag on
+# the next packet, so after the flood it does not stop at all).
+#
+#   python benchmark_chat_receive.py --rate 50000 --seconds 5
+#
+########################################################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from main import Client, ENCODING, RX_IFACE_ADDRESS
+from chat_receiver import ChatReceiver
+from chat_protocol import ChatSender, LEGACY_NAME_FIELD_LEN
+
+########################################################################
+
+GROUP = "239.1.255.1"
+PORT = 40999
+STOP_TIMEOUT = 1.0
+TICK = 0.001
+
+def flood(rate, seconds, payload_size, group, port, legacy):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, Client.TTL)
+    msg = b"x" * payload_size
+    if legacy:
+        pkt = "flooder".ljust(LEGACY_NAME_FIELD_LEN).encode(ENCODING) + msg
+        send = lambda: sock.sendto(pkt, address)
+    else:
+        sender = ChatSender("flooder")
+        send = lambda: sender.send(sock, msg, address)
+    address = (group, port)
+    sent = 0
+    start = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            break
+        # Send whatever is due so far, then wait for the next tick.
+        due = min(int(elapsed * rate), int(seconds * rate))
+        while sent < due:
+            send()
+            sent += 1
+        time.sleep(TICK)
+    sock.close()
+
+def receive_socket(group, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    sock.bind((Client.RECV_ADDRESS, port))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    socket.inet_aton(group) + socket.inet_aton(RX_IFACE_ADDRESS))
+    return sock
+
+def blocking_loop(sock, out, output_lock, run_flag, counts):
+    # The loop ChatReceiver replaced.
+    username = "bench"
+    while run_flag.is_set():
+        try:
+            data, address_port = sock.recvfrom(Client.RECV_SIZE)
+        except OSError:
+            break
+        counts["received"] += 1
+        data_str = data.decode(ENCODING)
+        author = data_str[:LEGACY_NAME_FIELD_LEN].rstrip()
+        if (author != username):
+            msg = data_str[LEGACY_NAME_FIELD_LEN:]
+            output_lock.acquire()
+            print(f"[{author}|room]: {msg}", file=out)
+            output_lock.release()
+
+def run_loop(name, args):
+    sock = receive_socket(args.group, args.port)
+    out = open(os.devnull, "w")
+    output_lock = threading.Lock()
+    run_flag = threading.Event()
+    run_flag.set()
+    counts = {"received": 0}
+    cpu = {}
+
+    if name == "chat_receiver":
+        receiver = ChatReceiver(sock, "bench", "room", out=out, output_lock=output_lock)
+        loop = lambda: receiver.run(run_flag)
+    else:
+        loop = lambda: blocking_loop(sock, out, output_lock, run_flag, counts)
+
+    def timed():
+        start = time.thread_time()
+        loop()
+        cpu["seconds"] = time.thread_time() - start
+
+    thread = threading.Thread(target=timed, daemon=True)
+    thread.start()
+    legacy = name != "chat_receiver"
+    sender = multiprocessing.Process(target=flood,
+                                     args=(args.rate, args.seconds, args.payload, args.group, args.port, legacy))
+    sender.start()
+    sender.join()
+    # Let the last datagrams arrive, then ask the loop to stop.
+    time.sleep(0.2)
+    stop = time.perf_counter()
+    run_flag.clear()
+    thread.join(STOP_TIMEOUT)
+    stopped = not thread.is_alive()
+    stop_ms = (time.perf_counter() - stop) * 1000 if stopped else None
+    if not stopped:
+        # Unblock it so it can be measured.
+        sock.sendto(b"", (args.group, args.port))
+        thread.join()
+    sock.close()
+    out.close()
+
+    received = receiver.received if name == "chat_receiver" else counts["received"]
+    expected = int(args.rate * args.seconds)
+    if legacy:
+        datagram_bytes = LEGACY_NAME_FIELD_LEN + args.payload
+    else:
+        datagram_bytes = len(ChatSender("flooder").build(b"x" * args.payload))
+    return {
+        "loop": name,
+        "datagram_bytes": datagram_bytes,
+        "sent": expected,
+        "received": received,
+        "loss_rate": 1 - received / expected if expected else None,
+        "seq_lost": receiver.lost if name == "chat_receiver" else None,
+        "receiver_cpu_seconds": cpu["seconds"],
+        "cpu_us_per_message": cpu["seconds"] / received * 1e6 if received else None,
+        "batches": receiver.batches if name == "chat_receiver" else None,
+        "stop_ms": stop_ms,
+    }
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chat receive loop multicast flood benchmark")
+    parser.add_argument('--rate', default=50000, type=int, help='messages per second')
+    parser.add_argument('--seconds', default=5.0, type=float)
+    parser.add_argument('--payload', default=32, type=int, help='message text bytes')
+    parser.add_argument('--group', default=GROUP)
+    parser.add_argument('--port', default=PORT, type=int)
+    args = parser.parse_args()
+
+    results = [run_loop(name, args) for name in ("blocking", "chat_receiver")]
+    print(json.dumps({"rate": args.rate, "seconds": args.seconds, "results": results}, indent=2))
+
+########################################################################
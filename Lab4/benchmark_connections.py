@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Idle connection cost and getdir latency of the CRDS serving modes.
+#
+# For each serving mode a directory server is started as a subprocess
+# (so its memory can be read from /proc), preloaded with some rooms,
+# and then N idle client connections are opened. The report (JSON)
+# gives the server's resident memory and thread count before and after,
+# and getdir round trip latency percentiles measured from a few extra
+# connections, opened after the idle ones and while they are held open,
+# e.g.
+#
+#   python benchmark_connections.py --modes select,pool,thread --connections 10000
+#
+# Linux only, because of /proc.
+#
+########################################################################
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from main import Server, CMD, CMD_FIELD_LEN, ENCODING, raise_fd_limit
+
+########################################################################
+
+STARTUP_TIMEOUT = 10
+SETTLE_TIME = 1.0
+LATENCY_TIMEOUT = 2.0
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((Server.HOSTNAME, 0))
+        return s.getsockname()[1]
+
+def proc_status(pid):
+    # VmRSS (kB) and Threads from /proc/<pid>/status.
+    status = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "Threads"):
+                status[key] = int(value.split()[0])
+    return status
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+def connect(port, timeout=None):
+    sock = socket.create_connection((Server.HOSTNAME, port), timeout=STARTUP_TIMEOUT)
+    sock.settimeout(timeout)
+    return sock
+
+def getdir(sock, expected_size):
+    sock.sendall(CMD["getdir"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+    recvd = 0
+    while recvd < expected_size:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed by server")
+        recvd += len(chunk)
+
+def run_mode(mode, args):
+    port = free_port()
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    server = subprocess.Popen(
+        [sys.executable, main_path, "-r", "server", "-p", str(port), "-m", mode,
+         "--max-connections", str(args.connections + args.samples + 16)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    idle = []
+    samples = []
+    control = None
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                control = connect(port, LATENCY_TIMEOUT)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        # Preload rooms and learn the size of the getdir response.
+        for i in range(args.rooms):
+            control.sendall(CMD["makeroom"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                            + f"room{i} 239.0.{i // 256 % 256}.{i % 256} {6000 + i}\n".encode(ENCODING))
+        control.sendall(CMD["getdir"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+        time.sleep(SETTLE_TIME)
+        expected_size = len(control.recv(1 << 20))
+
+        before = proc_status(server.pid)
+
+        failed_connects = 0
+        for _ in range(args.connections):
+            try:
+                idle.append(connect(port))
+            except OSError:
+                failed_connects += 1
+        time.sleep(SETTLE_TIME)
+        after = proc_status(server.pid)
+
+        # The sample connections come after the idle ones, so a mode
+        # that serves connections in arrival order and is held up by
+        # the idle ones shows it.
+        for _ in range(args.samples):
+            try:
+                samples.append(connect(port, LATENCY_TIMEOUT))
+            except OSError:
+                failed_connects += 1
+        time.sleep(SETTLE_TIME)
+
+        latencies = []
+        timeouts = 0
+        for sock in samples:
+            start = time.perf_counter()
+            try:
+                getdir(sock, expected_size)
+                latencies.append((time.perf_counter() - start) * 1000)
+            except (socket.timeout, OSError):
+                timeouts += 1
+
+        opened = len(idle)
+        return {
+            "mode": mode,
+            "idle_connections": opened,
+            "failed_connects": failed_connects,
+            "rooms": args.rooms,
+            "rss_kb_before": before.get("VmRSS"),
+            "rss_kb_after": after.get("VmRSS"),
+            "rss_bytes_per_idle_connection":
+                (after["VmRSS"] - before["VmRSS"]) * 1024 / opened if opened else None,
+            "threads_before": before.get("Threads"),
+            "threads_after": after.get("Threads"),
+            "getdir_samples": len(latencies),
+            "getdir_timeouts": timeouts,
+            "getdir_p50_ms": percentile(latencies, 50),
+            "getdir_p95_ms": percentile(latencies, 95),
+            "getdir_p99_ms": percentile(latencies, 99),
+        }
+    finally:
+        for sock in idle + samples + ([control] if control else []):
+            sock.close()
+        server.terminate()
+        server.wait()
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CRDS idle connection and getdir latency benchmark")
+    parser.add_argument('--modes', default="select,pool,thread",
+                        help='comma separated serving modes to measure')
+    parser.add_argument('--connections', default=10000, type=int,
+                        help='idle connections to hold open')
+    parser.add_argument('--samples', default=100, type=int,
+                        help='connections used to measure getdir latency')
+    parser.add_argument('--rooms', default=100, type=int,
+                        help='rooms in the directory')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to this file')
+    args = parser.parse_args()
+
+    raise_fd_limit(args.connections + args.samples + 64)
+
+    results = [run_mode(mode, args) for mode in args.modes.split(",")]
+    report = json.dumps({"results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+########################################################################
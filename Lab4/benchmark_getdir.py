@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# getdir (text) vs getdirbin (binary) transfer and decode time, and
+# the cost of fetching one search page instead.
+#
+# Starts a directory Server on a thread, fills it with N rooms and then
+# times complete fetch + parse round trips of both listings, and of a
+# page of a prefix search, from one client connection. Prints JSON with
+# the response sizes and latency percentiles for each directory size,
+# e.g.
+#
+#   python benchmark_getdir.py --rooms 1000,10000,50000 --repeat 50
+#
+########################################################################
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+from main import Server, ChatRoom, CMD, CMD_FIELD_LEN, ENCODING
+import crds_protocol
+
+########################################################################
+
+CMD_BYTES = {name: code.to_bytes(CMD_FIELD_LEN, byteorder='big') for name, code in CMD.items()}
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+def getdir_text(sock, size):
+    # The text listing has no length field, so the expected size has
+    # to be known up front.
+    sock.sendall(CMD_BYTES["getdir"])
+    listing = crds_protocol.recv_exact(sock, size)
+    rooms = {}
+    for line in listing.decode(ENCODING).split("\n"):
+        if line:
+            name, address = line.split(": ")
+            ip, port = address[1:-1].split(", ")
+            rooms[name] = (ip, int(port))
+    return rooms
+
+def getdir_binary(sock):
+    sock.sendall(CMD_BYTES["getdirbin"])
+    return crds_protocol.recv_directory(sock)[1]
+
+def search_page(sock, terms):
+    sock.sendall(CMD_BYTES["search"] + (" ".join(terms) + "\n").encode(ENCODING))
+    payload = crds_protocol.recv_frame(sock)
+    return crds_protocol.unpack_page(payload)[1], len(payload)
+
+def measure(fetch, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rooms = fetch()
+        times.append((time.perf_counter() - start) * 1000)
+    return rooms, {
+        "p50_ms": percentile(times, 50),
+        "p95_ms": percentile(times, 95),
+        "max_ms": max(times),
+    }
+
+def run_size(server, n, repeat, page):
+    # Fill the directory in one step rather than n makeroom commands.
+    with server.directory.write_lock:
+        server.directory.publish({
+            f"room{i}": ChatRoom(f"room{i}", f"239.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", 5000 + i % 60000)
+            for i in range(n)})
+    snapshot = server.directory.snapshot
+    text_size = len(snapshot.getdir_pkt)
+    binary_size = len(snapshot.getdir_bin_pkt())
+
+    with socket.create_connection((Server.HOSTNAME, server.port)) as sock:
+        text_rooms, text_times = measure(lambda: getdir_text(sock, text_size), repeat)
+        binary_rooms, binary_times = measure(lambda: getdir_binary(sock), repeat)
+        # First page of a prefix matching about a hundred rooms.
+        terms = [f"prefix=room{n // 2}"[:-2], f"limit={page}"]
+        (page_rooms, page_bytes), search_times = measure(lambda: search_page(sock, terms), repeat)
+
+    return {
+        "rooms": n,
+        "text_bytes": text_size,
+        "binary_bytes": binary_size,
+        "listings_match": text_rooms == binary_rooms and len(binary_rooms) == n,
+        "text": text_times,
+        "binary": binary_times,
+        "search_page_rooms": len(page_rooms),
+        "search_page_bytes": page_bytes,
+        "search": search_times,
+    }
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CRDS getdir text vs binary and search page benchmark")
+    parser.add_argument('--rooms', default="1000,10000,50000",
+                        help='comma separated directory sizes')
+    parser.add_argument('--repeat', default=20, type=int,
+                        help='round trips per listing and size')
+    parser.add_argument('--page', default=50, type=int,
+                        help='search page size')
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        server = Server(port=0, serve=False)
+        threading.Thread(target=server.process_connections_forever, daemon=True).start()
+        results = [run_size(server, int(n), args.repeat, args.page) for n in args.rooms.split(",")]
+        server.shutdown()
+
+    print(json.dumps({"results": results}, indent=2))
+
+########################################################################
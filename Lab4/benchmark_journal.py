@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Directory journal append throughput and recovery time.
+#
+# Appends makeroom/deleteroom records to a DirectoryJournal in a
+# temporary directory with several fsync batch sizes and reports the
+# operations per second of each. Then journals --ops operations (about
+# one in five a delete) and times a server style recovery: loading the
+# journal, building the ChatRoom directory and its sorted index. The
+# recovery is timed again after compacting all but the last --tail
+# operations into a snapshot. Prints JSON, e.g.
+#
+#   python benchmark_journal.py --ops 1000000
+#
+########################################################################
+
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import time
+
+import crds_protocol
+from directory_journal import DirectoryJournal
+from directory_store import DirectoryStore
+from main import ChatRoom
+
+########################################################################
+
+def operations(count):
+    # Delta frames for count operations: rooms are made in order and
+    # every fifth operation deletes the oldest remaining room.
+    oldest = 0
+    made = 0
+    for version in range(1, count + 1):
+        if version % 5 == 0 and oldest < made:
+            yield crds_protocol.pack_delta(crds_protocol.DELTA_REMOVE, version, f"room{oldest}")
+            oldest += 1
+        else:
+            ip = f"239.{made >> 16 & 255}.{made >> 8 & 255}.{made & 255}"
+            yield crds_protocol.pack_delta(crds_protocol.DELTA_ADD, version, f"room{made}", ip, 5000 + made % 60000)
+            made += 1
+
+def append_rate(fsync_every, count):
+    with tempfile.TemporaryDirectory() as dir_name:
+        journal = DirectoryJournal(dir_name, fsync_every=fsync_every, snapshot_every=0)
+        journal.load()
+        frames = list(operations(count))
+        start = time.perf_counter()
+        for frame in frames:
+            journal.append(frame)
+        journal.close()
+        elapsed = time.perf_counter() - start
+    return {"fsync_every": fsync_every, "ops": count, "seconds": elapsed, "ops_per_sec": count / elapsed}
+
+def recover(dir_name):
+    # What Server.open_directory does, with each step timed.
+    journal = DirectoryJournal(dir_name, snapshot_every=0)
+    start = time.perf_counter()
+    version, recovered = journal.load()
+    loaded = time.perf_counter()
+    rooms = {name: ChatRoom(name, ip, port) for name, (ip, port) in recovered.items()}
+    store = DirectoryStore(journal, version, rooms)
+    done = time.perf_counter()
+    store.close()
+    return {
+        "version": version,
+        "rooms": len(rooms),
+        "journal_records": journal.records,
+        "load_seconds": loaded - start,
+        "build_seconds": done - loaded,
+        "recovery_seconds": done - start,
+    }
+
+def write_journal(dir_name, frames):
+    journal = DirectoryJournal(dir_name, fsync_every=0, snapshot_every=0)
+    journal.load()
+    for frame in frames:
+        journal.append(frame)
+    journal.close()
+    return journal
+
+def recovery(count, tail):
+    with tempfile.TemporaryDirectory() as dir_name:
+        journal = write_journal(dir_name, operations(count))
+        journal_bytes = os.path.getsize(journal.journal_path)
+        journal_only = recover(dir_name)
+
+    with tempfile.TemporaryDirectory() as dir_name:
+        # Snapshot the first count - tail operations, then journal the
+        # rest of the same stream.
+        frames = operations(count)
+        write_journal(dir_name, itertools.islice(frames, count - tail))
+        journal = DirectoryJournal(dir_name, fsync_every=0, snapshot_every=0)
+        version, rooms = journal.load()
+        store = DirectoryStore(journal, version,
+                               {name: ChatRoom(name, ip, port) for name, (ip, port) in rooms.items()})
+        with store.write_lock:
+            journal.write_snapshot(store.snapshot)
+        store.close()
+        journal = write_journal(dir_name, frames)
+        snapshot_bytes = os.path.getsize(journal.snapshot_path)
+        with_snapshot = recover(dir_name)
+
+    journal_only["journal_bytes"] = journal_bytes
+    with_snapshot["snapshot_bytes"] = snapshot_bytes
+    return {"ops": count, "journal_only": journal_only, "snapshot_plus_tail": with_snapshot}
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CRDS directory journal benchmark")
+    parser.add_argument('--ops', default=1000000, type=int,
+                        help='operations journaled for the recovery test')
+    parser.add_argument('--tail', default=100000, type=int,
+                        help='operations left in the journal after the snapshot')
+    parser.add_argument('--append-ops', default=100000, type=int,
+                        help='operations per append rate test')
+    parser.add_argument('--sync-ops', default=2000, type=int,
+                        help='operations for the fsync-every-operation test')
+    args = parser.parse_args()
+
+    report = {
+        "append": [append_rate(1, args.sync_ops)]
+                  + [append_rate(n, args.append_ops) for n in (DirectoryJournal.FSYNC_EVERY, 0)],
+        "recovery": recovery(args.ops, args.tail),
+    }
+    print(json.dumps(report, indent=2))
+
+########################################################################
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Room lease expiry: directory size and sweep cost.
+#
+# Makes --rooms rooms from the address pool, renews a --renewed
+# fraction of them, then sweeps at the moment the other leases run
+# out, using the sweep's clock argument rather than waiting --lease
+# seconds. The JSON report gives the directory size and getdirbin
+# listing size (and client decode time) before and after, the cost of
+# a renew per room, of the sweep that expired the rest (in all and per
+# room), and of a sweep with nothing due.
+#
+#   python benchmark_leases.py --rooms 5000 --renewed 0.25
+#
+########################################################################
+
+import argparse
+import contextlib
+import json
+import os
+import time
+
+from main import Server
+import crds_protocol
+
+########################################################################
+
+IDLE_SWEEPS = 10000
+
+def listing(server):
+    # getdirbin bytes, and milliseconds for a client to decode them.
+    pkt = server.directory.snapshot.getdir_bin_pkt()
+    start = time.perf_counter()
+    crds_protocol.unpack_directory(memoryview(pkt)[crds_protocol.LENGTH_FIELD.size:])
+    return len(pkt), (time.perf_counter() - start) * 1000
+
+def run(args):
+    server = Server(port=0, serve=False, lease=args.lease)
+    names = [f"room{i:06d}" for i in range(args.rooms)]
+    for name in names:
+        server.create_room(name)
+    created = time.monotonic()
+    size_before = len(server.directory)
+    bytes_before, decode_before = listing(server)
+
+    renewed = names[:int(len(names) * args.renewed)]
+    start = time.perf_counter()
+    server.renew_rooms(renewed)
+    renew_seconds = time.perf_counter() - start
+
+    # Every lease not renewed has run out by then; the renewed ones,
+    # renewed after created, have not.
+    start = time.perf_counter()
+    expired = server.sweep_leases(now=created + args.lease)
+    sweep_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(IDLE_SWEEPS):
+        server.sweep_leases(now=created + args.lease)
+    idle_sweep_seconds = (time.perf_counter() - start) / IDLE_SWEEPS
+
+    bytes_after, decode_after = listing(server)
+    leases = server.leases
+    result = {
+        "rooms": args.rooms,
+        "renewed": len(renewed),
+        "lease": args.lease,
+        "directory_rooms_before": size_before,
+        "directory_rooms_after": len(server.directory),
+        "getdir_bytes_before": bytes_before,
+        "getdir_bytes_after": bytes_after,
+        "client_decode_ms_before": decode_before,
+        "client_decode_ms_after": decode_after,
+        "renew_us_per_room": renew_seconds / len(renewed) * 1e6 if renewed else None,
+        "expired": expired,
+        "expiring_sweep_ms": sweep_seconds * 1000,
+        "expiring_sweep_us_per_room": sweep_seconds / expired * 1e6 if expired else None,
+        "idle_sweep_us": idle_sweep_seconds * 1e6,
+        "leases_held": len(leases),
+        "lease_heap_entries": len(leases.heap),
+        "sweeps": leases.sweeps,
+        "max_sweep_ms": leases.max_sweep_seconds * 1000,
+    }
+    server.shutdown()
+    return result
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CRDS room lease expiry benchmark")
+    parser.add_argument('--rooms', default=5000, type=int)
+    parser.add_argument('--renewed', default=0.25, type=float, help='fraction of rooms renewed')
+    parser.add_argument('--lease', default=300.0, type=float, help='lease seconds')
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        result = run(args)
+    print(json.dumps(result, indent=2))
+
+########################################################################
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Joining and leaving many chat rooms with one ChatRooms.
+#
+# Each cycle joins --rooms rooms (on --ports different ports), sends one
+# message to every room from a separate sender, waits for them, checks
+# each arrived once and in the right room, measures the process CPU
+# time over --idle seconds with all the rooms joined, then leaves them
+# all. The JSON report gives, per cycle, the open file descriptor count
+# before leaving, the idle CPU, and any misrouted or missing messages.
+# The descriptor count should not grow from cycle to cycle.
+#
+#   python benchmark_rooms.py --rooms 50 --cycles 10
+#
+########################################################################
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+from main import Client, RX_IFACE_ADDRESS
+from chat_protocol import ChatSender
+from chat_rooms import ChatRooms
+
+########################################################################
+
+GROUP_BASE = "239.1.254.0"
+PORT = 41010
+WAIT = 1.0
+
+class Collector:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lines = []
+
+    def write(self, text):
+        self.lines += text.splitlines()
+
+    def flush(self):
+        pass
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+def room_address(i, ports):
+    base = int.from_bytes(socket.inet_aton(GROUP_BASE), "big")
+    return socket.inet_ntoa((base + i).to_bytes(4, "big")), PORT + i % ports
+
+def run(args):
+    out = Collector()
+    rooms = ChatRooms("bench", RX_IFACE_ADDRESS, Client.TTL, out=out, output_lock=out.lock)
+    send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, Client.TTL)
+    sender = ChatSender("sender")
+    names = [f"room{i}" for i in range(args.rooms)]
+    cycles = []
+    for cycle in range(args.cycles):
+        for i, name in enumerate(names):
+            rooms.join(name, *room_address(i, args.ports))
+        out.lines.clear()
+        for i, name in enumerate(names):
+            # The message is the room it was sent to.
+            sender.send(send_sock, name, room_address(i, args.ports))
+        deadline = time.monotonic() + WAIT
+        while len(out.lines) < len(names) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with out.lock:
+            lines = list(out.lines)
+        misrouted = sum(1 for line in lines if line.split("|")[1].split("]")[0] != line.split(": ", 1)[1])
+        missing = len(set(names) - {line.split(": ", 1)[1] for line in lines})
+        cpu = time.process_time()
+        time.sleep(args.idle)
+        idle_cpu = (time.process_time() - cpu) / args.idle
+        cycles.append({
+            "cycle": cycle,
+            "open_fds": open_fds(),
+            "idle_cpu_seconds_per_second": idle_cpu,
+            "received": len(lines),
+            "missing": missing,
+            "misrouted": misrouted,
+        })
+        for name in names:
+            rooms.leave(name)
+    after_leave = open_fds()
+    unrouted = rooms.unrouted
+    rooms.close()
+    send_sock.close()
+    return {
+        "rooms": args.rooms,
+        "ports": args.ports,
+        "cycles": cycles,
+        "open_fds_after_leaving": after_leave,
+        "unrouted": unrouted,
+        "open_fds_after_close": open_fds(),
+    }
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chat room join/leave benchmark")
+    parser.add_argument('--rooms', default=50, type=int, help='rooms joined at once')
+    parser.add_argument('--ports', default=2, type=int, help='distinct room ports')
+    parser.add_argument('--cycles', default=10, type=int)
+    parser.add_argument('--idle', default=0.5, type=float, help='seconds of idle CPU measured per cycle')
+    args = parser.parse_args()
+    print(json.dumps(run(args), indent=2))
+
+########################################################################
@@ -0,0 +1,139 @@
+########################################################################
+#
+# Chat room datagram format.
+#
+# ------------------------------------------------------------------
+# | 1 byte version | 1 byte name length | ... name ... |
+# ------------------------------------------------------------------
+# | 4 byte sequence number | 8 byte timestamp | ... message ... |
+# ------------------------------------------------------------------
+#
+# The sequence number counts each sender's messages from 0, so a
+# receiver can count lost and out of order messages per sender. The
+# timestamp is the send time in microseconds since the epoch. Integers
+# are big endian, text utf-8. A 6 character name costs 20 bytes of
+# header instead of the 64 bytes of the original padded name field.
+#
+# The name comes first, so a sender's header prefix never changes and
+# a receiver can spot its own messages by comparing that prefix.
+#
+# The optional reliable layer (chat_reliable) adds two control
+# datagrams, told apart by their first byte. A NACK asks a sender to
+# resend the listed sequence number ranges:
+#
+# --------------------------------------------------------------
+# | 1 byte NACK | 1 byte name length | ... sender name ...     |
+# --------------------------------------------------------------
+# | 1 byte range count | 4 byte first seq | 2 byte count | ... |
+# --------------------------------------------------------------
+#
+# A SYNC tells receivers a sender's last sequence number, so losing the
+# last messages before a pause is noticed too:
+#
+# -----------------------------------------------------------------------
+# | 1 byte SYNC | 1 byte name length | ... sender name ... | 4 byte seq |
+# -----------------------------------------------------------------------
+#
+# Datagrams from older clients (a 64 byte space padded name, then the
+# message) start with a printable character, never one of these kind
+# bytes, and are still understood.
+#
+########################################################################
+
+import struct
+import time
+
+ENCODING = "utf-8"
+
+VERSION = 1
+VERSION_BYTE = bytes([VERSION])
+NACK_BYTE = b"\x02"
+SYNC_BYTE = b"\x03"
+MAX_DATAGRAM = 1024
+LEGACY_NAME_FIELD_LEN = 64
+
+PREFIX = struct.Struct("!BB")
+SEQ_TIME = struct.Struct("!IQ")
+SEQ = struct.Struct("!I")
+NACK_RANGE = struct.Struct("!IH")
+MAX_NACK_RANGES = 64
+
+def header_prefix(name, kind=VERSION):
+    if isinstance(name, str):
+        name = name.encode(ENCODING)[:255]
+    return PREFIX.pack(kind, len(name)) + name
+
+def pack_nack(raw_name, ranges):
+    # ranges is a list of (first seq, count); at most MAX_NACK_RANGES.
+    ranges = ranges[:MAX_NACK_RANGES]
+    return (header_prefix(raw_name, NACK_BYTE[0]) + bytes([len(ranges)])
+            + b"".join(NACK_RANGE.pack(first, count) for first, count in ranges))
+
+def pack_sync(raw_name, seq):
+    return header_prefix(raw_name, SYNC_BYTE[0]) + SEQ.pack(seq)
+
+def parse_control(data):
+    # Returns (raw sender name, rest) of a NACK or SYNC datagram.
+    name_end = PREFIX.size + data[1]
+    if len(data) < name_end:
+        raise ValueError("Truncated control datagram")
+    return data[PREFIX.size:name_end], data[name_end:]
+
+def parse_nack(rest):
+    # The (first seq, count) ranges of a NACK's rest.
+    if not rest or len(rest) < 1 + rest[0] * NACK_RANGE.size:
+        raise ValueError("Truncated NACK")
+    return [NACK_RANGE.unpack_from(rest, 1 + i * NACK_RANGE.size) for i in range(rest[0])]
+
+def parse_sync(rest):
+    try:
+        return SEQ.unpack(rest)[0]
+    except struct.error:
+        raise ValueError("Truncated SYNC")
+
+class ChatSender:
+
+    # Builds datagrams in one preallocated buffer. The header prefix is
+    # written once; each send fills in the sequence number, timestamp
+    # and message and sends a view of the buffer.
+
+    def __init__(self, name):
+        self.buf = bytearray(MAX_DATAGRAM)
+        prefix = header_prefix(name)
+        self.buf[:len(prefix)] = prefix
+        self.seq_offset = len(prefix)
+        self.msg_offset = self.seq_offset + SEQ_TIME.size
+        self.view = memoryview(self.buf)
+        self.seq = 0
+
+    def build(self, msg):
+        # Fill the buffer for msg (str or bytes); returns the datagram
+        # as a view of the buffer, valid until the next build. Messages
+        # too long for one datagram are cut short.
+        if isinstance(msg, str):
+            msg = msg.encode(ENCODING)
+        msg = msg[:MAX_DATAGRAM - self.msg_offset]
+        SEQ_TIME.pack_into(self.buf, self.seq_offset, self.seq, time.time_ns() // 1000)
+        end = self.msg_offset + len(msg)
+        self.buf[self.msg_offset:end] = msg
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return self.view[:end]
+
+    def send(self, sock, msg, address):
+        return sock.sendto(self.build(msg), address)
+
+def parse(data):
+    # Returns (name, seq, timestamp_us, message bytes); seq and
+    # timestamp are None for the older padded format. Raises ValueError
+    # for a datagram too short for its header.
+    if data[:1] != VERSION_BYTE:
+        name = data[:LEGACY_NAME_FIELD_LEN].decode(ENCODING, errors="replace").rstrip()
+        return name, None, None, data[LEGACY_NAME_FIELD_LEN:]
+    if len(data) < PREFIX.size or len(data) < PREFIX.size + data[1] + SEQ_TIME.size:
+        raise ValueError("Truncated chat datagram")
+    name_end = PREFIX.size + data[1]
+    seq, timestamp = SEQ_TIME.unpack_from(data, name_end)
+    name = data[PREFIX.size:name_end].decode(ENCODING, errors="replace")
+    return name, seq, timestamp, data[name_end + SEQ_TIME.size:]
+
+########################################################################
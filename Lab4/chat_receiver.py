@@ -0,0 +1,180 @@
+########################################################################
+#
+# Chat room receive loop for the Lab4 client.
+#
+# The socket is non-blocking and waited on with a selector, so the loop
+# sees run_flag cleared within POLL_INTERVAL even when the room is
+# quiet. Each wakeup drains up to BATCH_SIZE datagrams. Our own
+# messages come back to us through multicast loopback; they are
+# recognised by comparing the raw header prefix (see chat_protocol)
+# with our pre-encoded one, without decoding anything. The other
+# messages of a batch are formatted and written to the output in one
+# write under output_lock.
+#
+# Per sender sequence numbers are followed to count messages lost
+# (a jump forward) and out of order (a step back).
+#
+# Under load a wakeup would otherwise find only a handful of datagrams.
+# So after a busy batch that emptied the socket, the loop sleeps
+# COALESCE_DELAY to let the next batch build up in the (enlarged)
+# socket receive buffer. That trades up to COALESCE_DELAY of latency,
+# only while the room is busy, for far fewer wakeups. A batch that
+# hits BATCH_SIZE is followed straight away by the next one.
+#
+########################################################################
+
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+import chat_protocol
+
+class ChatReceiver:
+
+    POLL_INTERVAL = 0.1
+    BATCH_SIZE = 256
+    RECV_SIZE = 1024
+    COALESCE_MIN = 16
+    COALESCE_DELAY = 0.002
+    RCVBUF_SIZE = 1 << 20
+
+    def __init__(self, sock, username, room_name, out=None, output_lock=None):
+        self.sock = sock
+        self.room_name = room_name
+        # The header prefix exactly as our own messages carry it.
+        self.own_prefix = chat_protocol.header_prefix(username)
+        self.out = sys.stdout if out is None else out
+        self.output_lock = threading.Lock() if output_lock is None else output_lock
+        self.received = 0
+        self.own = 0
+        self.batches = 0
+        self.malformed = 0
+        # Per sender (by raw name): the next sequence number expected,
+        # the first one received, and the decoded name.
+        self.next_seq = {}
+        self.first_seq = {}
+        self.names = {}
+        self.lost = 0
+        self.out_of_order = 0
+        self.poll_interval = ChatReceiver.POLL_INTERVAL
+
+    def run(self, run_flag):
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ChatReceiver.RCVBUF_SIZE)
+        except OSError:
+            pass
+        self.sock.setblocking(False)
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+            while run_flag.is_set():
+                count = self.drain() if selector.select(self.poll_interval) else 0
+                self.tick()
+                if ChatReceiver.COALESCE_MIN <= count < ChatReceiver.BATCH_SIZE:
+                    time.sleep(ChatReceiver.COALESCE_DELAY)
+
+    def drain(self):
+        # Read and print one batch; returns how many datagrams it had.
+        lines = []
+        own_prefix = self.own_prefix
+        recv = self.sock.recv
+        count = 0
+        for _ in range(ChatReceiver.BATCH_SIZE):
+            try:
+                data = recv(ChatReceiver.RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # The socket was closed under us; the caller is leaving.
+                break
+            count += 1
+            if data.startswith(own_prefix):
+                self.own += 1
+                continue
+            self.handle(data, lines)
+        self.received += count
+        self.batches += 1
+        self.write(lines)
+        return count
+
+    def handle(self, data, lines):
+        # Add the output lines for one datagram from someone else.
+        line = self.format(data)
+        if line is not None:
+            lines.append(line)
+
+    def tick(self):
+        # Called once per loop iteration, data or not.
+        pass
+
+    def write(self, lines):
+        if lines:
+            with self.output_lock:
+                self.out.write("".join(lines))
+                self.out.flush()
+
+    def format(self, data):
+        parsed = self.parse_message(data)
+        if parsed is None:
+            return None
+        raw_name, seq, line = parsed
+        if seq is not None:
+            self.track(raw_name, seq)
+        return line
+
+    def parse_message(self, data):
+        # Returns (raw sender name, seq, output line), seq None for the
+        # older format, or None for anything that is not a message. The
+        # current format is parsed here rather than through
+        # chat_protocol.parse, as this runs for every message.
+        kind = data[:1]
+        if kind != chat_protocol.VERSION_BYTE:
+            if kind in (chat_protocol.NACK_BYTE, chat_protocol.SYNC_BYTE):
+                return None
+            try:
+                name, seq, timestamp, msg = chat_protocol.parse(data)
+            except ValueError:
+                self.malformed += 1
+                return None
+            return None, None, f"[{name}|{self.room_name}]: {msg.decode(chat_protocol.ENCODING, errors='replace')}\n"
+        name_end = chat_protocol.PREFIX.size + data[1]
+        try:
+            seq, timestamp = chat_protocol.SEQ_TIME.unpack_from(data, name_end)
+        except struct.error:
+            self.malformed += 1
+            return None
+        raw_name = data[chat_protocol.PREFIX.size:name_end]
+        name = self.names.get(raw_name)
+        if name is None:
+            name = self.names[raw_name] = raw_name.decode(chat_protocol.ENCODING, errors="replace")
+        msg = data[name_end + chat_protocol.SEQ_TIME.size:]
+        return raw_name, seq, f"[{name}|{self.room_name}]: {msg.decode(chat_protocol.ENCODING, errors='replace')}\n"
+
+    def track(self, sender, seq):
+        expected = self.next_seq.get(sender)
+        if expected is not None:
+            gap = (seq - expected) & 0xFFFFFFFF
+            if gap >= 0x80000000:
+                # Behind what we expected: late or repeated.
+                self.out_of_order += 1
+                return
+            self.lost += gap
+        else:
+            self.first_seq[sender] = seq
+        self.next_seq[sender] = (seq + 1) & 0xFFFFFFFF
+
+    def seen(self, sender, seq):
+        # Whether seq is at or after the first message we had from
+        # sender, so was (or will be) received live.
+        first = self.first_seq.get(sender)
+        return first is not None and (seq - first) & 0xFFFFFFFF < 0x80000000
+
+    def replayed(self, sender, seq):
+        # Room history up to seq from sender has been printed. If we have
+        # had nothing live from sender yet, expect seq + 1 next.
+        if sender not in self.next_seq:
+            self.first_seq[sender] = self.next_seq[sender] = (seq + 1) & 0xFFFFFFFF
+
+########################################################################
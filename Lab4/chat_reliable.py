@@ -0,0 +1,270 @@
+########################################################################
+#
+# Optional reliable, ordered delivery for Lab4 chat rooms.
+#
+# Chat messages already carry a per sender sequence number (see
+# chat_protocol). A ReliableSender also keeps its last HISTORY
+# datagrams in a ring buffer, indexed by sequence number. A
+# ReliableChatReceiver holds each sender's messages that arrive ahead
+# of a gap (at most REORDER_WINDOW of them) and prints them once the
+# gap is filled, so output is always in order.
+#
+# Gaps are repaired by NACK: after NACK_DELAY the receiver multicasts a
+# NACK listing the missing ranges, and the sender (whose own receive
+# loop sees it) resends whatever its ring buffer still has. The NACK is
+# repeated every NACK_INTERVAL. After MAX_NACKS NACKs for the first
+# hole, or when a message arrives more than REORDER_WINDOW ahead, the
+# receiver gives up on the hole, counts it lost and moves on. A sender
+# that goes quiet multicasts a few SYNCs carrying its last sequence
+# number, so a loss just before the pause is noticed too.
+#
+# A receiver starts following a sender at the first sequence number it
+# sees, and never NACKs the messages before it: they were sent before
+# it joined, and NACKing them would have the whole room resent to
+# everyone. A late joiner gets them from the room history instead.
+#
+########################################################################
+
+import time
+
+import chat_protocol
+from chat_protocol import ChatSender
+from chat_receiver import ChatReceiver
+
+SEQ_MASK = 0xFFFFFFFF
+
+def seq_diff(a, b):
+    # a - b in sequence number space: negative if a comes before b.
+    return ((a - b + 0x80000000) & SEQ_MASK) - 0x80000000
+
+class ReliableSender(ChatSender):
+
+    HISTORY = 2048
+    # However many receivers NACK a message, resend it at most once in
+    # this many seconds.
+    RESEND_HOLDOFF = 0.01
+
+    def __init__(self, name):
+        super().__init__(name)
+        prefix = chat_protocol.header_prefix(name)
+        self.raw_name = prefix[chat_protocol.PREFIX.size:]
+        self.history = [None] * ReliableSender.HISTORY # (seq, datagram)
+        self.resent_at = [0.0] * ReliableSender.HISTORY
+        self.last_send = None
+        self.resent = 0
+
+    def send(self, sock, msg, address):
+        seq = self.seq
+        datagram = bytes(self.build(msg))
+        self.history[seq % ReliableSender.HISTORY] = (seq, datagram)
+        self.last_send = time.monotonic()
+        return sock.sendto(datagram, address)
+
+    def last_seq(self):
+        # The last sequence number sent, or None before the first send.
+        return None if self.last_send is None else (self.seq - 1) & SEQ_MASK
+
+    def resend(self, sock, ranges, address):
+        now = time.monotonic()
+        for first, count in ranges:
+            for i in range(min(count, ReliableSender.HISTORY)):
+                seq = (first + i) & SEQ_MASK
+                slot = seq % ReliableSender.HISTORY
+                entry = self.history[slot]
+                if entry is None or entry[0] != seq:
+                    # Never sent, or no longer in the ring buffer.
+                    continue
+                if now - self.resent_at[slot] < ReliableSender.RESEND_HOLDOFF:
+                    continue
+                self.resent_at[slot] = now
+                sock.sendto(entry[1], address)
+                self.resent += 1
+
+class SenderStream:
+
+    # What one receiver knows of one sender's messages.
+
+    def __init__(self, seq):
+        self.start = seq # first sequence number followed
+        self.next = seq # next sequence number to print
+        self.highest = (seq - 1) & SEQ_MASK # highest known to exist
+        self.pending = {} # seq -> line, waiting for a gap before them
+        self.gap_since = None # when the current gaps began
+        self.last_nack = 0.0
+        self.nacks = 0
+
+    def missing(self):
+        return seq_diff(self.highest, self.next) >= 0
+
+class ReliableChatReceiver(ChatReceiver):
+
+    REORDER_WINDOW = 1024
+    NACK_DELAY = 0.005
+    NACK_INTERVAL = 0.02
+    MAX_NACKS = 10
+    SYNC_INTERVAL = 0.2
+    SYNC_REPEATS = 3
+
+    def __init__(self, sock, username, room_name, sender, send_sock, address,
+                 out=None, output_lock=None):
+        # sender is our own ReliableSender, whose messages this loop
+        # resends when asked; NACKs and SYNCs go out on send_sock.
+        super().__init__(sock, username, room_name, out=out, output_lock=output_lock)
+        self.sender = sender
+        self.send_sock = send_sock
+        self.address = address
+        self.streams = {} # raw sender name -> SenderStream
+        self.poll_interval = ReliableChatReceiver.NACK_INTERVAL
+        self.duplicates = 0
+        self.nacks_sent = 0
+        self.sync_seq = None
+        self.syncs_sent = 0
+        self.last_sync = 0.0
+
+    def handle(self, data, lines):
+        kind = data[:1]
+        try:
+            if kind == chat_protocol.NACK_BYTE:
+                self.answer_nack(data)
+                return
+            if kind == chat_protocol.SYNC_BYTE:
+                self.note_sync(data, lines)
+                return
+        except ValueError:
+            self.malformed += 1
+            return
+        parsed = self.parse_message(data)
+        if parsed is None:
+            return
+        raw_name, seq, line = parsed
+        if seq is None:
+            # Older clients have no sequence numbers; print as is.
+            lines.append(line)
+            return
+        stream = self.streams.get(raw_name)
+        if stream is None:
+            stream = self.streams[raw_name] = SenderStream(seq)
+        self.accept(stream, seq, line, lines)
+
+    def seen(self, sender, seq):
+        stream = self.streams.get(sender)
+        return stream is not None and seq_diff(seq, stream.start) >= 0
+
+    def replayed(self, sender, seq):
+        # Follow sender from just after the room history, so a live
+        # message lost right after it is NACKed. A stream we already
+        # have starts after the history anyway.
+        if sender not in self.streams:
+            self.streams[sender] = SenderStream((seq + 1) & SEQ_MASK)
+
+    def accept(self, stream, seq, line, lines):
+        ahead = seq_diff(seq, stream.next)
+        if ahead < 0 or seq in stream.pending:
+            self.duplicates += 1
+            return
+        if ahead >= ReliableChatReceiver.REORDER_WINDOW:
+            # Too far ahead to keep waiting for what is missing.
+            self.skip(stream, (seq - ReliableChatReceiver.REORDER_WINDOW + 1) & SEQ_MASK, lines)
+        if seq_diff(seq, stream.highest) > 0:
+            stream.highest = seq
+        stream.pending[seq] = line
+        self.deliver(stream, lines)
+
+    def deliver(self, stream, lines):
+        pending = stream.pending
+        first = stream.next
+        while stream.next in pending:
+            lines.append(pending.pop(stream.next))
+            stream.next = (stream.next + 1) & SEQ_MASK
+        if stream.next != first:
+            # A new first hole; it gets its own MAX_NACKS.
+            stream.nacks = 0
+        if not stream.missing():
+            stream.gap_since = None
+        elif stream.gap_since is None:
+            stream.gap_since = time.monotonic()
+
+    def skip(self, stream, seq, lines):
+        # Give up on every missing message before seq.
+        while seq_diff(seq, stream.next) > 0:
+            line = stream.pending.pop(stream.next, None)
+            if line is None:
+                self.lost += 1
+            else:
+                lines.append(line)
+            stream.next = (stream.next + 1) & SEQ_MASK
+        stream.nacks = 0
+        self.deliver(stream, lines)
+
+    def holes(self, stream):
+        # The missing (first seq, count) ranges up to stream.highest.
+        ranges = []
+        first = None
+        seq = stream.next
+        end = (stream.highest + 1) & SEQ_MASK
+        while seq != end and len(ranges) < chat_protocol.MAX_NACK_RANGES:
+            if seq in stream.pending:
+                if first is not None:
+                    ranges.append((first, seq_diff(seq, first)))
+                    first = None
+            elif first is None:
+                first = seq
+            seq = (seq + 1) & SEQ_MASK
+        if first is not None and len(ranges) < chat_protocol.MAX_NACK_RANGES:
+            ranges.append((first, seq_diff(seq, first)))
+        return ranges
+
+    def tick(self):
+        now = time.monotonic()
+        lines = []
+        for raw_name, stream in self.streams.items():
+            if stream.gap_since is None or now - stream.gap_since < ReliableChatReceiver.NACK_DELAY:
+                continue
+            if now - stream.last_nack < ReliableChatReceiver.NACK_INTERVAL:
+                continue
+            if stream.nacks >= ReliableChatReceiver.MAX_NACKS:
+                # Give up on the first hole.
+                if stream.pending:
+                    target = min(stream.pending, key=lambda seq: seq_diff(seq, stream.next))
+                else:
+                    target = (stream.highest + 1) & SEQ_MASK
+                self.skip(stream, target, lines)
+                continue
+            self.send_sock.sendto(chat_protocol.pack_nack(raw_name, self.holes(stream)), self.address)
+            stream.nacks += 1
+            stream.last_nack = now
+            self.nacks_sent += 1
+        self.sync(now)
+        self.write(lines)
+
+    def sync(self, now):
+        # After we go quiet, tell the room our last sequence number.
+        last_seq = self.sender.last_seq()
+        if last_seq is None:
+            return
+        if last_seq != self.sync_seq:
+            self.sync_seq = last_seq
+            self.syncs_sent = 0
+        if (self.syncs_sent < ReliableChatReceiver.SYNC_REPEATS
+                and now - max(self.sender.last_send, self.last_sync) >= ReliableChatReceiver.SYNC_INTERVAL):
+            self.send_sock.sendto(chat_protocol.pack_sync(self.sender.raw_name, last_seq), self.address)
+            self.syncs_sent += 1
+            self.last_sync = now
+
+    def answer_nack(self, data):
+        raw_name, rest = chat_protocol.parse_control(data)
+        if raw_name == self.sender.raw_name:
+            self.sender.resend(self.send_sock, chat_protocol.parse_nack(rest), self.address)
+
+    def note_sync(self, data, lines):
+        raw_name, rest = chat_protocol.parse_control(data)
+        seq = chat_protocol.parse_sync(rest)
+        stream = self.streams.get(raw_name)
+        if stream is None or seq_diff(seq, stream.highest) <= 0:
+            return
+        if seq_diff(seq, stream.next) >= ReliableChatReceiver.REORDER_WINDOW:
+            self.skip(stream, (seq - ReliableChatReceiver.REORDER_WINDOW + 1) & SEQ_MASK, lines)
+        stream.highest = seq
+        self.deliver(stream, lines)
+
+########################################################################
@@ -0,0 +1,290 @@
+########################################################################
+#
+# Chat room memberships of one Lab4 client.
+#
+# A client can be in several rooms at once. Receiving is done by one
+# thread and one selector for all of them. Receive sockets are per room
+# port, opened the first time a room on that port is joined and kept
+# for later joins, so joining and leaving rooms only adds and drops
+# multicast memberships (IP_ADD_MEMBERSHIP / IP_DROP_MEMBERSHIP) on
+# sockets that already exist. A port has one socket for every
+# MAX_MEMBERSHIPS rooms in it at once; rooms made from the server's
+# pool all share a port, so a client in a handful of rooms has one
+# receive socket. All rooms are sent to through one send socket.
+#
+# Datagrams are routed to their room by port (which socket) and group.
+# The group is the datagram's destination address, which the kernel
+# passes along with it (IP_PKTINFO). IP_MULTICAST_ALL is turned off, so
+# a socket only receives groups it joined itself. Where IP_PKTINFO is
+# not available there is a socket per (group, port) instead.
+#
+# Each room has its own ChatSender (sequence numbers are per room) and
+# its own ChatReceiver, which formats, counts and writes the room's
+# messages as it does for a single room. The loop drains ready sockets
+# in batches and coalesces under load as ChatReceiver.run does.
+#
+########################################################################
+
+import errno
+import selectors
+import socket
+import sys
+import threading
+import time
+
+from chat_protocol import ChatSender
+from chat_receiver import ChatReceiver
+from chat_reliable import ReliableSender, ReliableChatReceiver
+
+if sys.platform.startswith("linux"):
+    IP_PKTINFO = getattr(socket, "IP_PKTINFO", 8)
+    IP_MULTICAST_ALL = getattr(socket, "IP_MULTICAST_ALL", 49)
+else:
+    IP_PKTINFO = getattr(socket, "IP_PKTINFO", None)
+    IP_MULTICAST_ALL = getattr(socket, "IP_MULTICAST_ALL", None)
+# struct in_pktinfo: interface index, local address, destination address.
+PKTINFO_SIZE = 12
+PKTINFO_DST = slice(8, 12)
+
+class ChatRoom:
+
+    def __init__(self, name, group, port, sender, receiver):
+        self.name = name
+        self.address = (group, port)
+        self.sender = sender
+        self.receiver = receiver
+
+class ChatRooms:
+
+    RECV_ADDRESS = ""
+    TTL = 1
+    # Linux allows a socket 20 memberships by default
+    # (net.ipv4.igmp_max_memberships).
+    MAX_MEMBERSHIPS = 20
+
+    def __init__(self, username, iface_address="0.0.0.0", ttl=TTL, reliable=False,
+                 out=None, output_lock=None):
+        self.username = username
+        self.iface = socket.inet_aton(iface_address)
+        self.reliable = reliable
+        self.out = sys.stdout if out is None else out
+        self.output_lock = threading.Lock() if output_lock is None else output_lock
+        self.pktinfo = IP_PKTINFO is not None
+        self.cmsg_size = socket.CMSG_SPACE(PKTINFO_SIZE) if self.pktinfo else 0
+        self.selector = selectors.DefaultSelector()
+        # Socket key (port, or (group, port) without IP_PKTINFO) -> the
+        # sockets for it, and socket -> how many groups it has joined.
+        self.sockets = {}
+        self.memberships = {}
+        self.rooms = {} # room name -> ChatRoom
+        self.routes = {} # (packed group, port) -> ChatRoom
+        self.unrouted = 0
+        self.lock = threading.Lock()
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.run_flag = threading.Event()
+        self.thread = None
+
+    def socket_key(self, group, port):
+        return port if self.pktinfo else (group, port)
+
+    def open_socket(self, key, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+            sock.bind((ChatRooms.RECV_ADDRESS, port))
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ChatReceiver.RCVBUF_SIZE)
+            except OSError:
+                pass
+            if self.pktinfo:
+                sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+            if IP_MULTICAST_ALL is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+                except OSError:
+                    pass
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        self.sockets.setdefault(key, []).append(sock)
+        self.memberships[sock] = 0
+        self.selector.register(sock, selectors.EVENT_READ, key)
+        return sock
+
+    def add_membership(self, group, port):
+        # Add group to a socket for port with a membership to spare,
+        # opening one if need be; returns the socket.
+        key = self.socket_key(group, port)
+        request = socket.inet_aton(group) + self.iface
+        for sock in self.sockets.get(key, []):
+            if self.memberships[sock] >= ChatRooms.MAX_MEMBERSHIPS:
+                continue
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, request)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # The limit here is lower than MAX_MEMBERSHIPS.
+                self.memberships[sock] = ChatRooms.MAX_MEMBERSHIPS
+                continue
+            self.memberships[sock] += 1
+            return sock
+        sock = self.open_socket(key, port)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, request)
+        self.memberships[sock] += 1
+        return sock
+
+    def join(self, name, group, port):
+        # Join room name at (group, port); returns its ChatRoom. Raises
+        # OSError if the socket or membership cannot be had.
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is not None:
+                return room
+            sock = self.add_membership(group, port)
+            room = self.make_room(name, group, port, sock)
+            self.rooms[name] = room
+            self.routes[(socket.inet_aton(group), port)] = room
+        if self.thread is None:
+            self.run_flag.set()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return room
+
+    def make_room(self, name, group, port, sock):
+        if self.reliable:
+            sender = ReliableSender(self.username)
+            receiver = ReliableChatReceiver(sock, self.username, name, sender, self.send_socket,
+                                            (group, port), out=self.out, output_lock=self.output_lock)
+        else:
+            sender = ChatSender(self.username)
+            receiver = ChatReceiver(sock, self.username, name, out=self.out, output_lock=self.output_lock)
+        return ChatRoom(name, group, port, sender, receiver)
+
+    def leave(self, name):
+        # Drop the membership; the socket stays for the next join.
+        with self.lock:
+            room = self.rooms.pop(name, None)
+            if room is None:
+                return False
+            group, port = room.address
+            packed = socket.inet_aton(group)
+            del self.routes[(packed, port)]
+            sock = room.receiver.sock
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, packed + self.iface)
+            except OSError:
+                pass
+            self.memberships[sock] -= 1
+            return True
+
+    def replay(self, name, datagrams):
+        # Print datagrams sent to room name before we joined, skipping
+        # any that have since arrived live. Holds the lock, so nothing
+        # live is printed in between. The receiver then follows each
+        # sender on from its last replayed message. Returns how many
+        # were printed.
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                return 0
+            receiver = room.receiver
+            lines = []
+            last = {} # raw sender name -> last replayed seq
+            for data in datagrams:
+                parsed = receiver.parse_message(data)
+                if parsed is None:
+                    continue
+                raw_name, seq, line = parsed
+                if seq is None:
+                    lines.append(line)
+                    continue
+                last[raw_name] = seq
+                if not receiver.seen(raw_name, seq):
+                    lines.append(line)
+            for raw_name, seq in last.items():
+                receiver.replayed(raw_name, seq)
+            receiver.write(lines)
+        return len(lines)
+
+    def send(self, name, msg):
+        room = self.rooms.get(name)
+        if room is None:
+            return False
+        room.sender.send(self.send_socket, msg, room.address)
+        return True
+
+    def run(self):
+        while self.run_flag.is_set():
+            with self.lock:
+                poll_interval = min((room.receiver.poll_interval for room in self.rooms.values()),
+                                    default=ChatReceiver.POLL_INTERVAL)
+            events = self.selector.select(poll_interval)
+            count = 0
+            with self.lock:
+                for key, mask in events:
+                    count += self.drain(key.fileobj, key.data)
+                for room in self.rooms.values():
+                    room.receiver.tick()
+            if ChatReceiver.COALESCE_MIN <= count < ChatReceiver.BATCH_SIZE:
+                time.sleep(ChatReceiver.COALESCE_DELAY)
+
+    def drain(self, sock, key):
+        # Read one batch from sock and hand each datagram to its room.
+        batch = {}
+        routes = self.routes
+        count = 0
+        if self.pktinfo:
+            port = key
+        else:
+            route = (socket.inet_aton(key[0]), key[1])
+        for _ in range(ChatReceiver.BATCH_SIZE):
+            try:
+                data, ancdata, flags, address = sock.recvmsg(ChatReceiver.RECV_SIZE, self.cmsg_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                break
+            count += 1
+            if self.pktinfo:
+                route = None
+                for level, kind, cmsg in ancdata:
+                    if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                        route = (cmsg[PKTINFO_DST], port)
+            room = routes.get(route)
+            if room is None:
+                # A room we just left, or no destination address.
+                self.unrouted += 1
+                continue
+            receiver = room.receiver
+            receiver.received += 1
+            if receiver.own_prefix is not None and data.startswith(receiver.own_prefix):
+                receiver.own += 1
+                continue
+            lines = batch.get(room)
+            if lines is None:
+                lines = batch[room] = []
+            receiver.handle(data, lines)
+        for room, lines in batch.items():
+            room.receiver.batches += 1
+            room.receiver.write(lines)
+        return count
+
+    def close(self):
+        self.run_flag.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for name in list(self.rooms):
+            self.leave(name)
+        for sock in self.memberships:
+            self.selector.unregister(sock)
+            sock.close()
+        self.sockets.clear()
+        self.memberships.clear()
+        self.selector.close()
+        self.send_socket.close()
+
+########################################################################
@@ -0,0 +1,228 @@
+########################################################################
+#
+# Binary directory listing used by the CRDS getdirbin command.
+#
+# -------------------------------------------------------------------
+# | 4 byte payload length | 1 byte format version | 8 byte directory |
+# |                       |                       | version          |
+# -------------------------------------------------------------------
+# | 4 byte room count | entry | entry | ... | name | name | ...      |
+# -------------------------------------------------------------------
+#
+# The entries are a table of fixed 8 byte records, so they can be
+# unpacked in one pass; the room names follow, in the same order:
+#
+# --------------------------------------------------
+# | 4 byte IPv4 | 2 byte port | 2 byte name length |
+# --------------------------------------------------
+#
+# A subscription (the subscribe command) starts with one such listing
+# and then carries a delta frame for every later change:
+#
+# ------------------------------------------------------------------
+# | 4 byte payload length | 1 byte op | 8 byte directory version |
+# ------------------------------------------------------------------
+# | 4 byte IPv4 | 2 byte port | 2 byte name length | ... name ... |
+# ------------------------------------------------------------------
+#
+# op is DELTA_ADD or DELTA_REMOVE; a removal carries 0.0.0.0 port 0.
+#
+# A search response is one page of rooms: a cursor for the next page
+# (empty on the last page) followed by the page as a listing:
+#
+# ---------------------------------------------------------------------------
+# | 4 byte payload length | 2 byte cursor length | ... cursor ... | listing |
+# ---------------------------------------------------------------------------
+#
+# makeroom, and allocroom which replies, create a room with a given
+# address or with one the server allocates. allocroom's reply gives the
+# outcome, the room's address and the server's room lease: how many
+# milliseconds a room lives without a renew from its creator (0 if
+# rooms never expire).
+#
+# ------------------------------------------------------------------------
+# | 4 byte payload length | 1 byte status | 4 byte IPv4 | 2 byte port |
+# | 4 byte lease |
+# ------------------------------------------------------------------------
+#
+# history returns the last chat datagrams the server logged in a room,
+# oldest first, each exactly as it was multicast (see chat_protocol):
+#
+# ---------------------------------------------------------------------------
+# | 4 byte payload length | 2 byte count | 2 byte length | datagram | ... |
+# ---------------------------------------------------------------------------
+#
+# All fields are big endian. The payload length counts every byte after
+# the length field itself, so the client always knows how much to read.
+#
+########################################################################
+
+import socket
+import struct
+
+ENCODING = "utf-8"
+
+FORMAT_VERSION = 1
+
+LENGTH_FIELD = struct.Struct("!I")
+HEADER = struct.Struct("!BQI")
+ENTRY = struct.Struct("!4sHH")
+# ENTRY with the address as its four octets, for decoding listings.
+ENTRY_OCTETS = struct.Struct("!BBBBHH")
+DELTA = struct.Struct("!BQ4sHH")
+CURSOR_FIELD = struct.Struct("!H")
+ROOM_REPLY = struct.Struct("!B4sHI")
+HISTORY_COUNT = struct.Struct("!H")
+DATAGRAM_LEN = struct.Struct("!H")
+
+DELTA_ADD = 1
+DELTA_REMOVE = 2
+
+# Dotted quad text of each octet value. Building addresses from these
+# is about twice as fast as socket.inet_ntoa per entry.
+OCTETS = tuple(str(i) for i in range(256))
+
+ROOM_OK = 0
+ROOM_NAME_TAKEN = 1
+ROOM_ADDRESS_IN_USE = 2
+ROOM_POOL_EXHAUSTED = 3
+ROOM_INVALID = 4
+ROOM_STATUS_MSG = {
+    ROOM_OK: "Room created",
+    ROOM_NAME_TAKEN: "A room with that name already exists",
+    ROOM_ADDRESS_IN_USE: "That address and port are already in use",
+    ROOM_POOL_EXHAUSTED: "No multicast addresses left to allocate",
+    ROOM_INVALID: "Invalid room address",
+}
+
+def pack_directory(rooms, version):
+    # rooms is an iterable of objects with name, ip and port.
+    return frame(pack_listing(rooms, version))
+
+def pack_page(rooms, version, cursor):
+    cursor = cursor.encode(ENCODING)
+    return frame(CURSOR_FIELD.pack(len(cursor)) + cursor + pack_listing(rooms, version))
+
+def frame(payload):
+    return LENGTH_FIELD.pack(len(payload)) + payload
+
+def pack_listing(rooms, version):
+    entries = []
+    names = []
+    for room in rooms:
+        name = room.name.encode(ENCODING)
+        entries.append(ENTRY.pack(socket.inet_aton(room.ip), room.port, len(name)))
+        names.append(name)
+    return b"".join([HEADER.pack(FORMAT_VERSION, version, len(entries))] + entries + names)
+
+def unpack_directory(payload):
+    # Returns (directory version, {name: (ip, port)}) from the bytes
+    # following the length field.
+    format_version, version, count = HEADER.unpack_from(payload, 0)
+    if format_version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported directory format version {format_version}")
+    table_end = HEADER.size + count * ENTRY.size
+    if table_end > len(payload):
+        raise ValueError("Truncated directory listing")
+    view = memoryview(payload)
+    names = view[table_end:]
+    text = str(names, ENCODING)
+    if len(text) == len(names):
+        # All ASCII: byte offsets are character offsets, so slice the
+        # names out of one decoded string.
+        names = text
+    pos = 0
+    rooms = {}
+    octets = OCTETS
+    for a, b, c, d, port, name_len in ENTRY_OCTETS.iter_unpack(view[HEADER.size:table_end]):
+        name = names[pos:pos + name_len]
+        rooms[name if names is text else str(name, ENCODING)] = (
+            f"{octets[a]}.{octets[b]}.{octets[c]}.{octets[d]}", port)
+        pos += name_len
+    if table_end + pos != len(payload):
+        raise ValueError("Directory listing length mismatch")
+    return version, rooms
+
+def pack_delta(op, version, name, ip="0.0.0.0", port=0):
+    name = name.encode(ENCODING)
+    return frame(DELTA.pack(op, version, socket.inet_aton(ip), port, len(name)) + name)
+
+def pack_room_reply(status, ip="0.0.0.0", port=0, lease=0.0):
+    # lease in seconds.
+    return frame(ROOM_REPLY.pack(status, socket.inet_aton(ip), port, round(lease * 1000)))
+
+def unpack_room_reply(payload):
+    # Returns (status, ip, port, lease in seconds).
+    status, ip, port, lease_ms = ROOM_REPLY.unpack(payload)
+    return status, socket.inet_ntoa(ip), port, lease_ms / 1000
+
+def unpack_page(payload):
+    # Returns (directory version, {name: (ip, port)} in page order,
+    # next cursor).
+    (cursor_len,) = CURSOR_FIELD.unpack_from(payload, 0)
+    view = memoryview(payload)
+    cursor_end = CURSOR_FIELD.size + cursor_len
+    cursor = str(view[CURSOR_FIELD.size:cursor_end], ENCODING)
+    version, rooms = unpack_directory(view[cursor_end:])
+    return version, rooms, cursor
+
+def unpack_delta(payload):
+    # Returns (op, directory version, name, ip, port).
+    op, version, ip, port, name_len = DELTA.unpack_from(payload, 0)
+    if op not in (DELTA_ADD, DELTA_REMOVE) or DELTA.size + name_len != len(payload):
+        raise ValueError("Malformed directory delta")
+    name = str(memoryview(payload)[DELTA.size:], ENCODING)
+    return op, version, name, socket.inet_ntoa(ip), port
+
+def pack_history(datagrams):
+    parts = [HISTORY_COUNT.pack(len(datagrams))]
+    for datagram in datagrams:
+        parts.append(DATAGRAM_LEN.pack(len(datagram)))
+        parts.append(datagram)
+    return frame(b"".join(parts))
+
+def unpack_history(payload):
+    # Returns the list of datagrams, oldest first.
+    (count,) = HISTORY_COUNT.unpack_from(payload, 0)
+    view = memoryview(payload)
+    pos = HISTORY_COUNT.size
+    datagrams = []
+    for _ in range(count):
+        (length,) = DATAGRAM_LEN.unpack_from(payload, pos)
+        pos += DATAGRAM_LEN.size
+        if pos + length > len(payload):
+            raise ValueError("Truncated history")
+        datagrams.append(bytes(view[pos:pos + length]))
+        pos += length
+    if pos != len(payload):
+        raise ValueError("History length mismatch")
+    return datagrams
+
+def recv_exact(sock, length):
+    # Receive exactly length bytes, or None if the peer closed early.
+    buf = bytearray(length)
+    view = memoryview(buf)
+    recvd = 0
+    while recvd < length:
+        n = sock.recv_into(view[recvd:])
+        if n == 0:
+            return None
+        recvd += n
+    return buf
+
+def recv_frame(sock):
+    # Read one length prefixed payload, or None if the connection closed.
+    length_bytes = recv_exact(sock, LENGTH_FIELD.size)
+    if length_bytes is None:
+        return None
+    return recv_exact(sock, LENGTH_FIELD.unpack(length_bytes)[0])
+
+def recv_directory(sock):
+    # Read one framed listing; returns (version, rooms) or None if the
+    # connection closed.
+    payload = recv_frame(sock)
+    if payload is None:
+        return None
+    return unpack_directory(payload)
+
+########################################################################
@@ -0,0 +1,200 @@
+########################################################################
+#
+# Crash-safe persistence for the CRDS room directory.
+#
+# Every makeroom/deleteroom is appended to a journal file as the same
+# delta frame that is pushed to subscribers (see crds_protocol),
+# followed by a 4 byte CRC32 of the frame payload:
+#
+# ---------------------------------------------------------
+# | delta frame (length, op, version, room) | 4 byte CRC32 |
+# ---------------------------------------------------------
+#
+# Each record is written straight through to the OS, so it survives the
+# server process dying. fsync (surviving the machine dying) is done
+# every fsync_every records, and at the latest fsync_interval seconds
+# after a record, by a thread of its own when no more records come;
+# fsync_every=1 makes every operation durable, fsync_every=0 leaves
+# flushing to the OS. A record that could only be partly written is
+# cut off again before the error is raised, so it cannot hide the
+# records after it from replay.
+#
+# Every snapshot_every records the whole directory is written to a
+# snapshot file (the binary getdirbin listing, written to a temporary
+# file and renamed into place) and the journal is emptied. Startup
+# loads the snapshot and replays the journal records with a newer
+# version. A torn or corrupt record at the end of the journal (a crash
+# mid-write) ends the replay and is cut off.
+#
+########################################################################
+
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import crds_protocol
+
+JOURNAL_NAME = "directory.journal"
+SNAPSHOT_NAME = "directory.snapshot"
+
+CRC_FIELD = struct.Struct("!I")
+
+class DirectoryJournal:
+
+    FSYNC_EVERY = 64
+    FSYNC_INTERVAL = 1.0
+    SNAPSHOT_EVERY = 100000
+
+    def __init__(self, dir_name, fsync_every=FSYNC_EVERY, fsync_interval=FSYNC_INTERVAL,
+                 snapshot_every=SNAPSHOT_EVERY):
+        self.dir_name = dir_name
+        self.journal_path = os.path.join(dir_name, JOURNAL_NAME)
+        self.snapshot_path = os.path.join(dir_name, SNAPSHOT_NAME)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        # Records in the journal, and those not yet fsynced.
+        self.records = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.file = None
+        # Length of the journal file, where the next record starts.
+        self.size = 0
+        # Serialises the file between append() and the sync thread.
+        self.lock = threading.Lock()
+        self.stop_syncing = threading.Event()
+        os.makedirs(dir_name, exist_ok=True)
+
+    def load(self):
+        # Returns (version, {name: (ip, port)}) and opens the journal for
+        # appending. Must be called once, before append().
+        version, rooms = 0, {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                data = f.read()
+            version, rooms = crds_protocol.unpack_directory(
+                memoryview(data)[crds_protocol.LENGTH_FIELD.size:])
+
+        data = b""
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb") as f:
+                data = f.read()
+        version, good_end = self.replay(data, version, rooms)
+        if good_end < len(data):
+            print(f"Discarding {len(data) - good_end} bytes of incomplete journal.")
+
+        self.file = open(self.journal_path, "ab", buffering=0)
+        self.size = good_end
+        if good_end < len(data):
+            self.file.truncate(good_end)
+            self.sync()
+        if self.fsync_every and self.fsync_interval:
+            threading.Thread(target=self.sync_forever, daemon=True).start()
+        return version, rooms
+
+    def replay(self, data, version, rooms):
+        # Apply the records of data newer than version to rooms. Returns
+        # the last version and the offset just past the last good record.
+        length_field = crds_protocol.LENGTH_FIELD
+        delta = crds_protocol.DELTA
+        ntoa = socket.inet_ntoa
+        view = memoryview(data)
+        offset = 0
+        while offset + length_field.size <= len(data):
+            (length,) = length_field.unpack_from(data, offset)
+            start = offset + length_field.size
+            end = start + length
+            if length < delta.size or end + CRC_FIELD.size > len(data):
+                break
+            if zlib.crc32(view[start:end]) != CRC_FIELD.unpack_from(data, end)[0]:
+                break
+            op, record_version, ip, port, name_len = delta.unpack_from(data, start)
+            if record_version > version:
+                name = str(view[start + delta.size:end], crds_protocol.ENCODING)
+                if op == crds_protocol.DELTA_ADD:
+                    rooms[name] = (ntoa(ip), port)
+                else:
+                    rooms.pop(name, None)
+                version = record_version
+                self.records += 1
+            offset = end + CRC_FIELD.size
+        return version, offset
+
+    def append(self, frame):
+        # frame is a delta frame; called under the directory write lock,
+        # so records are in version order.
+        payload = memoryview(frame)[crds_protocol.LENGTH_FIELD.size:]
+        record = memoryview(frame + CRC_FIELD.pack(zlib.crc32(payload)))
+        with self.lock:
+            written = 0
+            try:
+                while written < len(record):
+                    written += self.file.write(record[written:])
+            except OSError:
+                self.file.truncate(self.size)
+                raise
+            self.size += len(record)
+            self.records += 1
+            self.unsynced += 1
+            if self.fsync_every and (self.unsynced >= self.fsync_every
+                                     or time.monotonic() - self.last_sync >= self.fsync_interval):
+                self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def sync_forever(self):
+        # fsync records that have waited fsync_interval for the next
+        # append() to do it.
+        while not self.stop_syncing.wait(self.fsync_interval):
+            with self.lock:
+                if self.file is not None and self.unsynced \
+                        and time.monotonic() - self.last_sync >= self.fsync_interval:
+                    self.sync()
+
+    def needs_snapshot(self):
+        return self.snapshot_every and self.records >= self.snapshot_every
+
+    def write_snapshot(self, snapshot):
+        # Replace the snapshot file with snapshot, a DirectorySnapshot,
+        # then empty the journal. Called under the directory write lock.
+        # A crash in between leaves journal records the new snapshot
+        # already holds; load() skips them by version.
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(snapshot.getdir_bin_pkt())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.sync_dir()
+        with self.lock:
+            self.file.truncate(0)
+            self.size = 0
+            self.sync()
+            self.records = 0
+
+    def sync_dir(self):
+        # Make the rename itself durable (not possible on Windows).
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.dir_name, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.stop_syncing.set()
+        with self.lock:
+            if self.file is not None:
+                if self.fsync_every:
+                    self.sync()
+                self.file.close()
+                self.file = None
+
+########################################################################
@@ -0,0 +1,210 @@
+########################################################################
+#
+# Copy-on-write chat room directory for the CRDS server.
+#
+# The current directory is an immutable DirectorySnapshot: a version
+# number, the rooms, and the getdir response already encoded (the
+# binary getdirbin response is encoded on first request). Readers
+# just take self.snapshot (a single reference read, no lock) and can
+# use it for as long as they like. Writers serialise on write_lock,
+# build a new dict from the current one and publish a new snapshot
+# with the version bumped.
+#
+# Each snapshot also has its room names in sorted order, used to answer
+# searches: a prefix is a contiguous run found by bisection, and pages
+# are cut by name (the cursor is the last name returned), so a page
+# stays correct while rooms come and go between requests.
+#
+# With a DirectoryJournal attached every add and remove is journaled
+# before it is published, so the directory survives a restart.
+#
+# Subscribers are callbacks taking one encoded frame. subscribe() hands
+# a new subscriber the full binary listing, and every add or remove
+# then hands all subscribers a delta frame carrying the new version.
+# Both happen under write_lock, so a subscriber sees each version
+# exactly once and in order. Callbacks must not block.
+#
+########################################################################
+
+import bisect
+import threading
+from types import MappingProxyType
+
+import crds_protocol
+
+ENCODING = "utf-8"
+NO_ROOMS_MSG = "There are currently no rooms available."
+
+class DirectorySnapshot:
+
+    def __init__(self, version, rooms, names):
+        self.version = version
+        self.rooms = MappingProxyType(rooms) # name -> ChatRoom
+        self.names = names # sorted room names; never modified
+        self.getdir_pkt = self.encode_getdir()
+        self.binary_pkt = None
+
+    def getdir_bin_pkt(self):
+        # The binary listing is built on first use and kept with the
+        # snapshot. Two readers racing here both build the same bytes.
+        if self.binary_pkt is None:
+            self.binary_pkt = crds_protocol.pack_directory(self.rooms.values(), self.version)
+        return self.binary_pkt
+
+    def search(self, prefix="", contains="", descending=False, limit=50, after=""):
+        # Returns (rooms, cursor): up to limit matching rooms in name
+        # order, and the name to continue after, or "" if none are left.
+        names = self.names
+        if descending:
+            stop = bisect.bisect_left(names, prefix)
+            start = len(names) if not prefix else bisect.bisect_left(names, prefix + "\U0010ffff")
+            if after:
+                start = min(start, bisect.bisect_left(names, after))
+            indices = range(start - 1, stop - 1, -1)
+        else:
+            start = bisect.bisect_left(names, prefix)
+            if after:
+                start = max(start, bisect.bisect_right(names, after))
+            indices = range(start, len(names))
+        page = []
+        for i in indices:
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            if contains in name:
+                if len(page) == limit:
+                    return page, page[-1].name
+                page.append(self.rooms[name])
+        return page, ""
+
+    def encode_getdir(self):
+        pkt = "".join(f"{room.name}: ({room.ip}, {room.port})\n" for room in self.rooms.values())
+        if pkt == "":
+            pkt = NO_ROOMS_MSG
+        return pkt.encode(ENCODING)
+
+class DirectoryStore:
+
+    def __init__(self, journal=None, version=0, rooms=None):
+        # journal, if given, is a loaded DirectoryJournal; version and
+        # rooms are the directory it recovered.
+        rooms = {} if rooms is None else rooms
+        self.write_lock = threading.Lock()
+        self.snapshot = DirectorySnapshot(version, rooms, sorted(rooms))
+        self.subscribers = []
+        self.journal = journal
+
+    def publish(self, rooms, names=None):
+        # Caller must hold write_lock. names is the sorted index for
+        # rooms, if the caller already has it.
+        if names is None:
+            names = sorted(rooms)
+        self.snapshot = DirectorySnapshot(self.snapshot.version + 1, rooms, names)
+        return self.snapshot
+
+    def record(self, op, name, ip="0.0.0.0", port=0, version=None):
+        # Caller must hold write_lock. Journal the change about to be
+        # published as version (by default the next one) and return its
+        # delta frame, or None if nobody needs one. The journal goes
+        # first: if it fails nothing changes.
+        if self.journal is None and not self.subscribers:
+            return None
+        if version is None:
+            version = self.snapshot.version + 1
+        frame = crds_protocol.pack_delta(op, version, name, ip, port)
+        if self.journal is not None:
+            self.journal.append(frame)
+        return frame
+
+    def published(self, frame):
+        # Caller must hold write_lock, after publishing frame's change.
+        if self.subscribers:
+            self.notify(frame)
+        if self.journal is not None and self.journal.needs_snapshot():
+            try:
+                self.journal.write_snapshot(self.snapshot)
+            except OSError as msg:
+                # The change is journaled and published all the same,
+                # so it must not be reported as failed. The snapshot is
+                # tried again after the next change.
+                print(f"Could not write directory snapshot: {msg}")
+
+    def add(self, room):
+        with self.write_lock:
+            frame = self.record(crds_protocol.DELTA_ADD, room.name, room.ip, room.port)
+            rooms = dict(self.snapshot.rooms)
+            names = self.snapshot.names
+            if room.name not in rooms:
+                names = list(names)
+                bisect.insort(names, room.name)
+            rooms[room.name] = room
+            snapshot = self.publish(rooms, names)
+            self.published(frame)
+            return snapshot
+
+    def remove(self, name):
+        # Returns the new snapshot, or None if there was no such room.
+        with self.write_lock:
+            if name not in self.snapshot.rooms:
+                return None
+            frame = self.record(crds_protocol.DELTA_REMOVE, name)
+            rooms = dict(self.snapshot.rooms)
+            del rooms[name]
+            names = list(self.snapshot.names)
+            del names[bisect.bisect_left(names, name)]
+            snapshot = self.publish(rooms, names)
+            self.published(frame)
+            return snapshot
+
+    def remove_many(self, names):
+        # remove() for many rooms, copying the directory once. Each
+        # removal still has its own version, journal record and delta.
+        # Returns the names removed. If the journal fails, the removals
+        # journaled so far are published and the error raised.
+        with self.write_lock:
+            rooms = dict(self.snapshot.rooms)
+            version = self.snapshot.version
+            frames = []
+            removed = []
+            try:
+                for name in names:
+                    if name not in rooms:
+                        continue
+                    frames.append(self.record(crds_protocol.DELTA_REMOVE, name, version=version + 1))
+                    del rooms[name]
+                    removed.append(name)
+                    version += 1
+            finally:
+                if removed:
+                    gone = set(removed)
+                    names = [name for name in self.snapshot.names if name not in gone]
+                    self.snapshot = DirectorySnapshot(version, rooms, names)
+                    for frame in frames:
+                        self.published(frame)
+            return removed
+
+    def subscribe(self, callback):
+        with self.write_lock:
+            self.subscribers.append(callback)
+            callback(self.snapshot.getdir_bin_pkt())
+
+    def unsubscribe(self, callback):
+        with self.write_lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def close(self):
+        with self.write_lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def notify(self, frame):
+        # Caller must hold write_lock.
+        for callback in self.subscribers:
+            callback(frame)
+
+    def __len__(self):
+        return len(self.snapshot.rooms)
+
+########################################################################
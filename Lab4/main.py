@@ -3,10 +3,30 @@ import argparse
 import threading
 import time
 import random
+import select
+import selectors
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
-CMD = { "getdir": 1, "makeroom": 2, "deleteroom": 3}
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from directory_store import DirectoryStore, NO_ROOMS_MSG
+from directory_journal import DirectoryJournal
+from address_pool import AddressPool
+from chat_rooms import ChatRooms
+from room_history import RoomHistory
+from room_leases import RoomLeases
+import crds_protocol
+
+CMD = { "getdir": 1, "makeroom": 2, "deleteroom": 3, "getdirbin": 4, "subscribe": 5, "search": 6, "allocroom": 7,
+        "history": 8, "renew": 9}
+# Commands followed by newline terminated arguments.
+CMD_WITH_ARGS = (CMD["makeroom"], CMD["deleteroom"], CMD["search"], CMD["allocroom"], CMD["history"],
+                 CMD["renew"])
 CMD_FIELD_LEN = 1 # 1 byte commands sent from the client.
-USER_FILED_LEN = 64
 ENCODING = "utf-8"
 RX_IFACE_ADDRESS = "0.0.0.0"
 
@@ -18,72 +38,542 @@ class Server:
     RECV_SIZE = 1024
     BACKLOG = 5
 
-    def __init__(self):
-        self.next_room_id = 0
+    # Serving modes: a thread per connection, a bounded pool of worker
+    # threads, or a single selectors event loop.
+    MODES = ("thread", "pool", "select")
+    POOL_WORKERS = 32
+    MAX_CONNECTIONS = 10000
+    IDLE_TIMEOUT = 300
+    IDLE_SWEEP_INTERVAL = 1.0
+    SELECT_BACKLOG = 1024
+    # A subscriber this far behind on directory deltas is disconnected
+    # (frames queued in thread mode, bytes in pool and select modes).
+    MAX_PENDING_FRAMES = 4096
+    MAX_PENDING_BYTES = 1 << 20
+    SUBSCRIBER_POLL = 1.0
+    # Search page sizes.
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 1000
+    # Port of rooms given an address from the multicast pool.
+    ROOM_PORT = 40000
+    # Most seconds between lease sweeps.
+    SWEEP_INTERVAL = 1.0
+
+    def __init__(self, hostname=HOSTNAME, port=PORT, serve=True, mode="thread",
+                 max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                 workers=POOL_WORKERS, journal_dir=None,
+                 fsync_every=DirectoryJournal.FSYNC_EVERY,
+                 snapshot_every=DirectoryJournal.SNAPSHOT_EVERY,
+                 pool=AddressPool.NETWORK, room_port=ROOM_PORT, history=0, lease=0):
+        self.hostname = hostname
+        self.port = port
+        self.mode = mode
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.workers = workers
+        self.active_connections = 0
+        self.active_lock = threading.Lock()
+        self.running = True
         print("Running server")
-        self.directory = {} # A list of current chat rooms
+        # Current chat rooms, published as immutable versioned snapshots,
+        # and journaled to journal_dir if one is given.
+        self.directory = self.open_directory(journal_dir, fsync_every, snapshot_every)
+        # Multicast addresses handed out to rooms made without one, and
+        # the (ip, port) of every room. Both change only under
+        # allocation_lock, with the directory.
+        self.allocation_lock = threading.Lock()
+        self.addresses = AddressPool(pool)
+        self.room_port = room_port
+        self.room_addresses = {}
+        # Room leases, also under allocation_lock; rooms never expire
+        # if lease is 0. Recovered rooms start with a fresh lease.
+        self.leases = RoomLeases(lease) if lease > 0 else None
+        for room in self.directory.snapshot.rooms.values():
+            self.addresses.reserve(room.ip)
+            self.room_addresses[(room.ip, room.port)] = room.name
+            if self.leases is not None:
+                self.leases.grant(room.name)
+        # The last history messages of every room, for late joiners;
+        # none kept if 0.
+        self.history = None
+        if history > 0:
+            self.history = RoomHistory(history, RX_IFACE_ADDRESS)
+            self.directory.subscribe(self.history.update)
+        self.stop_sweeping = threading.Event()
+        if self.leases is not None:
+            threading.Thread(target=self.sweep_leases_forever, daemon=True).start()
+        if mode != "thread":
+            raise_fd_limit(max_connections + 64)
         self.create_listen_socket()
-        self.process_connections_forever()
+        if serve:
+            self.serve_forever()
+
+    def open_directory(self, journal_dir, fsync_every, snapshot_every):
+        if journal_dir is None:
+            return DirectoryStore()
+        journal = DirectoryJournal(journal_dir, fsync_every=fsync_every, snapshot_every=snapshot_every)
+        start = time.perf_counter()
+        version, recovered = journal.load()
+        rooms = {name: ChatRoom(name, ip, port) for name, (ip, port) in recovered.items()}
+        print(f"Recovered {len(rooms)} rooms (directory version {version}) "
+              f"in {time.perf_counter() - start:.3f} s.")
+        return DirectoryStore(journal, version, rooms)
+
+    def serve_forever(self):
+        try:
+            if self.mode == "select":
+                self.process_connections_select()
+            elif self.mode == "pool":
+                self.process_connections_pool()
+            else:
+                self.process_connections_forever()
+        finally:
+            if self.history is not None:
+                self.history.close()
+            self.directory.close()
 
     def create_listen_socket(self):
         try:
             # Create the TCP server listen socket in the usual way.
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.bind((Server.HOSTNAME, Server.PORT))
-            self.socket.listen(Server.BACKLOG)
-            print("Chat Room Directory Server listening on port {} ...".format(Server.PORT))
+            self.socket.bind((self.hostname, self.port))
+            self.socket.listen(Server.BACKLOG if self.mode == "thread" else Server.SELECT_BACKLOG)
+            # Port 0 asks the OS for a free port; record the real one.
+            self.port = self.socket.getsockname()[1]
+            print("Chat Room Directory Server listening on port {} ...".format(self.port))
         except Exception as msg:
             print(f"Error while creating listen socket: {msg}")
             exit()
     
     def process_connections_forever(self):
         try:
-            while True:
-                threading.Thread(target=self.connection_handler, args=(self.socket.accept(), )).start()
+            while self.running:
+                threading.Thread(target=self.connection_handler, args=(self.socket.accept(), ), daemon=True).start()
         except KeyboardInterrupt:
             print()
+        except OSError:
+            # The listen socket was closed by shutdown().
+            if self.running:
+                raise
         finally:
             self.socket.close()
+
+    def process_connections_pool(self):
+        # This thread waits, with a selector, for connections to send
+        # something. A connection that has is handed to one of `workers`
+        # threads, which carries out the commands it has sent and hands
+        # it back (see pool_service), so an idle connection holds no
+        # worker. Subscribers stay with this thread, which writes their
+        # pushes as select mode does, and count towards max_connections
+        # like any other connection. Beyond max_connections new
+        # connections are refused, and a connection (other than a
+        # subscriber) idle for idle_timeout is closed.
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.socket.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ, None)
+        # Workers hand connections back through pool_returns, and
+        # subscriber pushes arrive through pool_pushes; both wake the
+        # selector with wake_loop.
+        self.pool_returns = queue.SimpleQueue()
+        self.pool_pushes = queue.SimpleQueue()
+        wake = self.open_loop_wake(selector)
+        connections = {} # connection -> SelectConnection, in the selector or with a worker
+        last_sweep = time.monotonic()
+        try:
+            while self.running:
+                for key, mask in selector.select(Server.IDLE_SWEEP_INTERVAL):
+                    if key.data is None:
+                        self.pool_accept(selector, connections)
+                    elif key.data is wake:
+                        self.drain_loop_wake(wake)
+                    elif key.data.push is not None:
+                        self.pool_subscriber_ready(selector, key.fileobj, key.data, mask, connections)
+                    else:
+                        selector.unregister(key.fileobj)
+                        pool.submit(self.pool_service, key.fileobj, key.data)
+                self.pool_take_returns(selector, connections)
+                self.pool_take_pushes(selector, connections)
+                now = time.monotonic()
+                if now - last_sweep >= Server.IDLE_SWEEP_INTERVAL:
+                    for connection, state in list(connections.items()):
+                        if (state.push is None and selector.get_map().get(connection) is not None
+                                and now - state.last_active > self.idle_timeout):
+                            print("Closing idle client connection ...")
+                            selector.unregister(connection)
+                            self.pool_close(connection, connections)
+                    last_sweep = now
+        except KeyboardInterrupt:
+            print()
+        except OSError:
+            if self.running:
+                raise
+        finally:
+            pool.shutdown(wait=False)
+            for connection in list(connections):
+                self.pool_close(connection, connections)
+            selector.close()
+            wake.close()
+            self.loop_wake.close()
+            self.socket.close()
+
+    def open_loop_wake(self, selector):
+        # A socketpair through which other threads wake the selector
+        # loop (pool and select modes). Registers the loop's end, with
+        # itself as data, and returns it.
+        wake, self.loop_wake = socket.socketpair()
+        wake.setblocking(False)
+        self.loop_wake.setblocking(False)
+        selector.register(wake, selectors.EVENT_READ, wake)
+        self.wake_pending = False
+        return wake
+
+    def wake_loop(self):
+        # Any thread. Only the first call until the loop next drains
+        # the wake socket writes to it.
+        if self.wake_pending:
+            return
+        self.wake_pending = True
+        try:
+            self.loop_wake.send(b"\0")
+        except OSError:
+            # Already awake (the socket buffer is full), or shutting
+            # down.
+            pass
+
+    def drain_loop_wake(self, wake):
+        # Read the wake byte, then clear wake_pending, both before the
+        # loop takes what it was woken for. Anything added before the
+        # flag is cleared is taken now; anything after sends a new byte.
+        try:
+            wake.recv(Server.RECV_SIZE)
+        except BlockingIOError:
+            pass
+        self.wake_pending = False
+
+    def pool_accept(self, selector, connections):
+        while True:
+            try:
+                connection, address = self.socket.accept()
+            except BlockingIOError:
+                return
+            if len(connections) >= self.max_connections:
+                connection.close()
+                continue
+            print("-" * 72)
+            print(f"Connection received from {address[0]} on port {address[1]}.")
+            # Blocking, so a worker can sendall, but never stuck on a
+            # client for longer than idle_timeout.
+            connection.settimeout(self.idle_timeout)
+            state = SelectConnection()
+            connections[connection] = state
+            with self.active_lock:
+                self.active_connections += 1
+            selector.register(connection, selectors.EVENT_READ, state)
+
+    def pool_service(self, connection, state):
+        # Runs on a worker: read what the connection has sent and carry
+        # out its complete commands. The connection then goes back to
+        # the selector ("wait"), is closed ("close"), or goes back as a
+        # subscriber ("subscribed").
+        outcome = "wait"
+        try:
+            recvd = connection.recv(Server.RECV_SIZE)
+            if len(recvd) == 0:
+                print("Connection closed by client.")
+                outcome = "close"
+            else:
+                state.last_active = time.monotonic()
+                state.inbuf += recvd
+                for cmd, args in state.take_commands():
+                    if cmd == CMD["subscribe"]:
+                        # Push only from here on; later input is ignored.
+                        print("Received subscribe command.")
+                        state.inbuf.clear()
+                        outcome = "subscribed"
+                        break
+                    pkt = self.process_command(cmd, args)
+                    if pkt is not None:
+                        connection.sendall(pkt)
+        except OSError:
+            print("Closing client connection ...")
+            outcome = "close"
+        self.pool_returns.put((connection, outcome))
+        self.wake_loop()
+
+    def pool_take_returns(self, selector, connections):
+        while True:
+            try:
+                connection, outcome = self.pool_returns.get_nowait()
+            except queue.Empty:
+                return
+            state = connections.get(connection)
+            if state is None:
+                continue
+            if outcome == "wait":
+                selector.register(connection, selectors.EVENT_READ, state)
+            elif outcome == "close":
+                self.pool_close(connection, connections)
+            else:
+                self.pool_subscribe(selector, connection, state)
+
+    def pool_subscribe(self, selector, connection, state):
+        # From here on this thread does all of the connection's I/O.
+        connection.setblocking(False)
+
+        def push(frame):
+            # Runs under the directory write lock, on whichever thread
+            # changed the directory; leave the frame to the loop.
+            self.pool_pushes.put((connection, frame))
+            self.wake_loop()
+
+        state.push = push
+        selector.register(connection, selectors.EVENT_READ, state)
+        self.directory.subscribe(push)
+
+    def pool_take_pushes(self, selector, connections):
+        pushed = set()
+        while True:
+            try:
+                connection, frame = self.pool_pushes.get_nowait()
+            except queue.Empty:
+                break
+            state = connections.get(connection)
+            if state is not None:
+                state.outbuf += frame
+                pushed.add(connection)
+        for connection in pushed:
+            state = connections[connection]
+            if len(state.outbuf) > Server.MAX_PENDING_BYTES:
+                print("Subscriber fell behind, disconnecting.")
+                selector.unregister(connection)
+                self.pool_close(connection, connections)
+            else:
+                self.pool_flush(selector, connection, state, connections)
+
+    def pool_subscriber_ready(self, selector, connection, state, mask, connections):
+        if mask & selectors.EVENT_READ:
+            try:
+                recvd = connection.recv(Server.RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                recvd = None
+            except OSError:
+                recvd = b""
+            if recvd == b"":
+                print("Closing subscriber connection ...")
+                selector.unregister(connection)
+                self.pool_close(connection, connections)
+                return
+        self.pool_flush(selector, connection, state, connections)
+
+    def pool_flush(self, selector, connection, state, connections):
+        # Write what a subscriber's socket takes, and wait for it to
+        # become writable while there is more.
+        if state.outbuf:
+            try:
+                sent = connection.send(state.outbuf)
+                del state.outbuf[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                print("Closing subscriber connection ...")
+                selector.unregister(connection)
+                self.pool_close(connection, connections)
+                return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if state.outbuf else 0)
+        if events != state.events:
+            state.events = events
+            selector.modify(connection, events, state)
+
+    def pool_close(self, connection, connections):
+        state = connections.pop(connection)
+        if state.push is not None:
+            self.directory.unsubscribe(state.push)
+        with self.active_lock:
+            self.active_connections -= 1
+        connection.close()
+
+    def process_connections_select(self):
+        # One thread serves every connection. Each connection has an
+        # input buffer (commands may arrive split or several at once)
+        # and an output buffer written as the socket becomes writable.
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.select_connections = {}
+        # Frames pushed to subscribers, queued by whichever thread
+        # changed the directory (see select_subscribe).
+        self.select_pushes = queue.SimpleQueue()
+        wake = self.open_loop_wake(self.selector)
+        last_sweep = time.monotonic()
+        try:
+            while self.running:
+                for key, mask in self.selector.select(Server.IDLE_SWEEP_INTERVAL):
+                    if key.data is None:
+                        self.select_accept()
+                    elif key.data is wake:
+                        self.drain_loop_wake(wake)
+                    else:
+                        self.select_service(key.fileobj, key.data, mask)
+                self.select_take_pushes()
+                now = time.monotonic()
+                if now - last_sweep >= Server.IDLE_SWEEP_INTERVAL:
+                    self.select_sweep_idle(now)
+                    last_sweep = now
+        except KeyboardInterrupt:
+            print()
+        except OSError:
+            if self.running:
+                raise
+        finally:
+            for connection in list(self.select_connections):
+                self.select_close(connection)
+            self.selector.close()
+            wake.close()
+            self.loop_wake.close()
+            self.socket.close()
+
+    def select_accept(self):
+        while True:
+            try:
+                connection, address = self.socket.accept()
+            except BlockingIOError:
+                return
+            if len(self.select_connections) >= self.max_connections:
+                connection.close()
+                continue
+            connection.setblocking(False)
+            state = SelectConnection()
+            self.select_connections[connection] = state
+            self.selector.register(connection, selectors.EVENT_READ, state)
+
+    def select_service(self, connection, state, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                recvd = connection.recv(Server.RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                recvd = None
+            except OSError:
+                recvd = b""
+            if recvd == b"":
+                self.select_close(connection)
+                return
+            if recvd and state.push is None:
+                state.last_active = time.monotonic()
+                state.inbuf += recvd
+                for cmd, args in state.take_commands():
+                    if cmd == CMD["subscribe"]:
+                        # Push only from here on; later input is ignored.
+                        print("Received subscribe command.")
+                        self.select_subscribe(connection, state)
+                        break
+                    pkt = self.process_command(cmd, args)
+                    if pkt is not None:
+                        state.outbuf += pkt
+        if state.outbuf:
+            try:
+                sent = connection.send(state.outbuf)
+                del state.outbuf[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self.select_close(connection)
+                return
+        self.select_update_events(connection, state)
+
+    def select_update_events(self, connection, state):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if state.outbuf else 0)
+        if events != state.events:
+            state.events = events
+            self.selector.modify(connection, events, state)
+
+    def select_subscribe(self, connection, state):
+        state.inbuf.clear()
+
+        def push(frame):
+            # Runs under the directory write lock, on the loop or on the
+            # lease sweeper's thread. Only the loop touches outbuf (it
+            # may be in the middle of sending it), so queue the frame.
+            self.select_pushes.put((connection, frame))
+            self.wake_loop()
+
+        state.push = push
+        self.directory.subscribe(push)
+
+    def select_take_pushes(self):
+        pushed = set()
+        while True:
+            try:
+                connection, frame = self.select_pushes.get_nowait()
+            except queue.Empty:
+                break
+            state = self.select_connections.get(connection)
+            if state is not None:
+                state.outbuf += frame
+                pushed.add(connection)
+        for connection in pushed:
+            state = self.select_connections[connection]
+            if len(state.outbuf) > Server.MAX_PENDING_BYTES:
+                print("Subscriber fell behind, disconnecting.")
+                self.select_close(connection)
+            else:
+                self.select_update_events(connection, state)
+
+    def select_sweep_idle(self, now):
+        for connection, state in list(self.select_connections.items()):
+            if state.push is None and now - state.last_active > self.idle_timeout:
+                self.select_close(connection)
+
+    def select_close(self, connection):
+        self.selector.unregister(connection)
+        state = self.select_connections.pop(connection)
+        if state.push is not None:
+            self.directory.unsubscribe(state.push)
+        connection.close()
+
+    def shutdown(self):
+        self.running = False
+        self.stop_sweeping.set()
+        try:
+            # Wakes up a thread blocked in accept().
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        if self.history is not None:
+            self.history.close()
+        self.directory.close()
     
     def connection_handler(self, client):
         connection, address = client
         print("-" * 72)
         print(f"Connection received from {address[0]} on port {address[1]}.")
 
+        # Command arguments are newline terminated, so read through a
+        # buffered reader; a command sent right behind another must not
+        # be swallowed into its arguments.
+        reader = connection.makefile('rb')
+
         while True:
-            recvd = connection.recv(CMD_FIELD_LEN)
+            recvd = reader.read(CMD_FIELD_LEN)
             if len(recvd) == 0:
                 print("Connection closed by client.")
+                reader.close()
                 connection.close()
                 return
 
             cmd = int.from_bytes(recvd, byteorder='big')
-            
-            if cmd == CMD["getdir"]:
-                # Get and parse directory infor into packet for transmission
-                print("Received getdir command.")
-                pkt = ""
-                for entry in self.get_dir():
-                    pkt += f"{entry[0]}: ({entry[1]}, {entry[2]})\n"
-                if pkt == "":
-                    pkt = "There are currently no rooms available."
-                pkt = pkt.encode(ENCODING)
-
-            elif cmd == CMD["makeroom"]:
-                print("Received makeroom command.")
-                recv_bytes = connection.recv(Server.RECV_SIZE)
-                recv_str = recv_bytes.decode(ENCODING)
-                args = recv_str.split()
-                self.create_room(args[0], args[1], args[2])
-                pkt = None
-
-            elif cmd == CMD["deleteroom"]:
-                recv_bytes = connection.recv(Server.RECV_SIZE)
-                recv_str = recv_bytes.decode(ENCODING)
-                args = recv_str.split()
-                self.destroy_room(args[0])
-                pkt = None
+            if cmd == CMD["subscribe"]:
+                print("Received subscribe command.")
+                self.serve_subscription(connection)
+                reader.close()
+                return
+            args = []
+            if cmd in CMD_WITH_ARGS:
+                args = reader.readline(Server.RECV_SIZE).decode(ENCODING).split()
+            pkt = self.process_command(cmd, args)
+
             try:
                 # Send the packet to the connected client.
                 if pkt != None:
@@ -97,17 +587,265 @@ class Server:
                 connection.close()
                 return
 
+    def serve_subscription(self, connection):
+        # The connection only carries pushes from here on: the current
+        # listing, then a delta frame per change. This holds a thread for
+        # as long as the client stays subscribed.
+        pending = queue.Queue()
+
+        def push(frame):
+            # Runs under the directory write lock; never block there.
+            pending.put(frame if pending.qsize() < Server.MAX_PENDING_FRAMES else None)
+
+        self.directory.subscribe(push)
+        try:
+            while self.running:
+                try:
+                    frame = pending.get(timeout=Server.SUBSCRIBER_POLL)
+                except queue.Empty:
+                    # Nothing to send; notice a client that went away.
+                    if select.select([connection], [], [], 0)[0] and not connection.recv(Server.RECV_SIZE):
+                        break
+                    continue
+                if frame is None:
+                    print("Subscriber fell behind, disconnecting.")
+                    break
+                connection.sendall(frame)
+        except OSError:
+            pass
+        finally:
+            self.directory.unsubscribe(push)
+            print("Closing subscriber connection ...")
+            connection.close()
+
+    def process_command(self, cmd, args):
+        # Carry out one command and return the response, if any.
+        if cmd == CMD["getdir"]:
+            # The current snapshot carries the encoded directory.
+            print("Received getdir command.")
+            return self.directory.snapshot.getdir_pkt
+
+        elif cmd == CMD["getdirbin"]:
+            # Length prefixed binary listing; see crds_protocol.
+            print("Received getdirbin command.")
+            return self.directory.snapshot.getdir_bin_pkt()
+
+        elif cmd == CMD["search"]:
+            print("Received search command.")
+            return self.search(args)
+
+        elif cmd == CMD["makeroom"]:
+            print("Received makeroom command.")
+            if len(args) in (1, 3):
+                self.create_room(*args)
+
+        elif cmd == CMD["allocroom"]:
+            # makeroom with a reply saying how it went.
+            print("Received allocroom command.")
+            if len(args) not in (1, 3):
+                return crds_protocol.pack_room_reply(crds_protocol.ROOM_INVALID)
+            # The lease tells the creator how often to renew.
+            lease = 0.0 if self.leases is None else self.leases.lease
+            return crds_protocol.pack_room_reply(*self.create_room(*args), lease=lease)
+
+        elif cmd == CMD["history"]:
+            print("Received history command.")
+            if self.history is None or len(args) != 1:
+                return crds_protocol.pack_history([])
+            return crds_protocol.pack_history(self.history.messages(args[0]))
+
+        elif cmd == CMD["renew"]:
+            # Heartbeat from a room's creator; no reply.
+            print("Received renew command.")
+            self.renew_rooms(args)
+
+        elif cmd == CMD["deleteroom"]:
+            if len(args) == 1:
+                self.destroy_room(args[0])
+        return None
+
+    def search(self, args):
+        # args are key=value terms: prefix, contains, order (asc or
+        # desc), limit and after (the cursor from the previous page).
+        # Bad terms get an empty last page rather than no reply.
+        snapshot = self.directory.snapshot
+        terms = dict(arg.partition("=")[::2] for arg in args)
+        try:
+            limit = int(terms.get("limit", Server.PAGE_SIZE))
+            if not 1 <= limit <= Server.MAX_PAGE_SIZE or terms.get("order", "asc") not in ("asc", "desc"):
+                raise ValueError(f"bad search terms {args}")
+        except ValueError as msg:
+            print(f"Invalid search: {msg}")
+            return crds_protocol.pack_page([], snapshot.version, "")
+        rooms, cursor = snapshot.search(prefix=terms.get("prefix", ""),
+                                        contains=terms.get("contains", ""),
+                                        descending=terms.get("order") == "desc",
+                                        limit=limit,
+                                        after=terms.get("after", ""))
+        return crds_protocol.pack_page(rooms, snapshot.version, cursor)
+
     def get_dir(self):
-        arr = []
-        for room in self.directory.values():
-            arr.append(room.get_info())
-        return arr
+        return [room.get_info() for room in self.directory.snapshot.rooms.values()]
+
+    def create_room(self, name, address=None, port=None):
+        # Without an address the room gets the next free one from the
+        # pool. Returns (status, ip, port), the status one of the
+        # crds_protocol ROOM_ codes.
+        if address is not None:
+            # Rooms must fit the binary listing: an IPv4 address and a
+            # 16 bit port. Pool addresses are only given out here.
+            try:
+                socket.inet_aton(address)
+                room = ChatRoom(name, address, port)
+                if not 0 <= room.port <= 0xFFFF:
+                    raise ValueError(f"port {room.port} out of range")
+                if self.addresses.room_id(address) is not None:
+                    raise ValueError(f"{address} is in the allocation pool")
+            except (OSError, ValueError) as msg:
+                print(f"Invalid room {name}: {msg}")
+                return (crds_protocol.ROOM_INVALID, "0.0.0.0", 0)
+
+        with self.allocation_lock:
+            if name in self.directory.snapshot.rooms:
+                print(f"Room {name} already exists.")
+                return (crds_protocol.ROOM_NAME_TAKEN, "0.0.0.0", 0)
+            if address is None:
+                address = self.addresses.allocate()
+                if address is None:
+                    print(f"No multicast address left for room {name}.")
+                    return (crds_protocol.ROOM_POOL_EXHAUSTED, "0.0.0.0", 0)
+                room = ChatRoom(name, address, self.room_port)
+            elif (room.ip, room.port) in self.room_addresses:
+                print(f"Address {room.ip}:{room.port} is already used by room "
+                      f"{self.room_addresses[(room.ip, room.port)]}.")
+                return (crds_protocol.ROOM_ADDRESS_IN_USE, "0.0.0.0", 0)
+            try:
+                self.directory.add(room)
+            except OSError as msg:
+                # Only the journal append raises, and then the room was
+                # never published, so its address is free again.
+                print(f"Could not journal room {name}: {msg}")
+                self.addresses.free(room.ip)
+                return (crds_protocol.ROOM_INVALID, "0.0.0.0", 0)
+            self.room_addresses[(room.ip, room.port)] = name
+            if self.leases is not None:
+                self.leases.grant(name)
+        return (crds_protocol.ROOM_OK, room.ip, room.port)
 
-    def create_room(self, name, address, port):
-        self.directory[name] = ChatRoom(name, address, port)
-    
     def destroy_room(self, name):
-        self.directory.pop(name)
+        with self.allocation_lock:
+            return self.remove_room(name)
+
+    def remove_room(self, name):
+        # The caller holds allocation_lock. Returns whether the room was
+        # removed; it is not if it could not be journaled.
+        room = self.directory.snapshot.rooms.get(name)
+        if room is None:
+            print(f"No room named {name} to delete.")
+            return False
+        try:
+            self.directory.remove(name)
+        except OSError as msg:
+            print(f"Could not journal removal of room {name}: {msg}")
+            return False
+        self.room_addresses.pop((room.ip, room.port), None)
+        self.addresses.free(room.ip)
+        if self.leases is not None:
+            self.leases.release(name)
+        return True
+
+    def remove_rooms(self, names):
+        # remove_room() for many rooms in one directory update. The
+        # caller holds allocation_lock. Returns the names removed; the
+        # others are given a new lease, to be tried again.
+        rooms = self.directory.snapshot.rooms
+        try:
+            removed = self.directory.remove_many(names)
+        except OSError as msg:
+            print(f"Could not journal removal of expired rooms: {msg}")
+            removed = [name for name in names if name in rooms and name not in self.directory.snapshot.rooms]
+        for name in removed:
+            room = rooms[name]
+            self.room_addresses.pop((room.ip, room.port), None)
+            self.addresses.free(room.ip)
+            self.leases.release(name)
+        for name in names:
+            if name in self.directory.snapshot.rooms and name not in self.leases.expiry:
+                self.leases.grant(name)
+        return removed
+
+    def renew_rooms(self, names):
+        if self.leases is None:
+            return
+        with self.allocation_lock:
+            for name in names:
+                if not self.leases.renew(name):
+                    print(f"No lease on room {name} to renew.")
+
+    def sweep_leases_forever(self):
+        interval = min(Server.SWEEP_INTERVAL, self.leases.lease / 4)
+        while not self.stop_sweeping.wait(interval):
+            self.sweep_leases()
+
+    def sweep_leases(self, now=None):
+        # Delete the rooms whose leases have run out; returns how many.
+        start = time.perf_counter()
+        with self.allocation_lock:
+            names = self.leases.expired(now)
+            if names:
+                names = self.remove_rooms(names)
+        seconds = time.perf_counter() - start
+        self.leases.record_sweep(len(names), seconds)
+        if names:
+            print(f"Lease sweep: {len(names)} rooms expired in {seconds * 1000:.3f} ms; "
+                  f"{len(self.directory)} rooms in the directory; "
+                  f"{self.leases.evicted} expired in {self.leases.sweeps} sweeps taking "
+                  f"{self.leases.sweep_seconds * 1000:.3f} ms in all (longest {self.leases.max_sweep_seconds * 1000:.3f} ms).")
+        return len(names)
+
+class SelectConnection:
+
+    # Per connection state for the selector loop serving modes.
+
+    def __init__(self):
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.events = selectors.EVENT_READ
+        self.last_active = time.monotonic()
+        # Set once the connection subscribes to directory deltas.
+        self.push = None
+
+    def take_commands(self):
+        # Yield (cmd, args) for every complete command in inbuf.
+        while self.inbuf:
+            cmd = self.inbuf[0]
+            if cmd not in CMD_WITH_ARGS:
+                del self.inbuf[:CMD_FIELD_LEN]
+                yield cmd, []
+                continue
+            end = self.inbuf.find(b"\n", CMD_FIELD_LEN)
+            if end == -1:
+                if len(self.inbuf) > Server.RECV_SIZE:
+                    # Overlong arguments, as readline() would cut them.
+                    end = Server.RECV_SIZE
+                else:
+                    return
+            args = bytes(self.inbuf[CMD_FIELD_LEN:end]).decode(ENCODING, errors="replace").split()
+            del self.inbuf[:end + 1]
+            yield cmd, args
+
+def raise_fd_limit(wanted):
+    # Many connections need many file descriptors; raise the soft
+    # limit as far as the hard limit allows.
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+        except (ValueError, OSError):
+            pass
 
 class ChatRoom:
 
@@ -126,12 +864,33 @@ class Client:
     TTL = 1
     RECV_SIZE = 1024
     CLI_MODES = {"CRDS": 1, "CHAT": 2, "NC": 3}
-    def __init__(self):
+    # Most seconds between renews of our rooms' leases. A server with
+    # a shorter lease (given in its allocroom reply) is renewed
+    # RENEWS_PER_LEASE times a lease.
+    RENEW_INTERVAL = 30.0
+    RENEWS_PER_LEASE = 3
+    def __init__(self, reliable=False):
         self.username = f"User{random.randint(0, 100)}"
+        # NACK retransmission and in-order delivery in chat rooms.
+        self.reliable = reliable
         self.get_socket()
         self.mode = Client.CLI_MODES["NC"]
-        self.chatroom = None
+        # Chat rooms we are in; made on the first chat.
+        self.chat_rooms = None
+        # Rooms we made, whose leases we renew while connected.
+        self.my_rooms = set()
+        self.renew_stop = None
+        self.renew_interval = Client.RENEW_INTERVAL
         self.room_name = ""
+        self.server_address = (Server.HOSTNAME, Server.PORT)
+        # Local copy of the directory kept current by a subscription;
+        # None when not subscribed.
+        self.room_cache = None
+        self.room_cache_version = 0
+        self.sub_socket = None
+        # Last search, so "more" can fetch its next page.
+        self.search_terms = []
+        self.search_cursor = ""
         self.nc_prompt()
 
     def crds_prompt(self):
@@ -171,9 +930,18 @@ class Client:
                     return None
                 elif (cmd.lower() == "getdir"):
                     self.handle_getdir_command()
+                elif (cmd.lower() == "search"):
+                    self.handle_search_command(inputs[1:])
+                elif (cmd.lower() == "more"):
+                    if self.search_cursor:
+                        self.handle_search_command(self.search_terms + [f"after={self.search_cursor}"], more=True)
+                    else:
+                        print("No more results.")
+                elif (cmd.lower() == "subscribe"):
+                    self.handle_subscribe_command()
                 elif (cmd.lower() == "makeroom"):
                     try:
-                        self.handle_makeroom_command(args[0], args[1], args[2])
+                        self.handle_makeroom_command(*args[:3])
                     except:
                         print("Invalid arguments. Try agian.")
                 elif (cmd.lower() == "deleteroom"):
@@ -182,32 +950,41 @@ class Client:
                     except:
                         print("Invalid arguments. Try agian.")
                 elif (cmd.lower() == "chat"):
-                    rooms = self.handle_getdir_command(parse=True)
+                    # Resolve from the subscribed cache when there is
+                    # one, otherwise fetch the directory.
+                    rooms = self.room_cache
+                    if rooms is None:
+                        rooms = self.handle_getdir_command(parse=True)
                     room = rooms.get(args[0])
                     if room != None:
                         self.room_name = args[0]
                         self.handle_chat(room)
                     else:
                         print("Invalid room name. Please try again.")
+                elif (cmd.lower() == "rooms"):
+                    self.handle_rooms_command()
+                elif (cmd.lower() == "leave"):
+                    try:
+                        self.handle_leave_command(args[0])
+                    except:
+                        print("Invalid arguments. Try agian.")
                 else:
                     print("Invalid command. Please try again.")
             return True  
 
-    def chat_prompt(self, output_lock, room):
-        print(f"You have entered chat room {self.room_name}. Enter '^q' to return to main prompt.")
+    def chat_prompt(self):
+        print(f"You have entered chat room {self.room_name}. Enter '^q' to leave it and return to main prompt,")
+        print("or '^b' to return to main prompt and stay in it.")
         print(f"[{self.username}|{self.room_name}] Type a message and press enter to send.\n")
         while True:
             self.user_input = input()
             print(f"\033[A[you|{self.room_name}]: {self.user_input}")
             if self.user_input == "^q":
+                self.chat_rooms.leave(self.room_name)
                 break
-            # build packet
-            name_field = self.username.ljust(USER_FILED_LEN).encode(ENCODING)
-            msg = self.user_input.encode(ENCODING)
-
-            pkt = name_field + msg
-
-            self.chat_send_socket.sendto(pkt, room)
+            if self.user_input == "^b":
+                break
+            self.chat_rooms.send(self.room_name, self.user_input)
 
     def get_socket(self):
         try:
@@ -219,6 +996,7 @@ class Client:
     def connect_to_server(self, ip=Server.HOSTNAME, port=Server.PORT):
         try:
             self.socket.connect((ip, port))
+            self.server_address = (ip, port)
             print(f"Connected to server at {ip}:{port}")
         except Exception as msg:
             print(msg)
@@ -226,103 +1004,233 @@ class Client:
 
     def handle_getdir_command(self, parse=False):
         # Build and send the command packet
-        pkt = CMD["getdir"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+        pkt = CMD["getdirbin"].to_bytes(CMD_FIELD_LEN, byteorder='big')
         self.socket.sendall(pkt)
 
-        # Await response
-        recv_bytes = self.socket.recv(Client.RECV_SIZE)
-        recv_str = recv_bytes.decode(ENCODING)
+        # Await the length prefixed response and read all of it.
+        response = crds_protocol.recv_directory(self.socket)
+        if response is None:
+            print("Server closed the connection.")
+            return {}
+        version, rooms = response
 
         if not parse:
-            print(f"Recieved response from server:\n{recv_str}")
-        
+            listing = "".join(f"{name}: ({ip}, {port})\n" for name, (ip, port) in rooms.items())
+            print(f"Recieved response from server (directory version {version}):\n{listing or NO_ROOMS_MSG}")
+
         if parse:
-            rooms = recv_str.split("\n")
-            rooms_dict = {}
-            for room in rooms:
-                if len(room) > 0:
-                    name, address = room.split(":")
-                    ip, port = address.lstrip()[1:-1].split(", ")
-                    rooms_dict[name] = (ip, int(port))
-            return rooms_dict
-            
-
-    def handle_makeroom_command(self, name, ip, port):
-        # Build and send the command packet
-        cmd_field = CMD["makeroom"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+            return rooms
+
+    def handle_search_command(self, terms, more=False):
+        # e.g. search prefix=lab order=desc limit=20, then more for the
+        # next page.
+        args_field = (" ".join(terms) + "\n").encode(ENCODING)
+        self.socket.sendall(CMD["search"].to_bytes(CMD_FIELD_LEN, byteorder='big') + args_field)
+        payload = crds_protocol.recv_frame(self.socket)
+        if payload is None:
+            print("Server closed the connection.")
+            return {}
+        version, rooms, cursor = crds_protocol.unpack_page(payload)
+        if not more:
+            self.search_terms = terms
+        self.search_cursor = cursor
+        for name, (ip, port) in rooms.items():
+            print(f"{name}: ({ip}, {port})")
+        if not rooms:
+            print("No matching rooms.")
+        elif cursor:
+            print("Enter 'more' for the next page.")
+        return rooms
+
+    def handle_subscribe_command(self):
+        # Subscribe on a second connection, so the pushed frames never
+        # interleave with responses on the command connection.
+        if self.room_cache is not None:
+            print(f"Already subscribed (directory version {self.room_cache_version}).")
+            return
+        try:
+            self.sub_socket = socket.create_connection(self.server_address)
+            self.sub_socket.sendall(CMD["subscribe"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+            response = crds_protocol.recv_directory(self.sub_socket)
+        except OSError as msg:
+            print(f"Error while subscribing: {msg}")
+            return
+        if response is None:
+            print("Server closed the subscription.")
+            return
+        self.room_cache_version, self.room_cache = response
+        print(f"Subscribed to directory version {self.room_cache_version} ({len(self.room_cache)} rooms).")
+        threading.Thread(target=self.subscription_thread, args=(self.sub_socket, self.room_cache), daemon=True).start()
+
+    def subscription_thread(self, sub_socket, rooms):
+        # Apply pushed deltas to the cache. Versions must follow on
+        # exactly; on a gap or a lost connection drop the cache so chat
+        # goes back to fetching the directory.
+        try:
+            while True:
+                payload = crds_protocol.recv_frame(sub_socket)
+                if payload is None:
+                    break
+                op, version, name, ip, port = crds_protocol.unpack_delta(payload)
+                if version != self.room_cache_version + 1:
+                    print(f"Directory version jumped from {self.room_cache_version} to {version}; unsubscribing.")
+                    break
+                if op == crds_protocol.DELTA_ADD:
+                    rooms[name] = (ip, port)
+                else:
+                    rooms.pop(name, None)
+                self.room_cache_version = version
+        except (OSError, ValueError):
+            pass
+        if self.room_cache is rooms:
+            self.room_cache = None
+        sub_socket.close()
+
+    def close_subscription(self):
+        self.room_cache = None
+        if self.sub_socket is not None:
+            try:
+                # Wakes up the subscription thread blocked in recv.
+                self.sub_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sub_socket.close()
+            self.sub_socket = None
 
-        args_field = f"{name} {ip} {port}".encode(ENCODING)
+    def handle_makeroom_command(self, name, ip=None, port=None):
+        # Without ip and port the server picks the address. Returns the
+        # room's (ip, port), or None if it was not made.
+        cmd_field = CMD["allocroom"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+
+        args = name if ip is None else f"{name} {ip} {port}"
+        args_field = f"{args}\n".encode(ENCODING)
         pkt = cmd_field + args_field
 
         self.socket.sendall(pkt)
+        payload = crds_protocol.recv_frame(self.socket)
+        if payload is None:
+            print("Server closed the connection.")
+            return None
+        status, ip, port, lease = crds_protocol.unpack_room_reply(payload)
+        if status != crds_protocol.ROOM_OK:
+            print(f"{crds_protocol.ROOM_STATUS_MSG.get(status, 'Room not created')}.")
+            return None
+        print(f"Room {name} created at ({ip}, {port}).")
+        self.my_rooms.add(name)
+        if lease > 0:
+            interval = min(Client.RENEW_INTERVAL, lease / Client.RENEWS_PER_LEASE)
+            if interval < self.renew_interval and self.renew_stop is not None:
+                # Don't let the renew thread sleep out the old interval.
+                self.renew_stop.set()
+                self.renew_stop = None
+            self.renew_interval = interval
+        self.start_renewing()
+        return (ip, port)
 
     def handle_deleteroom_command(self, name):
         # Build and send the command packet
         cmd_field = CMD["deleteroom"].to_bytes(CMD_FIELD_LEN, byteorder='big')
 
-        args_field = name.encode(ENCODING)
+        args_field = f"{name}\n".encode(ENCODING)
         pkt = cmd_field + args_field
 
         self.socket.sendall(pkt)
+        self.my_rooms.discard(name)
+
+    def start_renewing(self):
+        if self.renew_stop is None:
+            self.renew_stop = threading.Event()
+            threading.Thread(target=self.renew_thread, args=(self.renew_stop,), daemon=True).start()
+
+    def stop_renewing(self):
+        self.my_rooms.clear()
+        if self.renew_stop is not None:
+            self.renew_stop.set()
+            self.renew_stop = None
+
+    def renew_thread(self, stop):
+        # Renew our rooms' leases every renew_interval, on a connection
+        # of its own so the renews never get between a command and its
+        # reply. On an error, reconnect next time round.
+        sock = None
+        while not stop.wait(self.renew_interval):
+            names = list(self.my_rooms)
+            if not names:
+                continue
+            try:
+                if sock is None:
+                    sock = socket.create_connection(self.server_address)
+                for pkt in self.renew_packets(names):
+                    sock.sendall(pkt)
+            except OSError:
+                if sock is not None:
+                    sock.close()
+                sock = None
+        if sock is not None:
+            sock.close()
+
+    def renew_packets(self, names):
+        # As many names per renew as fit the server's argument line.
+        cmd_field = CMD["renew"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+        line = []
+        length = 0
+        for name in names:
+            name_len = len(name.encode(ENCODING)) + 1
+            if line and length + name_len >= Server.RECV_SIZE:
+                yield cmd_field + (" ".join(line) + "\n").encode(ENCODING)
+                line, length = [], 0
+            line.append(name)
+            length += name_len
+        if line:
+            yield cmd_field + (" ".join(line) + "\n").encode(ENCODING)
 
     def handle_chat(self, room):
-        self.chatroom = room
-        #print(f"Handle chat: {room}")
-        self.get_chat_sockets(room[0], room[1])
-        output_lock = threading.Lock()
-        run_recv_thread = threading.Event()
-        run_recv_thread.set()
-        
-        self.recv_thread = threading.Thread(target=self.chat_receive_thread, args=(output_lock, run_recv_thread))
-        self.recv_thread.daemon = True
-        self.recv_thread.start()
-        self.chat_prompt(output_lock, room)
-        run_recv_thread.clear()
-
-    def get_chat_sockets(self, multicast_ip, port):
-        try:
-            self.chat_recv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.chat_recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-            self.chat_recv_socket.bind((Client.RECV_ADDRESS, port))
-
-            multicast_group_bytes = socket.inet_aton(multicast_ip)
-            # Set up the interface to be used.
-            multicast_if_bytes = socket.inet_aton(RX_IFACE_ADDRESS)
-            # Form the multicast request.
-            multicast_request = multicast_group_bytes + multicast_if_bytes
-            # You can use struct.pack to create the request, but it is more complicated, e.g.,
-            # 'struct.pack("<4sl", multicast_group_bytes,
-            # int.from_bytes(multicast_if_bytes, byteorder='little'))'
-            # or 'struct.pack("<4sl", multicast_group_bytes, socket.INADDR_ANY)'
-
-            # Issue the Multicast IP Add Membership request.
-            #print("Adding membership (address/interface): ", MULTICAST_ADDRESS,"/", RX_IFACE_ADDRESS)
-            self.chat_recv_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_request)
-        except Exception as e:
-            print(f"Error while getting chat recv socket; {e}")
-            exit()
+        # Join the room, staying in any others, and chat in it.
+        if self.chat_rooms is None:
+            self.chat_rooms = ChatRooms(self.username, RX_IFACE_ADDRESS, Client.TTL, self.reliable)
         try:
-            self.chat_send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.chat_send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, Client.TTL)
-        except Exception as e:
-            print(f"Error while getting chat send socket; {e}")
-            exit()
+            self.chat_rooms.join(self.room_name, room[0], room[1])
+        except OSError as e:
+            print(f"Error while joining chat room; {e}")
+            return
+        self.handle_history_command(self.room_name)
+        self.chat_prompt()
+
+    def handle_history_command(self, name):
+        # Print what was said in the room before we joined.
+        args_field = f"{name}\n".encode(ENCODING)
+        self.socket.sendall(CMD["history"].to_bytes(CMD_FIELD_LEN, byteorder='big') + args_field)
+        payload = crds_protocol.recv_frame(self.socket)
+        if payload is None:
+            print("Server closed the connection.")
+            return
+        self.chat_rooms.replay(name, crds_protocol.unpack_history(payload))
 
-    def chat_receive_thread(self, output_lock, run_flag):
-        while run_flag.is_set():
-            data, address_port = self.chat_recv_socket.recvfrom(Client.RECV_SIZE)
-            data_str = data.decode(ENCODING)
-            author = data_str[:USER_FILED_LEN].rstrip()
-            if (author != self.username):
-                msg = data_str[USER_FILED_LEN:]
-                output_lock.acquire()
-                print(f"[{author}|{self.room_name}]: {msg}")
-                output_lock.release()
+    def handle_rooms_command(self):
+        rooms = self.chat_rooms.rooms if self.chat_rooms is not None else {}
+        for name, room in rooms.items():
+            print(f"{name}: {room.address}")
+        if not rooms:
+            print("Not in any chat rooms.")
+
+    def handle_leave_command(self, name):
+        if self.chat_rooms is None or not self.chat_rooms.leave(name):
+            print(f"Not in chat room {name}.")
+
+    def close_chat_rooms(self):
+        if self.chat_rooms is not None:
+            self.chat_rooms.close()
+            self.chat_rooms = None
 
     def set_name(self, name):
+        # Our messages carry the name, so leave rooms joined as before.
+        self.close_chat_rooms()
         self.username = name
 
     def close_connection(self):
+        self.stop_renewing()
+        self.close_chat_rooms()
+        self.close_subscription()
         self.socket.close()
 
 
@@ -335,5 +1243,63 @@ if __name__ == '__main__':
                         help='server or client role',
                         required=True, type=str)
 
+    parser.add_argument('-p', '--port',
+                        help='server port',
+                        default=Server.PORT, type=int)
+
+    parser.add_argument('-m', '--mode',
+                        choices=Server.MODES, default="thread",
+                        help='server: thread per connection, bounded thread pool or selectors event loop')
+
+    parser.add_argument('--max-connections',
+                        help='server: connection limit in pool and select modes',
+                        default=Server.MAX_CONNECTIONS, type=int)
+
+    parser.add_argument('--idle-timeout',
+                        help='server: seconds before an idle connection is closed in pool and select modes',
+                        default=Server.IDLE_TIMEOUT, type=float)
+
+    parser.add_argument('--workers',
+                        help='server: worker threads in pool mode',
+                        default=Server.POOL_WORKERS, type=int)
+
+    parser.add_argument('-j', '--journal-dir',
+                        help='server: keep the room directory in this directory across restarts')
+
+    parser.add_argument('--fsync-every',
+                        help='server: fsync the journal every N operations (1 = every operation, 0 = never)',
+                        default=DirectoryJournal.FSYNC_EVERY, type=int)
+
+    parser.add_argument('--snapshot-every',
+                        help='server: compact the journal into a snapshot every N operations',
+                        default=DirectoryJournal.SNAPSHOT_EVERY, type=int)
+
+    parser.add_argument('--pool',
+                        help='server: multicast network rooms made without an address are given one from',
+                        default=AddressPool.NETWORK, type=str)
+
+    parser.add_argument('--room-port',
+                        help='server: port of rooms given a pool address',
+                        default=Server.ROOM_PORT, type=int)
+
+    parser.add_argument('--history',
+                        help='server: chat messages kept per room for late joiners (0 = none)',
+                        default=RoomHistory.DEPTH, type=int)
+
+    parser.add_argument('--lease',
+                        help='server: seconds a room lives without a renew from its creator (0 = forever)',
+                        default=RoomLeases.LEASE, type=float)
+
+    parser.add_argument('--reliable',
+                        help='client: resend lost chat messages and print them in order',
+                        action='store_true')
+
     args = parser.parse_args()
-    roles[args.role]()
\ No newline at end of file
+    if args.role == 'server':
+        Server(port=args.port, mode=args.mode, max_connections=args.max_connections,
+               idle_timeout=args.idle_timeout, workers=args.workers,
+               journal_dir=args.journal_dir, fsync_every=args.fsync_every,
+               snapshot_every=args.snapshot_every, pool=args.pool,
+               room_port=args.room_port, history=args.history, lease=args.lease)
+    else:
+        Client(reliable=args.reliable)
\ No newline at end of file
@@ -4,14 +4,55 @@
 
 import socket
 import argparse
+import selectors
 import sys
 import time
 import struct
 
 ########################################################################
 
-# Read in the config.py file to set various addresses and ports.
-from config import *
+# The groups to send to / receive from: config.py's addresses and
+# ports, unless overridden from a file, the environment or the command
+# line. See config_loader.py.
+from config_loader import add_arguments, load_config
+
+########################################################################
+# Throughput mode (-t). Instead of a beacon every TIMEOUT seconds, the
+# sender sends fixed size packets as fast as --rate allows, each
+# stamped with a sequence number and its send time:
+#
+# -----------------------------------------------------------
+# | 4 byte sequence number | 8 byte send time (ns) | padding |
+# -----------------------------------------------------------
+#
+# The receiver uses the sequence numbers (per sender) to count lost
+# and out of order packets. Both ends print aggregate statistics every
+# --interval seconds instead of a line per packet, and the socket
+# buffer sizes can be set (--sndbuf / --rcvbuf) to see how they change
+# what gets through.
+#
+# Several groups can be given (see config_loader.py). The sender then
+# sends each packet to every group, and the receiver has a socket per
+# group, all waited on with one selector, and keeps statistics per
+# group as well as in total. That shows how fan-out to more groups
+# changes what one host can send and receive.
+########################################################################
+
+PACKET_HEADER = struct.Struct("!IQ")
+
+# Linux delivers a group's packets to every socket bound to the port,
+# whether or not it joined that group, unless IP_MULTICAST_ALL is off.
+if sys.platform.startswith("linux"):
+    IP_MULTICAST_ALL = getattr(socket, "IP_MULTICAST_ALL", 49)
+else:
+    IP_MULTICAST_ALL = getattr(socket, "IP_MULTICAST_ALL", None)
+
+def set_buffer_size(sock, option, size):
+    # The kernel may cap (Linux: net.core.rmem_max / wmem_max) or
+    # double the size asked for; report what we actually got.
+    if size:
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+    return sock.getsockopt(socket.SOL_SOCKET, option)
 
 ########################################################################
 # Broadcast Server class
@@ -35,9 +76,19 @@ class Sender:
     TTL_BYTE = TTL.to_bytes(TTL_SIZE, byteorder='big')
     # OR: TTL_BYTE = struct.pack('B', TTL)
 
-    def __init__(self):
+    # Throughput mode defaults.
+    RATE = 10000 # packets per second, 0 = as fast as possible
+    PAYLOAD = 64 # bytes per packet, header included
+    INTERVAL = 1.0 # seconds between statistics lines
+    TICK = 0.001
+
+    def __init__(self, groups=None, throughput=False, rate=RATE, payload=PAYLOAD, sndbuf=0, interval=INTERVAL):
+        self.groups = load_config() if groups is None else groups
         self.create_listen_socket()
-        self.send_messages_forever()
+        if throughput:
+            self.send_throughput_forever(rate, max(payload, PACKET_HEADER.size), sndbuf, interval)
+        else:
+            self.send_messages_forever()
 
     def create_listen_socket(self):
         try:
@@ -52,8 +103,9 @@ class Sender:
     def send_messages_forever(self):
         try:
             while True:
-                print("Sending multicast packet (address, port): ", MULTICAST_ADDRESS_PORT)
-                self.socket.sendto(Sender.MESSAGE_ENCODED, MULTICAST_ADDRESS_PORT)
+                for group in self.groups:
+                    print("Sending multicast packet (address, port): ", group.address_port)
+                    self.socket.sendto(Sender.MESSAGE_ENCODED, group.address_port)
                 time.sleep(Sender.TIMEOUT)
         except Exception as msg:
             print(msg)
@@ -63,30 +115,141 @@ class Sender:
             self.socket.close()
             sys.exit(1)
 
+    def send_throughput_forever(self, rate, payload, sndbuf, interval):
+        print("SO_SNDBUF: ", set_buffer_size(self.socket, socket.SO_SNDBUF, sndbuf))
+        addresses = [group.address_port for group in self.groups]
+        print(f"Sending {payload} byte packets at {rate or 'max'} packets/s to each (address, port): ",
+              *addresses)
+        packet = bytearray(payload)
+        # Each group gets every sequence number, so packets sent in all
+        # is seq times the number of groups.
+        seq = 0
+        errors = 0
+        last_seq = 0
+        start = last = time.perf_counter()
+        try:
+            while True:
+                now = time.perf_counter()
+                # Send whatever is due so far, then wait for the next tick.
+                due = int((now - start) * rate) if rate else seq + 1000
+                while seq < due:
+                    PACKET_HEADER.pack_into(packet, 0, seq & 0xFFFFFFFF, time.time_ns())
+                    for address_port in addresses:
+                        try:
+                            self.socket.sendto(packet, address_port)
+                        except OSError:
+                            # e.g. ENOBUFS: the send buffer or queue is full.
+                            errors += 1
+                    seq += 1
+                if now - last >= interval:
+                    sent = (seq - last_seq) * len(addresses)
+                    print(f"sent {sent / (now - last):10.0f} pkt/s {sent * payload * 8 / (now - last) / 1e6:8.2f} Mbit/s"
+                          f"  total {seq * len(addresses)}  send errors {errors}")
+                    last, last_seq = now, seq
+                if rate:
+                    time.sleep(Sender.TICK)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            print(f"Sent {seq * len(addresses)} packets in {time.perf_counter() - start:.1f} s,"
+                  f" {errors} send errors.")
+            self.socket.close()
+            sys.exit(1)
+
 ########################################################################
 # Echo Receiver class
 ########################################################################
 
+class GroupStats:
+
+    # Throughput mode statistics for one group, over the current
+    # interval and in total.
+
+    def __init__(self, name):
+        self.name = name
+        # Per sender (address, port): the next sequence number expected.
+        self.next_seq = {}
+        self.total_received = self.total_lost = 0
+        self.reset()
+
+    def reset(self):
+        self.received = self.nbytes = self.lost = self.reordered = 0
+        self.latency_ns = 0
+
+    def record(self, buf, n, address_port, now_ns):
+        if n < PACKET_HEADER.size:
+            return
+        seq, sent_ns = PACKET_HEADER.unpack_from(buf)
+        self.latency_ns += now_ns - sent_ns
+        self.received += 1
+        self.nbytes += n
+        expected = self.next_seq.get(address_port)
+        gap = 0 if expected is None else (seq - expected) & 0xFFFFFFFF
+        if gap >= 0x80000000:
+            # Behind what we expected: late or repeated.
+            self.reordered += 1
+        else:
+            self.lost += gap
+            self.next_seq[address_port] = (seq + 1) & 0xFFFFFFFF
+
+    def add(self, other):
+        self.received += other.received
+        self.nbytes += other.nbytes
+        self.lost += other.lost
+        self.reordered += other.reordered
+        self.latency_ns += other.latency_ns
+
+    def line(self, elapsed, senders):
+        loss = self.lost / (self.received + self.lost) if self.received + self.lost else 0.0
+        latency = f"{self.latency_ns / self.received / 1000:8.1f}" if self.received else "       -"
+        return (f"{self.name:>12} recv {self.received / elapsed:10.0f} pkt/s {self.nbytes * 8 / elapsed / 1e6:8.2f} Mbit/s"
+                f"  lost {self.lost} ({loss:.2%})  out of order {self.reordered}"
+                f"  latency {latency} us  senders {senders}")
+
+    def roll(self):
+        self.total_received += self.received
+        self.total_lost += self.lost
+        self.reset()
+
 class Receiver:
 
     RECV_SIZE = 256
-
-    def __init__(self):
-
-        print("Bind address/port = ", BIND_ADDRESS_PORT)
-        
-        self.get_socket()
-        self.receive_forever()
-
-    def get_socket(self):
+    # Throughput mode: room for the largest UDP payload.
+    THROUGHPUT_RECV_SIZE = 65535
+    # Datagrams read from one socket before looking at the others.
+    BATCH_SIZE = 64
+    INTERVAL = 1.0
+
+    def __init__(self, groups=None, throughput=False, rcvbuf=0, interval=INTERVAL):
+        self.groups = load_config() if groups is None else groups
+        self.selector = selectors.DefaultSelector()
+        self.sockets = []
+        for group in self.groups:
+            print("Bind address/port = ", group.bind_address_port)
+            sock = self.get_socket(group)
+            self.sockets.append(sock)
+            self.selector.register(sock, selectors.EVENT_READ, group)
+        if throughput:
+            self.receive_throughput_forever(rcvbuf, interval)
+        else:
+            self.receive_forever()
+
+    def get_socket(self, group):
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
 
             # Bind to an address/port. In multicast, this is viewed as
             # a "filter" that determines what packets make it to the
             # UDP app.
-            self.socket.bind(BIND_ADDRESS_PORT)
+            sock.bind(group.bind_address_port)
+
+            # Only receive the group this socket joins (see above).
+            if IP_MULTICAST_ALL is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+                except OSError:
+                    pass
 
             ############################################################
             # The multicast_request must contain a bytes object
@@ -96,12 +259,12 @@ class Receiver:
             # means all network interfaces.
             ############################################################
                         
-            multicast_group_bytes = socket.inet_aton(MULTICAST_ADDRESS)
+            multicast_group_bytes = socket.inet_aton(group.address)
 
-            print("Multicast Group: ", MULTICAST_ADDRESS)
+            print("Multicast Group: ", group.address)
 
             # Set up the interface to be used.
-            multicast_if_bytes = socket.inet_aton(RX_IFACE_ADDRESS)
+            multicast_if_bytes = socket.inet_aton(group.iface)
 
             # Form the multicast request.
             multicast_request = multicast_group_bytes + multicast_if_bytes
@@ -112,8 +275,9 @@ class Receiver:
             # or 'struct.pack("<4sl", multicast_group_bytes, socket.INADDR_ANY)'
 
             # Issue the Multicast IP Add Membership request.
-            print("Adding membership (address/interface): ", MULTICAST_ADDRESS,"/", RX_IFACE_ADDRESS)
-            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_request)
+            print("Adding membership (address/interface): ", group.address,"/", group.iface)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_request)
+            return sock
         except Exception as msg:
             print(msg)
             sys.exit(1)
@@ -121,15 +285,58 @@ class Receiver:
     def receive_forever(self):
         while True:
             try:
-                data, address_port = self.socket.recvfrom(Receiver.RECV_SIZE)
-                address, port = address_port
-                print("Received: ", data.decode('utf-8'), " Address:", address, " Port: ", port)
+                for key, mask in self.selector.select():
+                    data, address_port = key.fileobj.recvfrom(Receiver.RECV_SIZE)
+                    address, port = address_port
+                    print("Received: ", data.decode('utf-8'), " Address:", address, " Port: ", port,
+                          " Group: ", key.data.address)
             except KeyboardInterrupt:
                 print(); exit()
             except Exception as msg:
                 print(msg)
                 sys.exit(1)
 
+    def receive_throughput_forever(self, rcvbuf, interval):
+        for sock in self.sockets:
+            print("SO_RCVBUF: ", set_buffer_size(sock, socket.SO_RCVBUF, rcvbuf))
+            sock.setblocking(False)
+        buf = bytearray(Receiver.THROUGHPUT_RECV_SIZE)
+        stats = {group: GroupStats(group.name) for group in self.groups}
+        last = time.perf_counter()
+        try:
+            while True:
+                # Wake up at least once an interval, to print even when idle.
+                for key, mask in self.selector.select(max(0.0, last + interval - time.perf_counter())):
+                    group_stats = stats[key.data]
+                    recvfrom_into = key.fileobj.recvfrom_into
+                    for _ in range(Receiver.BATCH_SIZE):
+                        try:
+                            n, address_port = recvfrom_into(buf)
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        group_stats.record(buf, n, address_port, time.time_ns())
+                now = time.perf_counter()
+                if now - last >= interval:
+                    elapsed = now - last
+                    total = GroupStats("total")
+                    for group_stats in stats.values():
+                        total.add(group_stats)
+                        if len(stats) > 1:
+                            print(group_stats.line(elapsed, len(group_stats.next_seq)))
+                        group_stats.roll()
+                    print(total.line(elapsed, max(len(s.next_seq) for s in stats.values())))
+                    last = now
+        except KeyboardInterrupt:
+            print()
+        finally:
+            received = sum(s.total_received for s in stats.values())
+            lost = sum(s.total_lost for s in stats.values())
+            print(f"Received {received} packets, lost {lost}"
+                  f" ({lost / (received + lost) if received + lost else 0.0:.2%}).")
+            for sock in self.sockets:
+                sock.close()
+            sys.exit(1)
+
 ########################################################################
 # Process command line arguments if run directly.
 ########################################################################
@@ -143,8 +350,42 @@ if __name__ == '__main__':
                         help='sender or receiver role',
                         required=True, type=str)
 
+    parser.add_argument('-t', '--throughput',
+                        help='send/receive sequence stamped packets at a rate and print statistics',
+                        action='store_true')
+
+    parser.add_argument('--rate',
+                        help='sender, throughput mode: packets per second (0 = as fast as possible)',
+                        default=Sender.RATE, type=int)
+
+    parser.add_argument('--payload',
+                        help='sender, throughput mode: packet size in bytes',
+                        default=Sender.PAYLOAD, type=int)
+
+    parser.add_argument('--sndbuf',
+                        help='sender, throughput mode: SO_SNDBUF in bytes (0 = system default)',
+                        default=0, type=int)
+
+    parser.add_argument('--rcvbuf',
+                        help='receiver, throughput mode: SO_RCVBUF in bytes (0 = system default)',
+                        default=0, type=int)
+
+    parser.add_argument('--interval',
+                        help='throughput mode: seconds between statistics lines',
+                        default=Sender.INTERVAL, type=float)
+
+    add_arguments(parser)
+
     args = parser.parse_args()
-    roles[args.role]()
+    try:
+        groups = load_config(args)
+    except ValueError as msg:
+        print(f"Bad multicast configuration: {msg}")
+        sys.exit(1)
+    if args.role == 'sender':
+        Sender(groups, args.throughput, args.rate, args.payload, args.sndbuf, args.interval)
+    else:
+        Receiver(groups, args.throughput, args.rcvbuf, args.interval)
 
 ########################################################################
 
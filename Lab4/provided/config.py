@@ -3,6 +3,9 @@
 #
 # Address configuration for MulticastSenderReceiverConfig.py
 #
+# These are the defaults. config_loader.py lets a config file, the
+# environment or the command line override them, and add more groups.
+#
 ########################################################################
 
 # Two sample multicast addresses to experiment with.
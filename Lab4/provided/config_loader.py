@@ -0,0 +1,147 @@
+########################################################################
+#
+# Runtime configuration for MulticastSenderReceiverConfig.py
+#
+# config.py holds the defaults: one group, MULTICAST_ADDRESS port
+# MULTICAST_PORT, received on interface RX_IFACE_ADDRESS with the
+# socket bound to RX_BIND_ADDRESS. These can be overridden, and any
+# number of groups given, without editing code. From lowest to highest
+# precedence:
+#
+# 1. A config file, named by --config or the MULTICAST_CONFIG
+#    environment variable, with an optional [defaults] section and one
+#    section per group:
+#
+#        [defaults]
+#        port = 2000
+#        iface = 0.0.0.0
+#        bind = 0.0.0.0
+#
+#        [group a]
+#        address = 239.0.0.10
+#
+#        [group b]
+#        address = 239.0.0.11
+#        port = 2001
+#
+# 2. Environment variables: MULTICAST_GROUPS (comma separated
+#    address[:port] list), MULTICAST_PORT, RX_IFACE_ADDRESS and
+#    RX_BIND_ADDRESS.
+#
+# 3. The command line: -g/--group address[:port] (repeatable), --port,
+#    --iface and --bind.
+#
+# Groups given at one level replace those from the levels below it.
+# port, iface and bind apply to every group without a port of its own.
+# A bind of "group" binds each group's socket to the group address, so
+# it only receives that group even when groups share a port.
+#
+########################################################################
+
+import configparser
+import ipaddress
+import os
+import socket
+
+import config
+
+class Group:
+
+    def __init__(self, name, address, port, iface, bind):
+        self.name = name
+        self.address = address
+        self.port = port
+        self.iface = iface
+        self.bind = address if bind == "group" else bind
+
+        # Sender:
+        self.address_port = (self.address, self.port)
+        # Receiver:
+        self.bind_address_port = (self.bind, self.port)
+
+def add_arguments(parser):
+    parser.add_argument('--config',
+                        help='group configuration file (default: $MULTICAST_CONFIG)')
+
+    parser.add_argument('-g', '--group',
+                        help='multicast group address[:port]; repeat for several groups',
+                        action='append')
+
+    parser.add_argument('--port',
+                        help='port of groups not given one',
+                        type=int)
+
+    parser.add_argument('--iface',
+                        help='receive interface address (0.0.0.0 = let the system choose)')
+
+    parser.add_argument('--bind',
+                        help='receiver bind address, or "group" for each group address')
+
+def parse_group(spec):
+    # "address[:port]" -> (name, address, port or None).
+    address, _, port = spec.strip().partition(":")
+    return (spec.strip(), address, int(port) if port else None)
+
+def read_file(path):
+    parser = configparser.ConfigParser()
+    if not parser.read(path):
+        raise ValueError(f"cannot read config file {path}")
+    settings = dict(parser["defaults"]) if parser.has_section("defaults") else {}
+    groups = []
+    for section in parser.sections():
+        if section.startswith("group "):
+            values = parser[section]
+            if "address" not in values:
+                raise ValueError(f"[{section}] has no address")
+            groups.append((section[len("group "):].strip(), values["address"],
+                           int(values["port"]) if "port" in values else None))
+    return settings, groups
+
+def load_config(args=None, environ=None):
+    # Returns the list of Groups; args is the parsed command line (see
+    # add_arguments), if any. Raises ValueError for a bad setting.
+    environ = os.environ if environ is None else environ
+    settings = {"port": config.MULTICAST_PORT, "iface": config.RX_IFACE_ADDRESS, "bind": config.RX_BIND_ADDRESS}
+    groups = [("default", config.MULTICAST_ADDRESS, None)]
+
+    path = getattr(args, "config", None) or environ.get("MULTICAST_CONFIG")
+    if path:
+        file_settings, file_groups = read_file(path)
+        settings.update((key, file_settings[key]) for key in settings if key in file_settings)
+        if file_groups:
+            groups = file_groups
+
+    if environ.get("MULTICAST_GROUPS"):
+        groups = [parse_group(spec) for spec in environ["MULTICAST_GROUPS"].split(",") if spec.strip()]
+    for key, variable in (("port", "MULTICAST_PORT"), ("iface", "RX_IFACE_ADDRESS"), ("bind", "RX_BIND_ADDRESS")):
+        if variable in environ:
+            settings[key] = environ[variable]
+
+    if getattr(args, "group", None):
+        groups = [parse_group(spec) for spec in args.group]
+    for key in settings:
+        if getattr(args, key, None) is not None:
+            settings[key] = getattr(args, key)
+
+    result = []
+    for name, address, port in groups:
+        group = Group(name, address, int(settings["port"] if port is None else port),
+                      settings["iface"], settings["bind"])
+        for what, value in (("address", group.address), ("interface", group.iface), ("bind address", group.bind)):
+            if value == "" and what == "bind address":
+                # Bind to any address, as "0.0.0.0".
+                continue
+            try:
+                socket.inet_aton(value)
+            except OSError:
+                raise ValueError(f"group {name}: bad {what} {value!r}")
+        if not ipaddress.IPv4Address(socket.inet_ntoa(socket.inet_aton(group.address))).is_multicast:
+            raise ValueError(f"group {name}: {group.address} is not a multicast address")
+        if not 0 < group.port <= 0xFFFF:
+            raise ValueError(f"group {name}: bad port {group.port}")
+        result.append(group)
+    if not result:
+        raise ValueError("no multicast groups configured")
+    return result
+
+########################################################################
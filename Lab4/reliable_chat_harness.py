@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Loss injection test for the reliable chat layer (chat_reliable).
+#
+# One sender and --receivers receivers share a chat room on loopback
+# multicast, each with its own sockets and receive loop, as separate
+# clients would. The receivers drop each incoming datagram (messages,
+# resends and control datagrams alike) with probability --loss, and
+# hold one back until after the next with probability --reorder, from
+# the first message on (a receiver follows a sender from the first
+# message it gets). The sender sends --messages numbered messages at
+# --rate per second, then goes quiet for --settle seconds while the
+# gaps are repaired.
+#
+# Each receiver must print every message exactly once and in order. The
+# JSON report gives, per receiver, what it delivered, what was injected
+# and how many NACKs it sent, and how many resends the sender made. The
+# exit status is 1 if any receiver missed or misordered a message.
+#
+#   python reliable_chat_harness.py --messages 20000 --loss 0.05
+#
+# With --replay it instead checks a late joiner: a ChatRooms client
+# joins after m0..m4 were sent, is replayed them as room history, and
+# then gets m6 live, m5 having been lost. It must NACK m5 (and nothing
+# before it) and print m0..m6 exactly once each, in order.
+#
+#   python reliable_chat_harness.py --replay
+#
+########################################################################
+
+import argparse
+import json
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+from main import Client, RX_IFACE_ADDRESS
+from chat_reliable import ReliableSender, ReliableChatReceiver
+from chat_rooms import ChatRooms
+
+########################################################################
+
+GROUP = "239.1.255.3"
+PORT = 41003
+# Where messages the joiner must not receive live are sent instead.
+NOWHERE = ("239.1.255.4", 41004)
+REPLAYED = 5
+TICK = 0.001
+LINE = re.compile(r"\[sender\|room\]: m(\d+)$")
+
+class Collector:
+
+    # Output stream for a receiver; keeps its lines.
+
+    def __init__(self):
+        self.text = []
+
+    def write(self, text):
+        self.text.append(text)
+
+    def flush(self):
+        pass
+
+    def numbers(self):
+        return [int(LINE.match(line).group(1)) for line in "".join(self.text).splitlines()]
+
+class LossyReceiver(ReliableChatReceiver):
+
+    def __init__(self, *args, loss=0.0, reorder=0.0, seed=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loss = loss
+        self.reorder = reorder
+        self.rng = random.Random(seed)
+        self.held = None
+        self.dropped = 0
+        self.swapped = 0
+
+    def handle(self, data, lines):
+        if not self.streams:
+            # Nothing to lose yet; we start following at this message.
+            super().handle(data, lines)
+            return
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        if self.held is None and self.rng.random() < self.reorder:
+            self.held = data
+            self.swapped += 1
+            return
+        super().handle(data, lines)
+        self.release(lines)
+
+    def release(self, lines):
+        if self.held is not None:
+            held, self.held = self.held, None
+            super().handle(held, lines)
+
+    def tick(self):
+        # Nothing followed the held datagram for a whole poll.
+        lines = []
+        self.release(lines)
+        self.write(lines)
+        super().tick()
+
+def chat_sockets(group, port):
+    recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    recv_sock.bind((Client.RECV_ADDRESS, port))
+    recv_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                         socket.inet_aton(group) + socket.inet_aton(RX_IFACE_ADDRESS))
+    send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, Client.TTL)
+    return recv_sock, send_sock
+
+def start(receiver, run_flag):
+    thread = threading.Thread(target=receiver.run, args=(run_flag,), daemon=True)
+    thread.start()
+    return thread
+
+def run(args):
+    address = (args.group, args.port)
+    run_flag = threading.Event()
+    run_flag.set()
+    sockets = []
+    threads = []
+
+    recv_sock, send_sock = chat_sockets(args.group, args.port)
+    sockets += [recv_sock, send_sock]
+    sender = ReliableSender("sender")
+    # The sender's own receive loop answers NACKs and sends SYNCs.
+    threads.append(start(ReliableChatReceiver(recv_sock, "sender", "room", sender, send_sock, address,
+                                              out=Collector()), run_flag))
+
+    receivers = []
+    for i in range(args.receivers):
+        recv_sock, send_sock = chat_sockets(args.group, args.port)
+        sockets += [recv_sock, send_sock]
+        receiver = LossyReceiver(recv_sock, f"receiver{i}", "room", ReliableSender(f"receiver{i}"),
+                                 send_sock, address, out=Collector(),
+                                 loss=args.loss, reorder=args.reorder, seed=args.seed + i)
+        receivers.append(receiver)
+        threads.append(start(receiver, run_flag))
+
+    send_sock = sockets[1]
+    sent = 0
+    begin = time.perf_counter()
+    while sent < args.messages:
+        due = min(int((time.perf_counter() - begin) * args.rate), args.messages)
+        while sent < due:
+            sender.send(send_sock, f"m{sent}", address)
+            sent += 1
+        time.sleep(TICK)
+    send_seconds = time.perf_counter() - begin
+    time.sleep(args.settle)
+    run_flag.clear()
+    for thread in threads:
+        thread.join()
+    for sock in sockets:
+        sock.close()
+
+    results = []
+    for receiver in receivers:
+        numbers = receiver.out.numbers()
+        results.append({
+            "delivered": len(numbers),
+            "missing": args.messages - len(set(numbers)),
+            "duplicates": len(numbers) - len(set(numbers)),
+            "in_order": numbers == sorted(numbers),
+            "injected_drops": receiver.dropped,
+            "injected_reorders": receiver.swapped,
+            "nacks_sent": receiver.nacks_sent,
+            "duplicates_discarded": receiver.duplicates,
+            "given_up": receiver.lost,
+        })
+    ok = all(r["missing"] == 0 and r["duplicates"] == 0 and r["in_order"] for r in results)
+    report = {
+        "messages": args.messages,
+        "rate": args.rate,
+        "send_seconds": send_seconds,
+        "loss": args.loss,
+        "reorder": args.reorder,
+        "sender_resent": sender.resent,
+        "receivers": results,
+        "ok": ok,
+    }
+    return report
+
+def replay_check(args):
+    address = (args.group, args.port)
+    run_flag = threading.Event()
+    run_flag.set()
+    recv_sock, send_sock = chat_sockets(args.group, args.port)
+    sender = ReliableSender("sender")
+    thread = start(ReliableChatReceiver(recv_sock, "sender", "room", sender, send_sock, address,
+                                        out=Collector()), run_flag)
+
+    # Sent before the joiner joined; what the server's history has.
+    for i in range(REPLAYED):
+        sender.send(send_sock, f"m{i}", NOWHERE)
+    history = [sender.history[seq][1] for seq in range(REPLAYED)]
+
+    out = Collector()
+    rooms = ChatRooms("joiner", RX_IFACE_ADDRESS, reliable=True, out=out)
+    rooms.join("room", args.group, args.port)
+    replayed = rooms.replay("room", history)
+    sender.send(send_sock, f"m{REPLAYED}", NOWHERE)
+    sender.send(send_sock, f"m{REPLAYED + 1}", address)
+    time.sleep(args.settle)
+    receiver = rooms.rooms["room"].receiver
+    rooms.close()
+    run_flag.clear()
+    thread.join()
+    recv_sock.close()
+    send_sock.close()
+
+    numbers = out.numbers()
+    return {
+        "replayed": replayed,
+        "printed": numbers,
+        "nacks_sent": receiver.nacks_sent,
+        "sender_resent": sender.resent,
+        "ok": numbers == list(range(REPLAYED + 2)) and sender.resent == 1,
+    }
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reliable chat loss injection test")
+    parser.add_argument('--messages', default=20000, type=int)
+    parser.add_argument('--rate', default=5000, type=int, help='messages per second')
+    parser.add_argument('--receivers', default=3, type=int)
+    parser.add_argument('--loss', default=0.05, type=float, help='receiver drop probability')
+    parser.add_argument('--reorder', default=0.02, type=float, help='receiver swap probability')
+    parser.add_argument('--settle', default=1.0, type=float, help='seconds to repair gaps after sending')
+    parser.add_argument('--seed', default=1, type=int)
+    parser.add_argument('--group', default=GROUP)
+    parser.add_argument('--port', default=PORT, type=int)
+    parser.add_argument('--replay', action='store_true', help='check history replay for a late joiner')
+    args = parser.parse_args()
+
+    report = replay_check(args) if args.replay else run(args)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["ok"] else 1)
+
+########################################################################
@@ -0,0 +1,77 @@
+########################################################################
+#
+# Chat history kept by the CRDS server, for late joiners.
+#
+# RoomHistory subscribes to the DirectoryStore and is a member of every
+# room in it, using the same ChatRooms sockets and receive loop as a
+# client. For each room it keeps the last depth datagrams, raw, in a
+# deque. Memory per room is at most depth * chat_protocol.MAX_DATAGRAM,
+# whatever the traffic. The history command returns a room's datagrams
+# in one frame (crds_protocol.pack_history). The joining client formats
+# them as it does live messages, so names and sequence numbers are kept
+# and the clients do not need to resend anything.
+#
+# NACK and SYNC datagrams of the reliable layer are not kept.
+#
+########################################################################
+
+import collections
+
+import chat_protocol
+import crds_protocol
+from chat_receiver import ChatReceiver
+from chat_rooms import ChatRoom, ChatRooms
+
+class HistoryReceiver(ChatReceiver):
+
+    def __init__(self, sock, room_name, depth):
+        super().__init__(sock, "", room_name)
+        # We send nothing, so keep every datagram.
+        self.own_prefix = None
+        self.messages = collections.deque(maxlen=depth)
+
+    def handle(self, data, lines):
+        if data[:1] not in (chat_protocol.NACK_BYTE, chat_protocol.SYNC_BYTE):
+            self.messages.append(data)
+
+class RoomHistory(ChatRooms):
+
+    DEPTH = 100
+
+    def __init__(self, depth=DEPTH, iface_address="0.0.0.0"):
+        super().__init__("", iface_address)
+        self.depth = depth
+        self.listed = False
+
+    def make_room(self, name, group, port, sock):
+        return ChatRoom(name, group, port, None, HistoryReceiver(sock, name, self.depth))
+
+    def update(self, frame):
+        # DirectoryStore subscriber: the full listing, then a delta per
+        # change. Runs under the store's write lock.
+        payload = memoryview(frame)[crds_protocol.LENGTH_FIELD.size:]
+        if not self.listed:
+            self.listed = True
+            version, rooms = crds_protocol.unpack_directory(payload)
+            for name, (ip, port) in rooms.items():
+                self.follow(name, ip, port)
+            return
+        op, version, name, ip, port = crds_protocol.unpack_delta(payload)
+        if op == crds_protocol.DELTA_ADD:
+            self.follow(name, ip, port)
+        else:
+            self.leave(name)
+
+    def follow(self, name, ip, port):
+        try:
+            self.join(name, ip, port)
+        except OSError as msg:
+            print(f"Not keeping history of room {name}: {msg}")
+
+    def messages(self, name):
+        # The room's datagrams, oldest first; empty for unknown rooms.
+        with self.lock:
+            room = self.rooms.get(name)
+            return list(room.receiver.messages) if room is not None else []
+
+########################################################################
@@ -0,0 +1,84 @@
+########################################################################
+#
+# Room leases for the CRDS server.
+#
+# Every room holds a lease of `lease` seconds, granted when it is made
+# and extended by renew (the client sends one for the rooms it made
+# every RENEW_INTERVAL). Rooms whose lease runs out are deleted by the
+# server's sweeper, so rooms whose creators are gone drop out of the
+# directory.
+#
+# Expiry times are kept in a dict and, for the sweeper, in a heap of
+# (expiry, name). A renew or grant pushes a new heap entry rather than
+# moving the old one; stale entries (a renewed or released lease) are
+# skipped when they reach the top, and the heap is rebuilt when they
+# outnumber the live ones. Granting, renewing and expiring a room are
+# O(log n); a sweep with nothing due only looks at the top of the heap.
+#
+# The sweep metrics (sweeps, rooms evicted, time spent) are kept here
+# for the server to report.
+#
+# Not thread safe; the server calls it under its allocation lock.
+#
+########################################################################
+
+import heapq
+import time
+
+class RoomLeases:
+
+    LEASE = 300.0
+
+    def __init__(self, lease=LEASE):
+        self.lease = lease
+        self.expiry = {} # room name -> expiry time (time.monotonic)
+        self.heap = [] # (expiry, room name), some stale
+        self.sweeps = 0
+        self.evicted = 0
+        self.sweep_seconds = 0.0
+        self.max_sweep_seconds = 0.0
+
+    def grant(self, name, now=None):
+        expiry = (time.monotonic() if now is None else now) + self.lease
+        self.expiry[name] = expiry
+        heapq.heappush(self.heap, (expiry, name))
+        if len(self.heap) > 2 * len(self.expiry) + 64:
+            self.compact()
+
+    def renew(self, name, now=None):
+        # False if name holds no lease (never made, or expired).
+        if name not in self.expiry:
+            return False
+        self.grant(name, now)
+        return True
+
+    def release(self, name):
+        # The heap entry goes when it reaches the top.
+        self.expiry.pop(name, None)
+
+    def expired(self, now=None):
+        # Take the names whose leases have run out, soonest first.
+        now = time.monotonic() if now is None else now
+        names = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            expiry, name = heapq.heappop(heap)
+            if self.expiry.get(name) == expiry:
+                del self.expiry[name]
+                names.append(name)
+        return names
+
+    def compact(self):
+        self.heap = [(expiry, name) for name, expiry in self.expiry.items()]
+        heapq.heapify(self.heap)
+
+    def record_sweep(self, evicted, seconds):
+        self.sweeps += 1
+        self.evicted += evicted
+        self.sweep_seconds += seconds
+        self.max_sweep_seconds = max(self.max_sweep_seconds, seconds)
+
+    def __len__(self):
+        return len(self.expiry)
+
+########################################################################
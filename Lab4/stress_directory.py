@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Concurrency stress run for the CRDS room directory.
+#
+# Starts a directory Server on a thread and has many TCP clients make,
+# list and delete rooms at the same time. Each client owns its own
+# rooms, so at the end exactly the rooms that were made and not
+# deleted must be listed. Every getdir response is checked to be a
+# well formed listing. Prints a JSON summary and exits non-zero if
+# anything was inconsistent, e.g.
+#
+#   python stress_directory.py --clients 50 --ops 200
+#
+########################################################################
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from main import Server, CMD, CMD_FIELD_LEN, ENCODING
+from directory_store import NO_ROOMS_MSG
+
+########################################################################
+
+RECV_SIZE = 1 << 20
+CMD_BYTES = {name: code.to_bytes(CMD_FIELD_LEN, byteorder='big') for name, code in CMD.items()}
+
+def getdir(sock):
+    # The text listing is not length prefixed; a complete one ends in
+    # a newline (or is the no rooms message).
+    sock.sendall(CMD_BYTES["getdir"])
+    listing = b""
+    while True:
+        recvd = sock.recv(RECV_SIZE)
+        if len(recvd) == 0:
+            raise ConnectionError("connection closed by server")
+        listing += recvd
+        text = listing.decode(ENCODING, errors="replace")
+        if text.endswith("\n") or text == NO_ROOMS_MSG:
+            return text
+
+def parse_listing(listing):
+    # Returns the room names, or None if the listing is malformed.
+    if listing == NO_ROOMS_MSG:
+        return set()
+    if not listing.endswith("\n"):
+        return None
+    names = set()
+    for line in listing[:-1].split("\n"):
+        name, sep, address = line.partition(": ")
+        if not sep or not (address.startswith("(") and address.endswith(")")):
+            return None
+        names.add(name)
+    return names
+
+def client_worker(port, index, ops, result):
+    rng = random.Random(index)
+    mine = set()
+    bad = 0
+    sock = socket.create_connection(("127.0.0.1", port))
+    for i in range(ops):
+        action = rng.random()
+        if action < 0.3:
+            name = f"c{index}r{i}"
+            sock.sendall(CMD_BYTES["makeroom"] + f"{name} 239.0.{index % 256}.{i % 256} {5000 + i}\n".encode(ENCODING))
+            mine.add(name)
+        elif action < 0.6 and mine:
+            name = mine.pop()
+            sock.sendall(CMD_BYTES["deleteroom"] + f"{name}\n".encode(ENCODING))
+        else:
+            names = parse_listing(getdir(sock))
+            if names is None:
+                bad += 1
+            # Our own earlier commands must already be visible.
+            elif not {n for n in names if n.startswith(f"c{index}r")} == mine:
+                bad += 1
+    result[index] = (mine, bad, ops)
+    sock.close()
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CRDS directory concurrency stress run")
+    parser.add_argument('--clients', default=50, type=int)
+    parser.add_argument('--ops', default=200, type=int, help='operations per client')
+    args = parser.parse_args()
+
+    # Every client connects at once.
+    Server.BACKLOG = max(Server.BACKLOG, args.clients)
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        server = Server(port=0, serve=False)
+        threading.Thread(target=server.process_connections_forever, daemon=True).start()
+
+        result = {}
+        threads = [threading.Thread(target=client_worker, args=(server.port, i, args.ops, result))
+                   for i in range(args.clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        with socket.create_connection(("127.0.0.1", server.port)) as sock:
+            final = parse_listing(getdir(sock))
+        server.shutdown()
+
+    expected = set().union(*(mine for mine, _, _ in result.values()))
+    bad = sum(b for _, b, _ in result.values())
+    total_ops = sum(o for _, _, o in result.values())
+    summary = {
+        "clients": args.clients,
+        "ops": total_ops,
+        "seconds": elapsed,
+        "ops_per_sec": total_ops / elapsed,
+        "directory_version": server.directory.snapshot.version,
+        "rooms": len(expected),
+        "inconsistent_getdir": bad,
+        "final_listing_ok": final == expected,
+    }
+    print(json.dumps(summary, indent=2))
+    sys.exit(0 if bad == 0 and final == expected and len(result) == args.clients else 1)
+
+########################################################################